@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+bench_frames.py — Micro-benchmarks del procesado de frames de VIGIA
+
+Mide con frames sintéticos (sin X11 ni servidor) el coste por frame de las
+rutas calientes de client.py, y el retraso que la pantalla compartida del
+profesor mete en el event loop de server.py.
+
+Ejecutar:  python3 bench_frames.py [jpeg|formatos|escalado|lag ...]   (por defecto, todas)
+           python3 bench_frames.py jpeg > bench_output.txt
+"""
+
+import sys
+import time
+import types
+
+import numpy as np
+
+import client
+
+RESOLUCIONES = {'1080p': (1920, 1080), '1440p': (2560, 1440)}
+REPETICIONES = 20
+
+
+def captura_sintetica(w, h, semilla=0):
+    """Imita un mss.ScreenShot de un escritorio: fondo en degradado, ventanas
+    planas y "texto" (ruido de alta frecuencia en franjas)."""
+    rng = np.random.default_rng(semilla)
+    px = np.empty((h, w, 4), np.uint8)
+    px[..., 0] = np.linspace(40, 90, w, dtype=np.uint8)
+    px[..., 1] = np.linspace(30, 60, h, dtype=np.uint8)[:, None]
+    px[..., 2] = 50
+    px[..., 3] = 255
+    for _ in range(6):
+        x, y = rng.integers(0, w // 2), rng.integers(0, h // 2)
+        px[y:y + h // 3, x:x + w // 3, :3] = rng.integers(180, 255, 3)
+        lineas = px[y + 20:y + h // 3 - 20:14, x + 20:x + w // 3 - 20, :3]
+        lineas[rng.random(lineas.shape[:2]) < 0.3] = 20
+    return types.SimpleNamespace(bgra=px.tobytes(), width=w, height=h, size=(w, h))
+
+
+def medir(fn, repeticiones=REPETICIONES):
+    """Devuelve (ms por llamada, último resultado); la primera llamada calienta."""
+    res = fn()
+    t0 = time.perf_counter()
+    for _ in range(repeticiones):
+        res = fn()
+    return (time.perf_counter() - t0) * 1000 / repeticiones, res
+
+
+def bench_jpeg():
+    """Codificación JPEG a calidad CALIDAD_JPEG: Pillow (frombytes + save)
+    frente a libjpeg-turbo directo desde el buffer BGRA."""
+    backends = ['pillow'] + (['turbo'] if client.TURBO_OK else [])
+    print(f"JPEG calidad {client.CALIDAD_JPEG} (turbo {'disponible' if client.TURBO_OK else 'NO instalado'})")
+    for nombre, (w, h) in RESOLUCIONES.items():
+        cap = captura_sintetica(w, h)
+        for backend in backends:
+            cod = client._CodificadorImagen(backend)
+            ms, jpeg = medir(lambda: cod.bgra(cap, client.CALIDAD_JPEG))
+            print(f"  {nombre:6} {backend:7} {ms:8.1f} ms/frame  {len(jpeg) / 1024:7.0f} KiB")
+
+
+def bench_formatos():
+    """Miniatura a ANCHO_IMAGEN: tamaño y coste de JPEG frente a WebP/AVIF
+    (los formatos que negocia image_formats) con las opciones de OPCIONES_FORMATO."""
+    print(f"Formatos de miniatura a {client.ANCHO_IMAGEN} px, calidad {client.CALIDAD_JPEG}")
+    w = client.ANCHO_IMAGEN
+    cap = captura_sintetica(w, w * 9 // 16)
+    img = client.Image.frombytes('RGB', cap.size, cap.bgra, 'raw', 'BGRX')
+    for formato in ('jpeg', 'webp', 'avif'):
+        if not client._formato_disponible(formato):
+            print(f"  {formato:5} no disponible en este Pillow")
+            continue
+        cod = client._CodificadorImagen(formato=formato)
+        ms, datos = medir(lambda: cod.imagen(img, client.CALIDAD_JPEG), repeticiones=5)
+        print(f"  {formato:5} {ms:8.1f} ms/frame  {len(datos) / 1024:7.0f} KiB")
+
+
+def bench_escalado():
+    """Coste de reducir una captura 1080p/4K a miniatura: LANCZOS (método
+    anterior) frente a reduce()+BOX y al promedio por áreas con NumPy. La
+    calidad se da como PSNR respecto a LANCZOS."""
+    Image = client.Image
+
+    def lanczos(cap, ancho):
+        img = Image.frombytes('RGB', cap.size, cap.bgra, 'raw', 'BGRX')
+        return img.resize((ancho, round(img.height * ancho / img.width)), Image.LANCZOS)
+
+    metodos = {'lanczos': lanczos,
+               'pillow': lambda cap, ancho: client._escalar_captura(cap, ancho, 'pillow'),
+               'numpy': lambda cap, ancho: client._escalar_captura(cap, ancho, 'numpy')}
+    print("Reducción de capturas (ms/frame, PSNR dB frente a LANCZOS)")
+    for nombre, (w, h) in {'1080p': (1920, 1080), '4K': (3840, 2160)}.items():
+        cap = captura_sintetica(w, h)
+        for ancho in (client.ANCHO_IMAGEN, client.ANCHO_MIN, 192):
+            ref = np.asarray(lanczos(cap, ancho), np.float64)
+            linea = []
+            for metodo, fn in metodos.items():
+                ms, img = medir(lambda: fn(cap, ancho), repeticiones=10)
+                mse = np.mean((np.asarray(img, np.float64) - ref) ** 2)
+                psnr = '   ref' if metodo == 'lanczos' else f"{10 * np.log10(255 ** 2 / max(mse, 1e-9)):6.1f}"
+                linea.append(f"{metodo} {ms:6.1f} ms {psnr}")
+            print(f"  {nombre:5} → {ancho:4}px  " + " | ".join(linea))
+
+
+def bench_lag(duracion=3.0, tick=0.005):
+    """Retraso del event loop de eventlet (lo que espera cualquier otro evento)
+    mientras se comparte una pantalla 1080p que cambia entera en cada frame:
+    sin compartir, capturando y codificando en el propio green thread (como
+    antes) y en el hilo de captura de server.py (_hilo_captura_profesor)."""
+    import eventlet
+    import server
+    frames = [captura_sintetica(1920, 1080, semilla=i) for i in range(4)]
+    capturas = [0]
+
+    def capturar():
+        capturas[0] += 1
+        return frames[capturas[0] % len(frames)]
+
+    def en_el_loop(gen):
+        cambios = server._CambiosProfesor()
+        while server._captura_vigente(gen):
+            t0 = time.monotonic()
+            cap = capturar()
+            img = client.Image.frombytes('RGB', cap.size, cap.bgra, 'raw', 'BGRX')
+            cambios.codificar(server._reducir(img, server.ANCHO_PROFESOR), server.CALIDAD_PROFESOR, t0)
+            eventlet.sleep(max(0.0, 1 / cambios.fps - (time.monotonic() - t0)))
+
+    modos = {'apagado': None, 'en el loop': en_el_loop,
+             'en un hilo': lambda gen: server._teacher_capture_loop(gen, capturar)}
+    print(f"Retraso del event loop compartiendo 1080p en movimiento ({duracion:.0f} s, tick {tick * 1000:.0f} ms)")
+    for nombre, fn in modos.items():
+        server._parar_captura_profesor()
+        server._teacher_capture['running'] = fn is not None
+        tarea = eventlet.spawn(fn, server._teacher_capture['gen']) if fn else None
+        inicio = capturas[0]
+        retrasos = []
+        fin = time.monotonic() + duracion
+        while time.monotonic() < fin:
+            t0 = time.monotonic()
+            eventlet.sleep(tick)
+            retrasos.append((time.monotonic() - t0 - tick) * 1000)
+        server._parar_captura_profesor()
+        if tarea:
+            tarea.wait()
+        r = np.array(retrasos)
+        fps = (capturas[0] - inicio) / duracion
+        print(f"  {nombre:10}  medio {r.mean():6.1f} ms  p95 {np.percentile(r, 95):6.1f} ms"
+              f"  máx {r.max():6.1f} ms  ({fps:4.1f} capturas/s)")
+
+
+PRUEBAS = {'jpeg': bench_jpeg, 'formatos': bench_formatos, 'escalado': bench_escalado,
+           'lag': bench_lag}
+
+if __name__ == '__main__':
+    for nombre in sys.argv[1:] or PRUEBAS:
+        PRUEBAS[nombre]()
@@ -11,7 +11,9 @@ import io
 import re
 import json
 import time
+import zlib
 import socket
+import struct
 import threading
 import queue
 import base64
@@ -64,6 +66,22 @@ try:
 except ImportError:
     _instalar("Pillow"); from PIL import Image
 
+# NumPy (opcional): comparación vectorizada de frames para la codificación delta
+try:
+    import numpy as np
+    NP_OK = True
+except ImportError:
+    np = None; NP_OK = False
+
+# libjpeg-turbo (opcional, PyTurboJPEG): codifica JPEG desde arrays NumPy o desde
+# el buffer BGRA de mss sin pasar por Image.frombytes
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGRA, TJPF_RGB, TJSAMP_420
+    _turbo = TurboJPEG()
+    TURBO_OK = NP_OK
+except Exception:
+    _turbo = None; TURBO_OK = False
+
 try:
     import tkinter as tk
     TK_OK = True
@@ -217,6 +235,50 @@ CALIDAD_JPEG      = 55
 INTERVALO_SEG     = 1.0
 REINTENTOS_ESPERA = 5
 
+# Control adaptativo: el servidor informa de su carga (server_load) y el cliente
+# degrada la captura por niveles, de los valores de arriba (nivel 0) a estos.
+INTERVALO_MAX      = 4.0
+ANCHO_MIN          = 640
+CALIDAD_MIN        = 30
+NIVELES_CARGA      = 4
+LAG_OBJETIVO_MS    = 50     # retraso del event loop del servidor tolerado
+COLA_OBJETIVO      = 60     # frames retenidos esperando a un dashboard lento (batch_ack)
+REPORTES_RECUPERAR = 5      # informes holgados seguidos antes de subir un nivel
+
+# Suscripción por visibilidad (capture_mode): si la tarjeta del alumno no está en
+# pantalla en ningún dashboard se captura más despacio; si nadie mira, se pausa.
+FACTOR_LENTO       = 5
+
+# Codificación delta: solo viajan los bloques que cambian respecto al frame anterior
+DELTA_ACTIVO       = True
+TAM_BLOQUE         = 64     # px; múltiplo de 16 para alinear con los MCU del JPEG
+KEYFRAME_SEG       = 10.0   # keyframe completo periódico
+MAX_FRACCION_DELTA = 0.4    # si cambia más de esta fracción de bloques → keyframe
+
+# Pantalla sin cambios: hash perceptual de la captura antes de redimensionar/codificar
+UMBRAL_HASH        = 0          # celdas distintas toleradas (0 = toda celda cuyo nivel cambie)
+REJILLA_HASH       = (64, 36)   # celdas (ancho, alto) del hash
+# El hash muestrea 1 de cada 4 píxeles y promedia cada celda en 64 niveles: un
+# cambio pequeño (un carácter tecleado, el cursor) puede no moverlo. Este
+# refresco acota cuánto tarda en llegar ese cambio.
+REFRESCO_MAX_SEG   = 5.0        # envío forzado aunque el hash no cambie
+
+# Formato de las miniaturas: el servidor anuncia los que entienden todos los
+# dashboards (image_formats) y se usa el primero de esta lista que esté entre
+# ellos. WebP ocupa bastante menos que JPEG en pantallas de texto/código; AVIF
+# comprime aún más pero cuesta varias veces más CPU (añadirlo delante si sobra).
+FORMATOS_PREFERIDOS = ('webp', 'jpeg')
+OPCIONES_FORMATO    = {'webp': {'method': 0}, 'avif': {'speed': 8}}   # modos rápidos
+
+# Miniatura para la rejilla del dashboard: viaja con cada frame; el frame
+# completo (ANCHO_IMAGEN) solo se reenvía al dashboard que abre el modal
+ANCHO_MINIATURA     = 320
+
+# Reducción de las capturas: 'pillow' (reduce() entero + BOX para el resto) o
+# 'numpy' (promedio por áreas sobre el buffer BGRA). Pillow es más rápido en las
+# mediciones de bench_frames.py; las dos dan la misma calidad a tamaño miniatura.
+ESCALADO            = 'pillow'
+
 # ── Estado ───────────────────────────────────────────────────────────────────
 sio = sio_module.Client(reconnection=True, reconnection_attempts=0)
 _cola_profesor      = queue.Queue(maxsize=2)
@@ -225,15 +287,13 @@ _cola_mensajes      = queue.Queue(maxsize=20)
 _cola_clipboard_req = queue.Queue(maxsize=1)
 _cola_clipboard_res = queue.Queue(maxsize=1)
 _en_observacion = False
+_modo_captura  = 'normal'   # 'normal' | 'lento' | 'pausa' (lo decide el servidor)
 _webrtc_loop   = None   # event loop asyncio dedicado
 _webrtc_pc     = None   # RTCPeerConnection activa
 _webrtc_prof   = None   # prof_sid del profesor conectado
 _webrtc_activo = False  # True cuando P2P establecido
 _pending_ice   = []     # ICE candidates recibidos antes del offer
 
-def _b64(jpeg: bytes) -> str:
-    return 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode()
-
 if WEBRTC_OK:
     class ScreenStreamTrack(VideoStreamTrack):
         kind = "video"
@@ -242,9 +302,14 @@ if WEBRTC_OK:
 
         def __init__(self):
             super().__init__()
-            self._sct = None
+            self._seq = 0
             self._ts  = 0
             self._t0  = None
+            _bus.suscribir('webrtc', self._TARGET_FPS)
+
+        def stop(self):
+            _bus.cancelar('webrtc')
+            super().stop()
 
         async def recv(self):
             if self._t0 is None:
@@ -264,25 +329,17 @@ if WEBRTC_OK:
 
         def _capturar(self):
             try:
-                if self._sct is None:
-                    self._sct = mss.mss()
-                mon = self._sct.monitors[1]
-                cap = self._sct.grab(mon)
-                bgra = np.frombuffer(cap.bgra, np.uint8).reshape(cap.height, cap.width, 4)
-                rgb  = bgra[:, :, [2, 1, 0]]   # BGRA → RGB
-                h, w = rgb.shape[:2]
+                frame = _bus.siguiente(self._seq, timeout=1.0)
+                if frame is None:
+                    raise RuntimeError('sin frames del bus de captura')
+                self._seq, cap = frame
                 # Cap at 1920px wide for good resolution; VP8 at 4 Mbps handles 1080p well.
-                if w > 1920:
-                    new_w, new_h = 1920, int(h * 1920 / w)
-                    img = Image.fromarray(rgb).resize((new_w, new_h), Image.BILINEAR)
-                    rgb = np.array(img)
-                return rgb
+                if cap.width > 1920:
+                    return np.asarray(_escalar_captura(cap, 1920))
+                bgra = np.frombuffer(cap.bgra, np.uint8).reshape(cap.height, cap.width, 4)
+                return bgra[:, :, [2, 1, 0]]   # BGRA → RGB
             except Exception as e:
                 print(f"  [WebRTC] Captura: {e}")
-                if self._sct:
-                    try: self._sct.close()
-                    except: pass
-                    self._sct = None
                 return np.zeros((1080, 1920, 3), dtype=np.uint8)
 
 def _asyncio_runner():
@@ -296,45 +353,550 @@ def _wrtc(coro):
     if _webrtc_loop and _webrtc_loop.is_running():
         asyncio.run_coroutine_threadsafe(coro, _webrtc_loop)
 
+class _ControlAdaptativo:
+    """Ajusta intervalo, ancho y calidad según la carga que reporta el servidor.
+
+    Sube un nivel de degradación en cuanto el servidor va saturado (retraso del
+    event loop o cola por encima del objetivo) y solo recupera un nivel tras
+    REPORTES_RECUPERAR informes holgados, para no oscilar."""
+
+    def __init__(self, niveles=NIVELES_CARGA, lag_objetivo=LAG_OBJETIVO_MS,
+                 cola_objetivo=COLA_OBJETIVO, reportes_recuperar=REPORTES_RECUPERAR):
+        self.niveles = niveles
+        self.lag_objetivo = lag_objetivo
+        self.cola_objetivo = cola_objetivo
+        self.reportes_recuperar = reportes_recuperar
+        self.nivel = 0
+        self._holgura = 0
+
+    def actualizar(self, lag_ms, cola):
+        presion = max(lag_ms / self.lag_objetivo, cola / self.cola_objetivo)
+        if presion > 1:
+            self.nivel = min(self.niveles, self.nivel + 1)
+            self._holgura = 0
+        elif presion < 0.5:
+            self._holgura += 1
+            if self._holgura >= self.reportes_recuperar:
+                self.nivel = max(0, self.nivel - 1)
+                self._holgura = 0
+        else:
+            self._holgura = 0
+
+    def _interp(self, mejor, peor):
+        return mejor + (peor - mejor) * self.nivel / self.niveles
+
+    @property
+    def intervalo(self):
+        return self._interp(INTERVALO_SEG, INTERVALO_MAX)
+
+    @property
+    def ancho(self):
+        return int(round(self._interp(ANCHO_IMAGEN, ANCHO_MIN) / 16)) * 16
+
+    @property
+    def calidad(self):
+        return int(round(self._interp(CALIDAD_JPEG, CALIDAD_MIN)))
+
+_control = _ControlAdaptativo()
+
+def _formato_disponible(formato):
+    """True si el Pillow local sabe codificar `formato` ('jpeg', 'webp', 'avif')."""
+    if formato == 'jpeg':
+        return True
+    try:
+        from PIL import features
+        return bool(features.check(formato))
+    except Exception:
+        return False
+
+class _CodificadorImagen:
+    """Codificador de frames. En JPEG el backend es intercambiable: 'turbo'
+    (libjpeg-turbo vía PyTurboJPEG, SIMD) si está disponible, 'pillow' si no;
+    con turbo los arrays y las capturas BGRA de mss se codifican sin copiarlos a
+    una PIL.Image. WebP y AVIF se codifican siempre con Pillow."""
+
+    def __init__(self, backend=None, formato='jpeg'):
+        self.backend = backend or ('turbo' if TURBO_OK else 'pillow')
+        self.formato = formato
+
+    @property
+    def _usa_turbo(self):
+        return self.backend == 'turbo' and self.formato == 'jpeg'
+
+    def imagen(self, img, calidad):
+        """Codifica una PIL.Image RGB."""
+        if self._usa_turbo:
+            return self._turbo(np.asarray(img), TJPF_RGB, calidad)
+        buf = io.BytesIO()
+        img.save(buf, format=self.formato.upper(), quality=calidad,
+                 **OPCIONES_FORMATO.get(self.formato, {}))
+        return buf.getvalue()
+
+    def array(self, arr, calidad):
+        """Codifica un ndarray (alto, ancho, 3) RGB o (alto, ancho, 4) BGRA.
+        Admite recortes (vistas) de un array mayor."""
+        bgra = arr.shape[2] == 4
+        if self._usa_turbo:
+            return self._turbo(arr, TJPF_BGRA if bgra else TJPF_RGB, calidad)
+        return self.imagen(Image.fromarray(arr[:, :, 2::-1] if bgra else arr), calidad)
+
+    def bgra(self, captura, calidad):
+        """Codifica una captura mss (buffer BGRA) a tamaño completo."""
+        if self._usa_turbo:
+            arr = np.frombuffer(captura.bgra, np.uint8).reshape(captura.height, captura.width, 4)
+            return self._turbo(arr, TJPF_BGRA, calidad)
+        img = Image.frombytes('RGB', captura.size, captura.bgra, 'raw', 'BGRX')
+        return self.imagen(img, calidad)
+
+    def _turbo(self, arr, formato, calidad):
+        if not arr[0].flags.c_contiguous:
+            arr = np.ascontiguousarray(arr)   # turbo exige filas contiguas (admite stride)
+        return _turbo.encode(arr, quality=calidad, pixel_format=formato,
+                             jpeg_subsample=TJSAMP_420)
+
+_jpeg = _CodificadorImagen()          # vista en vivo: siempre JPEG (latencia)
+_miniaturas = _CodificadorImagen()    # miniaturas/delta: formato negociado (image_formats)
+
+def _reducir(img, ancho):
+    """Reduce `img` a `ancho` px de ancho (nunca amplía). Primero reduce() por el
+    factor entero (promedio de bloques, muy barato) y después BOX para el resto:
+    a tamaño miniatura el resultado es equivalente a LANCZOS y varias veces más
+    rápido."""
+    if img.width <= ancho:
+        return img
+    alto = max(1, round(img.height * ancho / img.width))
+    factor = img.width // ancho
+    if factor >= 2:
+        img = img.reduce(factor)
+    if img.size != (ancho, alto):
+        img = img.resize((ancho, alto), Image.BOX)
+    return img
+
+def _promedio_areas(arr, factor):
+    """Promedio por bloques factor×factor de un ndarray (alto, ancho, canales) uint8."""
+    h, w = arr.shape[0] // factor * factor, arr.shape[1] // factor * factor
+    tipo = np.uint16 if factor <= 16 else np.uint32   # 255·factor² sin desbordar
+    filas = arr[0:h:factor, :w].astype(tipo)
+    for i in range(1, factor):
+        filas += arr[i:h:factor, :w]
+    acc = filas[:, 0:w:factor].copy()
+    for j in range(1, factor):
+        acc += filas[:, j:w:factor]
+    return (acc // (factor * factor)).astype(np.uint8)
+
+def _escalar_captura(captura, ancho, metodo=None):
+    """PIL.Image RGB de una captura mss reducida a `ancho` px (ver ESCALADO)."""
+    metodo = metodo or ESCALADO
+    factor = captura.width // ancho
+    if metodo == 'numpy' and NP_OK and factor >= 2:
+        bgra = np.frombuffer(captura.bgra, np.uint8).reshape(captura.height, captura.width, 4)
+        img = Image.fromarray(np.ascontiguousarray(_promedio_areas(bgra, factor)[:, :, 2::-1]))
+    else:
+        img = Image.frombytes('RGB', captura.size, captura.bgra, 'raw', 'BGRX')
+    return _reducir(img, ancho)
+
+class _CodificadorDelta:
+    """Codificación delta por bloques de las capturas del alumno.
+
+    Divide cada frame en bloques de TAM_BLOQUE px, los compara con el último
+    frame enviado (diff vectorizado con NumPy) y devuelve solo las franjas de
+    bloques que han cambiado. Cada KEYFRAME_SEG, o si cambia demasiada pantalla,
+    se envía un keyframe completo. `kf` identifica el keyframe vigente para que
+    el servidor descarte deltas que no casan con su imagen base."""
+
+    def __init__(self, tam=TAM_BLOQUE, keyframe_seg=KEYFRAME_SEG, max_fraccion=MAX_FRACCION_DELTA):
+        self.tam = tam
+        self.keyframe_seg = keyframe_seg
+        self.max_fraccion = max_fraccion
+        self.kf = 0
+        self._prev = None      # ndarray (alto, ancho, 3) del último frame enviado
+        self._t_key = 0.0
+
+    def forzar_keyframe(self):
+        self._prev = None
+
+    def bloques_cambiados(self, prev, actual):
+        """Matriz booleana (filas, columnas) de bloques con algún píxel distinto."""
+        t = self.tam
+        diff = (prev != actual).any(axis=2)
+        h, w = diff.shape
+        fil, col = -(-h // t), -(-w // t)
+        if (fil * t, col * t) != (h, w):
+            diff = np.pad(diff, ((0, fil * t - h), (0, col * t - w)))
+        return diff.reshape(fil, t, col, t).any(axis=(1, 3))
+
+    def rectangulos(self, mascara, ancho, alto):
+        """Agrupa bloques contiguos de cada fila en franjas (x, y, w, h) en píxeles."""
+        t = self.tam
+        rects = []
+        for f, fila in enumerate(mascara):
+            c = 0
+            n = len(fila)
+            while c < n:
+                if not fila[c]:
+                    c += 1; continue
+                ini = c
+                while c < n and fila[c]:
+                    c += 1
+                x, y = ini * t, f * t
+                rects.append((x, y, min(c * t, ancho) - x, min(t, alto - y)))
+        return rects
+
+    def codificar(self, img, calidad, now=None):
+        """Devuelve ('key', jpeg) o ('delta', [(x, y, jpeg), ...])."""
+        now = time.monotonic() if now is None else now
+        actual = np.asarray(img)
+        prev, self._prev = self._prev, actual
+        if prev is None or prev.shape != actual.shape or now - self._t_key >= self.keyframe_seg:
+            return self._keyframe(img, calidad, now)
+        mascara = self.bloques_cambiados(prev, actual)
+        if mascara.mean() > self.max_fraccion:
+            return self._keyframe(img, calidad, now)
+        return 'delta', [(x, y, _miniaturas.array(actual[y:y + h, x:x + w], calidad))
+                         for x, y, w, h in self.rectangulos(mascara, img.width, img.height)]
+
+    def _keyframe(self, img, calidad, now):
+        self.kf += 1
+        self._t_key = now
+        return 'key', _miniaturas.imagen(img, calidad)
+
+_delta = _CodificadorDelta() if (NP_OK and DELTA_ACTIVO) else None
+
+class _DetectorCambios:
+    """Hash perceptual barato para no codificar pantallas que no cambian.
+
+    Muestrea la captura BGRA cruda (1 de cada 4 píxeles por eje), promedia la
+    luminancia en una rejilla de REJILLA_HASH celdas y la cuantiza a 64 niveles.
+    La distancia entre dos hashes es el número de celdas distintas. Sin NumPy
+    se usa un CRC32 del buffer (solo detecta frames idénticos)."""
+
+    def __init__(self, umbral=UMBRAL_HASH, rejilla=REJILLA_HASH, refresco_max=REFRESCO_MAX_SEG):
+        self.umbral = umbral
+        self.rejilla = rejilla
+        self.refresco_max = refresco_max
+        self._ultimo = None
+        self._dims = None
+        self._t_envio = 0.0
+
+    def reiniciar(self):
+        self._ultimo = None
+
+    def calcular(self, captura):
+        if not NP_OK:
+            return zlib.crc32(captura.bgra)
+        lum = np.frombuffer(captura.bgra, np.uint8).reshape(
+            captura.height, captura.width, 4)[::4, ::4, :3].sum(axis=2, dtype=np.uint32)
+        alto, ancho = lum.shape
+        filas = np.linspace(0, alto, min(self.rejilla[1], alto), endpoint=False).astype(np.intp)
+        cols  = np.linspace(0, ancho, min(self.rejilla[0], ancho), endpoint=False).astype(np.intp)
+        sumas = np.add.reduceat(np.add.reduceat(lum, filas, axis=0), cols, axis=1)
+        n = np.outer(np.diff(np.append(filas, alto)), np.diff(np.append(cols, ancho)))
+        return (sumas // n // 12).astype(np.uint8)   # 0..765 → 64 niveles
+
+    def distancia(self, a, b):
+        if not NP_OK:
+            return 0 if a == b else 1
+        return int(np.count_nonzero(a != b))
+
+    def cambio(self, captura, now=None):
+        """True si la captura difiere de la última enviada (y la registra como tal)."""
+        now = time.monotonic() if now is None else now
+        h, dims = self.calcular(captura), (captura.width, captura.height)
+        if (self._ultimo is not None and dims == self._dims
+                and now - self._t_envio < self.refresco_max
+                and self.distancia(h, self._ultimo) <= self.umbral):
+            return False
+        self._ultimo, self._dims, self._t_envio = h, dims, now
+        return True
+
+_detector = _DetectorCambios()
+
+def _codificar_captura(img, calidad):
+    """Codifica la captura: keyframe/delta si hay NumPy, JPEG completo si no.
+    Devuelve la lista de mensajes (evento, datos) a emitir."""
+    fmt = _miniaturas.formato
+    thumb = _miniaturas.imagen(_reducir(img, ANCHO_MINIATURA), calidad)
+    if _delta is None:
+        return [('screenshot', {'image': _miniaturas.imagen(img, calidad), 'fmt': fmt,
+                                'thumb': thumb})]   # adjuntos binarios
+    tipo, datos = _delta.codificar(img, calidad)
+    if tipo == 'key':
+        return [('screenshot', {'image': datos, 'kf': _delta.kf, 'fmt': fmt, 'thumb': thumb})]
+    return [('screenshot_delta', {
+        'kf': _delta.kf, 'fmt': fmt, 'thumb': thumb,
+        'tiles': [{'x': x, 'y': y, 'image': jpeg} for x, y, jpeg in datos],
+    })]
+
+# ── Pipeline captura → codificación → envío ───────────────────────────────────
+# Tres hilos unidos por buzones "el último gana": si una etapa va retrasada, el
+# frame pendiente se sustituye por el nuevo en lugar de encolarse. Así un socket
+# lento no frena la captura y una codificación lenta no retrasa el envío.
+MAX_PENDIENTE_DELTA = 2 * 1024 * 1024   # bytes de bloques sin enviar antes de pedir keyframe
+ESTADISTICAS_SEG    = 10.0              # periodo de envío de pipeline_stats al servidor
+
+class _Buzon:
+    """Buzón con una ranura por tipo de frame. Un frame nuevo sustituye al
+    pendiente del mismo tipo (que cuenta como descartado), salvo que el tipo
+    tenga una función `combinar(pendiente, nuevo)` propia."""
+
+    def __init__(self, combinar=None):
+        self._cond = threading.Condition()
+        self._items = {}
+        self._combinar = combinar or {}
+        self.descartados = 0
+
+    def poner(self, tipo, item):
+        with self._cond:
+            if tipo in self._items:
+                fn = self._combinar.get(tipo)
+                if fn:
+                    item = fn(self._items[tipo], item)
+                else:
+                    self.descartados += 1
+            self._items[tipo] = item
+            self._cond.notify()
+
+    def sacar(self, timeout=None):
+        """Devuelve (tipo, item) del más antiguo pendiente, o None si vence el timeout."""
+        with self._cond:
+            while not self._items:
+                if not self._cond.wait(timeout):
+                    return None
+            tipo = next(iter(self._items))
+            return tipo, self._items.pop(tipo)
+
+    def vaciar(self):
+        with self._cond:
+            self._items.clear()
+
+def _combinar_capturas(pendiente, nuevo):
+    """Combina mensajes de miniatura sin perder bloques delta: un keyframe lo
+    sustituye todo, un heartbeat no pisa un frame real y los deltas se acumulan
+    (pintados en orden dan la misma imagen) con la miniatura más reciente."""
+    if nuevo[0][0] == 'heartbeat':
+        return pendiente
+    if nuevo[0][0] == 'screenshot' or pendiente[-1][0] == 'heartbeat':
+        return nuevo
+    if pendiente[-1][0] == 'screenshot_delta':
+        ultimo = pendiente[-1][1]
+        combinado = dict(nuevo[0][1], tiles=ultimo['tiles'] + nuevo[0][1]['tiles'])
+        pendiente = pendiente[:-1] + [('screenshot_delta', combinado)]
+    else:
+        pendiente = pendiente + nuevo
+    if _delta and sum(len(t['image']) for ev, d in pendiente if ev == 'screenshot_delta'
+                      for t in d['tiles']) > MAX_PENDIENTE_DELTA:
+        _delta.forzar_keyframe()   # el socket no da abasto: mejor un keyframe que arrastrar bloques
+    return pendiente
+
+class _EstadisticasPipeline:
+    """Tiempo medio por etapa (media móvil exponencial, en ms)."""
+
+    def __init__(self, alfa=0.2):
+        self.alfa = alfa
+        self._ms = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, etapa, segundos):
+        ms = segundos * 1000
+        with self._lock:
+            prev = self._ms.get(etapa)
+            self._ms[etapa] = ms if prev is None else prev + self.alfa * (ms - prev)
+
+    def resumen(self):
+        with self._lock:
+            res = {etapa: round(ms, 1) for etapa, ms in self._ms.items()}
+        res['descartados'] = _buzon_codif.descartados + _buzon_envio.descartados
+        return res
+
+_buzon_codif = _Buzon()
+_buzon_envio = _Buzon(combinar={'captura': _combinar_capturas})
+_estadisticas = _EstadisticasPipeline()
+
+# ── Fuente de captura única ───────────────────────────────────────────────────
+# Un solo hilo con una sola instancia de mss captura la pantalla y publica el
+# último frame con un número de secuencia. Miniaturas, vista en vivo JPEG y
+# WebRTC lo leen cada uno a su ritmo: si coinciden, comparten el mismo frame en
+# lugar de hacer dos o tres grabs del mismo escritorio.
+FPS_VIVO = 20   # ritmo del fallback JPEG en vivo (sin WebRTC)
+
+class _BusFrames:
+    """Último frame capturado, compartido entre consumidores. La captura
+    continua va al ritmo del suscriptor más exigente; sin suscriptores solo se
+    captura cuando alguien pide un frame (miniaturas cada pocos segundos)."""
+
+    def __init__(self, capturar=None):
+        self._cond = threading.Condition()
+        self._subs = {}          # nombre → fps deseados
+        self._pedido = False
+        self._frame = None
+        self._seq = 0
+        self._t = 0.0            # time.monotonic() del último frame
+        self._dims = None        # (ancho, alto) del monitor
+        self._sct = None
+        self._capturar = capturar or self._grab
+
+    def suscribir(self, nombre, fps):
+        with self._cond:
+            if self._subs.get(nombre) != fps:
+                self._subs[nombre] = fps
+                self._cond.notify_all()
+
+    def cancelar(self, nombre):
+        with self._cond:
+            self._subs.pop(nombre, None)
+
+    @property
+    def fps(self):
+        with self._cond:
+            return max(self._subs.values(), default=0)
+
+    def siguiente(self, seq, timeout=1.0):
+        """Espera un frame más nuevo que `seq`. Devuelve (seq, captura) o None."""
+        with self._cond:
+            if self._seq <= seq and not self._subs:
+                self._pedido = True   # nadie captura de forma continua: pedir uno
+                self._cond.notify_all()
+            if not self._cond.wait_for(lambda: self._seq > seq, timeout):
+                return None
+            return self._seq, self._frame
+
+    def reciente(self, max_edad, timeout=1.0):
+        """Último frame si tiene menos de `max_edad` segundos; si no, uno nuevo."""
+        with self._cond:
+            if self._frame is not None and time.monotonic() - self._t <= max_edad:
+                return self._seq, self._frame
+            seq = self._seq
+        return self.siguiente(seq, timeout)
+
+    def dimensiones(self, timeout=1.0):
+        """(ancho, alto) del monitor capturado, o None si aún no se puede capturar."""
+        if self._dims is None:
+            self.siguiente(self._seq, timeout)
+        return self._dims
+
+    def _grab(self):
+        if self._sct is None:
+            self._sct = mss.mss()
+        monitor = self._sct.monitors[1]
+        self._dims = (monitor['width'], monitor['height'])
+        return self._sct.grab(monitor)
+
+    def bucle(self):
+        proxima = 0.0
+        while True:
+            with self._cond:
+                while True:
+                    fps = max(self._subs.values(), default=0)
+                    espera = proxima - time.monotonic()
+                    if self._pedido or (fps and espera <= 0):
+                        break
+                    self._cond.wait(espera if fps else None)
+                self._pedido = False
+            inicio = time.monotonic()
+            t0 = time.perf_counter()
+            try:
+                captura = self._capturar()
+            except Exception:
+                if self._sct:
+                    try: self._sct.close()
+                    except: pass
+                    self._sct = None
+                time.sleep(1); continue
+            _estadisticas.registrar('captura', time.perf_counter() - t0)
+            with self._cond:
+                if self._dims is None:
+                    self._dims = (captura.width, captura.height)
+                self._frame = captura
+                self._seq += 1
+                self._t = time.monotonic()
+                self._cond.notify_all()
+            proxima = inicio + 1.0 / fps if fps else 0.0
+
+_bus = _BusFrames()
+
 def bucle_capturas():
+    """Etapa 1: toma frames del bus de captura y los deja en el buzón de codificación."""
     _ultimo_screenshot = 0.0
-    sct = None
+    _ultimas_estadisticas = time.monotonic()
+    seq_vivo = 0
     while True:
         if not sio.connected:
+            _bus.cancelar('vivo')
             time.sleep(0.5); continue
-        if sct is None:
-            try: sct = mss.mss()
-            except: time.sleep(2); continue
-        
+
         now = time.monotonic()
+        intervalo = _control.intervalo * (FACTOR_LENTO if _modo_captura == 'lento' else 1)
+        if (now - _ultimo_screenshot) >= intervalo:
+            if _modo_captura == 'pausa':
+                _buzon_envio.poner('captura', [('heartbeat', {})])
+            else:
+                # Si la vista en vivo o WebRTC ya están capturando, se reutiliza su frame
+                frame = _bus.reciente(1.0 / FPS_VIVO)
+                if frame:
+                    _buzon_codif.poner('captura', (frame[1], now))
+            _ultimo_screenshot = now
+
+        if now - _ultimas_estadisticas >= ESTADISTICAS_SEG:
+            _buzon_envio.poner('stats', [('pipeline_stats', _estadisticas.resumen())])
+            _ultimas_estadisticas = now
+
+        if _en_observacion and not _webrtc_activo:
+            _bus.suscribir('vivo', FPS_VIVO)
+            frame = _bus.siguiente(seq_vivo, timeout=0.5)
+            if frame:
+                seq_vivo, captura = frame
+                _buzon_codif.poner('vivo', (captura, captura.width, captura.height))
+        else:
+            _bus.cancelar('vivo')
+            time.sleep(0.2)
+
+def _bucle_codificacion():
+    """Etapa 2: redimensiona y codifica; deja los mensajes en el buzón de envío."""
+    while True:
+        tipo, item = _buzon_codif.sacar()
+        t0 = time.perf_counter()
         try:
-            monitor = sct.monitors[1]
-            orig_w, orig_h = monitor['width'], monitor['height']
-            
-            if (now - _ultimo_screenshot) >= INTERVALO_SEG:
-                captura = sct.grab(monitor)
-                img = Image.frombytes('RGB', captura.size, captura.bgra, 'raw', 'BGRX')
-                if img.width > ANCHO_IMAGEN:
-                    img = img.resize((ANCHO_IMAGEN, int(img.height * ANCHO_IMAGEN / img.width)), Image.LANCZOS)
-                buf = io.BytesIO(); img.save(buf, format='JPEG', quality=CALIDAD_JPEG)
-                sio.emit('screenshot', {'image': _b64(buf.getvalue())})
-                _ultimo_screenshot = now
-            
-            if _en_observacion and not _webrtc_activo:
-                captura = sct.grab(monitor)
-                img = Image.frombytes('RGB', captura.size, captura.bgra, 'raw', 'BGRX')
+            if tipo == 'captura':
+                captura, now = item
+                if _detector.cambio(captura, now):
+                    img = _escalar_captura(captura, _control.ancho)
+                    msgs = _codificar_captura(img, _control.calidad)
+                else:
+                    msgs = [('heartbeat', {})]   # sin cambios: solo mantener last_seen
+                _buzon_envio.poner('captura', msgs)
+            elif tipo == 'vivo':
+                captura, orig_w, orig_h = item
                 ancho_r = min(orig_w, 1280)
-                if img.width > ancho_r:
-                    img = img.resize((ancho_r, int(img.height * ancho_r / img.width)), Image.BILINEAR)
-                buf = io.BytesIO(); img.save(buf, format='JPEG', quality=70)
-                sio.emit('remote_frame', {'image': _b64(buf.getvalue()), 'orig_w': orig_w, 'orig_h': orig_h})
-                time.sleep(0.05)   # ~20 fps JPEG fallback
-            else:
-                time.sleep(0.2)
-        except:
-            try: sct.close()
-            except: pass
-            sct = None; time.sleep(1)
+                if captura.width > ancho_r:
+                    jpeg = _jpeg.imagen(_escalar_captura(captura, ancho_r), 70)
+                else:
+                    jpeg = _jpeg.bgra(captura, 70)   # sin escalar: directo desde BGRA
+                _buzon_envio.poner('vivo', [('remote_frame', {
+                    'image': jpeg, 'orig_w': orig_w, 'orig_h': orig_h})])
+        except Exception as e:
+            print(f"  [!] Codificación ({tipo}): {e}")
+        _estadisticas.registrar(f'codificacion_{tipo}', time.perf_counter() - t0)
+
+def _bucle_envio():
+    """Etapa 3: emite por Socket.IO los mensajes ya codificados."""
+    while True:
+        tipo, msgs = _buzon_envio.sacar()
+        if not sio.connected:
+            continue
+        t0 = time.perf_counter()
+        try:
+            for evento, datos in msgs:
+                sio.emit(evento, datos)
+        except Exception:
+            pass
+        _estadisticas.registrar(f'envio_{tipo}', time.perf_counter() - t0)
+
+def _iniciar_pipeline():
+    for fn, nombre in ((_bus.bucle, 'vigia-bus-captura'),
+                       (bucle_capturas, 'vigia-captura'),
+                       (_bucle_codificacion, 'vigia-codificacion'),
+                       (_bucle_envio, 'vigia-envio')):
+        threading.Thread(target=fn, daemon=True, name=nombre).start()
 
 # ── Manejo de entrada ─────────────────────────────────────────────────────────
 
@@ -467,28 +1029,278 @@ def on_do_input(data):
         try: _input_q.put(data, timeout=0.05)
         except queue.Full: pass
 
+# ── Pantalla del profesor por multicast ───────────────────────────────────────
+# Con VIGIA_MULTICAST en el servidor, cada frame del profesor se envía una sola
+# vez a un grupo multicast, troceado en datagramas con la cabecera (magia,
+# sesión, nº de frame, índice de fragmento, nº de fragmentos, tipo). Por
+# Socket.IO solo llega el anuncio del grupo. Los parches solo valen sobre el
+# frame anterior: si se pierde alguno (o un frame se queda a medias), se pide un
+# keyframe por Socket.IO (teacher_keyframe). Si en SILENCIO_MULTICAST s no llega
+# ningún datagrama (la red bloquea el multicast: IGMP snooping, Wi-Fi...), el
+# alumno deja el grupo y pide la sesión por Socket.IO (teacher_keyframe {fallback}).
+CABECERA_MULTICAST = struct.Struct('!2sHIHHB')
+MAGIA_MULTICAST    = b'VP'
+TIPOS_MULTICAST    = ('key', 'parche')
+ESPERA_FRAGMENTOS  = 0.3    # s que se espera a los fragmentos de un frame
+ESPERA_KEYFRAME    = 1.0    # s mínimos entre peticiones de keyframe
+SILENCIO_MULTICAST = 12.0   # s sin datagramas (más que KEEPALIVE_PROFESOR del servidor)
+
+def _desempaquetar_parches(datos):
+    """Inversa de _empaquetar_parches del servidor: [{'x', 'y', 'image'}]."""
+    tiles, pos = [], 0
+    while pos + 8 <= len(datos):
+        x, y, n = struct.unpack_from('!HHI', datos, pos)
+        tiles.append({'x': x, 'y': y, 'image': datos[pos + 8:pos + 8 + n]})
+        pos += 8 + n
+    return tiles
+
+class _ReceptorMulticast:
+    """Hilo que recibe los fragmentos del grupo multicast, recompone los frames
+    de la sesión anunciada y los entrega en orden con `entregar(mensaje)`, con
+    mensajes como los de teacher_screen ({'activa', 'image'} o {'activa', 'tiles'}).
+    Si el grupo enmudece, llama una vez a `sin_grupo(sesion)` y se detiene.
+    cubrir() llega desde el hilo de Socket.IO: el estado va protegido por un lock."""
+
+    def __init__(self, grupo, puerto, sesion, entregar, pedir_keyframe, sin_grupo=None,
+                 interfaz='0.0.0.0'):
+        self.grupo, self.puerto, self.sesion = grupo, puerto, sesion
+        self.interfaz = interfaz
+        self._entregar = entregar
+        self._pedir_keyframe = pedir_keyframe
+        self._sin_grupo = sin_grupo
+        self.ultimo = 0          # último frame entregado (o cubierto por un keyframe)
+        self.roto = True         # sin imagen base: se ignoran parches hasta un keyframe
+        self._parciales = {}     # frame → [nº fragmentos, {índice: datos}, t_primero, tipo]
+        self._t_peticion = 0.0
+        self._t_inicio = self._t_dato = time.monotonic()
+        self._lock = threading.Lock()
+        self._activo = False
+        self._sock = None
+
+    def iniciar(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        s.bind(('', self.puerto))
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                     socket.inet_aton(self.grupo) + socket.inet_aton(self.interfaz))
+        s.settimeout(0.1)
+        self._sock, self._activo = s, True
+        self._t_inicio = self._t_dato = time.monotonic()
+        threading.Thread(target=self._bucle, daemon=True, name='vigia-multicast').start()
+
+    def detener(self):
+        self._activo = False
+
+    def cubrir(self, frame):
+        """Un keyframe por Socket.IO ya muestra `frame`: se descartan los anteriores."""
+        with self._lock:
+            self._cubrir(frame)
+
+    def _cubrir(self, frame):
+        self.ultimo = max(self.ultimo, frame)
+        self.roto = False
+        for f in [f for f in self._parciales if f <= self.ultimo]:
+            del self._parciales[f]
+
+    def _bucle(self):
+        try:
+            while self._activo:
+                try:
+                    self.recibir(self._sock.recv(65536))
+                except socket.timeout:
+                    pass
+                except OSError:
+                    break
+                except Exception as e:   # un datagrama raro no debe matar el hilo
+                    print(f"[!] Error recibiendo multicast: {e}")
+                self.revisar()
+        finally:
+            self._sock.close()
+
+    def recibir(self, datagrama):
+        """Procesa un datagrama; devuelve el mensaje entregado si cierra un frame."""
+        if len(datagrama) < CABECERA_MULTICAST.size:
+            return None
+        magia, sesion, frame, idx, total, tipo = CABECERA_MULTICAST.unpack_from(datagrama)
+        if magia != MAGIA_MULTICAST or sesion != self.sesion:
+            return None
+        with self._lock:
+            self._t_dato = time.monotonic()
+            if frame <= self.ultimo or idx >= total or tipo >= len(TIPOS_MULTICAST):
+                return None
+            p = self._parciales.setdefault(frame, [total, {}, self._t_dato, TIPOS_MULTICAST[tipo]])
+            p[1][idx] = datagrama[CABECERA_MULTICAST.size:]
+            if len(p[1]) < p[0]:
+                return None
+            datos = b''.join(p[1][i] for i in range(p[0]))
+            if p[3] == 'key':
+                self._cubrir(frame)
+                mensaje = {'activa': True, 'image': datos}
+            else:
+                seguido = frame == self.ultimo + 1 and not self.roto
+                del self._parciales[frame]
+                if not seguido:
+                    self.roto = True   # falta un parche intermedio: revisar() pide keyframe
+                    return None
+                self._cubrir(frame)
+                mensaje = {'activa': True, 'tiles': _desempaquetar_parches(datos)}
+        self._entregar(mensaje)
+        return mensaje
+
+    def revisar(self, ahora=None):
+        """Pide un keyframe si hay un frame incompleto caducado, si se perdió un
+        parche o si no ha llegado ningún keyframe desde que empezó la sesión.
+        Si lleva SILENCIO_MULTICAST s sin llegar nada, el grupo no llega a este
+        equipo: se avisa con sin_grupo() y el receptor se detiene."""
+        ahora = ahora or time.monotonic()
+        if ahora - self._t_dato > SILENCIO_MULTICAST:
+            self._activo = False
+            sin_grupo, self._sin_grupo = self._sin_grupo, None
+            if sin_grupo:
+                sin_grupo(self.sesion)
+            return
+        with self._lock:
+            caducados = [f for f, p in self._parciales.items() if ahora - p[2] > ESPERA_FRAGMENTOS]
+            for f in caducados:
+                del self._parciales[f]
+            roto = self.roto and (self.ultimo or ahora - self._t_inicio > ESPERA_KEYFRAME)
+        if (caducados or roto) and ahora - self._t_peticion > ESPERA_KEYFRAME:
+            self._t_peticion = ahora
+            self._pedir_keyframe(self.sesion)
+
+_multicast = {'receptor': None, 'fallback': None}   # fallback: sesión que llega por Socket.IO
+_profesor = {'base': False, 't_peticion': 0.0}   # ¿hay keyframe sobre el que pintar parches? (sin multicast)
+_lock_profesor = threading.Lock()
+
+def _combinar_profesor(pendiente, nuevo):
+    """Un keyframe o un apagado sustituyen a lo pendiente; los parches se
+    acumulan encima (descartar uno dejaría la imagen corrupta)."""
+    if nuevo.get('image') is not None or not nuevo.get('activa') or not pendiente.get('activa'):
+        return nuevo
+    return dict(pendiente, tiles=pendiente.get('tiles', []) + nuevo.get('tiles', []))
+
+def _encolar_profesor(data):
+    """Encola un mensaje para la ventana del profesor; si la interfaz va
+    retrasada, combina lo pendiente en un solo mensaje."""
+    with _lock_profesor:
+        try:
+            _cola_profesor.put_nowait(data); return
+        except queue.Full:
+            pass
+        pendiente = None
+        while True:
+            try: d = _cola_profesor.get_nowait()
+            except queue.Empty: break
+            pendiente = d if pendiente is None else _combinar_profesor(pendiente, d)
+        try: _cola_profesor.put_nowait(_combinar_profesor(pendiente, data) if pendiente else data)
+        except queue.Full: pass
+
+def _sin_multicast(sesion):
+    """El grupo no llega a este equipo: el resto de la sesión, por Socket.IO."""
+    print("[!] No llega el multicast del profesor; se recibe por Socket.IO")
+    _multicast['fallback'] = sesion
+    sio.emit('teacher_keyframe', {'sesion': sesion, 'fallback': True})
+
+def _seguir_multicast(anuncio):
+    """Une el cliente al grupo anunciado (o lo deja con None)."""
+    if anuncio and anuncio.get('sesion') == _multicast['fallback']:
+        return None   # esta sesión ya llega por Socket.IO
+    r = _multicast['receptor']
+    if r and anuncio and (r.grupo, r.puerto, r.sesion) == (anuncio['grupo'], anuncio['puerto'], anuncio['sesion']):
+        return r
+    if r:
+        r.detener()
+    _multicast['receptor'] = None
+    if anuncio:
+        r = _ReceptorMulticast(anuncio['grupo'], int(anuncio['puerto']), int(anuncio['sesion']),
+                               _encolar_profesor,
+                               lambda sesion: sio.emit('teacher_keyframe', {'sesion': sesion}),
+                               _sin_multicast)
+        try:
+            r.iniciar()
+            _multicast['receptor'] = r
+        except OSError as e:
+            print(f"[!] No se pudo unir al grupo multicast {anuncio['grupo']}: {e}")
+            _sin_multicast(anuncio['sesion'])
+    return _multicast['receptor']
+
+def _id_cliente():
+    """Id aleatorio de este usuario y equipo, creado la primera vez. El servidor
+    separa con él el historial de alumnos que se llaman igual (equipos clonados)."""
+    ruta = os.path.expanduser('~/.local/share/vigia/id')
+    try:
+        with open(ruta) as f:
+            id_ = f.read().strip()
+        if id_:
+            return id_
+    except OSError:
+        pass
+    id_ = os.urandom(8).hex()
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        with open(ruta, 'w') as f:
+            f.write(id_)
+    except OSError:
+        pass   # sin HOME escribible: id nuevo en cada arranque
+    return id_
+
 # ── Eventos Socket.IO ─────────────────────────────────────────────────────────
 @sio.event
 def connect():
-    print(f"[✓] Conectado al servidor.")
-    sio.emit('register', {'name': f"{os.environ.get('USER','alumno')} - {socket.gethostname()}"})
+    global _modo_captura
+    print("[✓] Conectado al servidor.")
+    _modo_captura = 'normal'
+    _miniaturas.formato = 'jpeg'   # hasta que el servidor anuncie image_formats
+    _buzon_codif.vaciar(); _buzon_envio.vaciar()
+    _detector.reiniciar()
+    if _delta: _delta.forzar_keyframe()   # el servidor no tiene imagen base tras reconectar
+    _profesor['base'] = False   # ni este cliente la del profesor: la pedirá con el primer parche
+    _multicast['fallback'] = None
+    _seguir_multicast(None)   # la sesión multicast se anuncia de nuevo si sigue activa
+    sio.emit('register', {'name': f"{os.environ.get('USER','alumno')} - {socket.gethostname()}",
+                          'id': _id_cliente()})
+
+@sio.on('server_load')
+def on_server_load(data):
+    _control.actualizar(float(data.get('lag_ms', 0)), int(data.get('cola', 0)))
+
+@sio.on('capture_mode')
+def on_capture_mode(data):
+    global _modo_captura
+    modo = data.get('modo', 'normal')
+    if modo in ('normal', 'lento', 'pausa'):
+        _modo_captura = modo
+
+@sio.on('image_formats')
+def on_image_formats(data):
+    """Formatos que entienden todos los dashboards: se elige el preferido."""
+    admitidos = data.get('formatos') or ['jpeg']
+    formato = next((f for f in FORMATOS_PREFERIDOS
+                    if f in admitidos and _formato_disponible(f)), 'jpeg')
+    if formato != _miniaturas.formato:
+        print(f"[*] Formato de miniaturas: {formato}")
+        _miniaturas.formato = formato
+        on_request_keyframe()   # reenviar la pantalla entera en el nuevo formato
+
+@sio.on('request_keyframe')
+def on_request_keyframe(_data=None):
+    _detector.reiniciar()
+    if _delta: _delta.forzar_keyframe()
 
 @sio.on('viewer_start')
 def on_viewer_start(data):
     global _en_observacion; _en_observacion = True
-    print(f"[*] El profesor está observando/controlando.")
+    print("[*] El profesor está observando/controlando.")
     # Enviar resolución real de pantalla para que el profesor mapee coordenadas correctamente
-    try:
-        with mss.mss() as _sct:
-            _mon = _sct.monitors[1]
-            sio.emit('screen_info', {'w': _mon['width'], 'h': _mon['height']})
-    except Exception:
-        pass
+    dims = _bus.dimensiones()
+    if dims:
+        sio.emit('screen_info', {'w': dims[0], 'h': dims[1]})
 
 @sio.on('viewer_stop')
 def on_viewer_stop(_data):
     global _en_observacion; _en_observacion = False
-    print(f"[*] Fin de observación.")
+    print("[*] Fin de observación.")
     if WEBRTC_OK:
         _wrtc(_cerrar_webrtc())
 
@@ -510,11 +1322,21 @@ def on_unlock_screen(_data): _cola_bloqueo.put_nowait(False)
 
 @sio.on('teacher_screen')
 def on_teacher_screen(data):
-    try:
-        _cola_profesor.put_nowait(data)
-    except queue.Full:
-        try: _cola_profesor.get_nowait(); _cola_profesor.put_nowait(data)
-        except: pass
+    """Frame del profesor, o anuncio del grupo multicast por el que llegarán."""
+    if not data.get('activa'):
+        _multicast['fallback'] = None
+    r = _seguir_multicast(data.get('multicast') if data.get('activa') else None)
+    if r and data.get('frame'):
+        r.cubrir(int(data['frame']))
+    if data.get('tiles') and not _profesor['base']:
+        ahora = time.monotonic()   # parches sin imagen base (conectado a mitad)
+        if ahora - _profesor['t_peticion'] > ESPERA_KEYFRAME:
+            _profesor['t_peticion'] = ahora
+            sio.emit('teacher_keyframe', {})
+        return
+    _profesor['base'] = data.get('image') is not None or (_profesor['base'] and data.get('activa'))
+    if data.get('image') is not None or data.get('tiles') or not data.get('activa'):
+        _encolar_profesor(data)
 
 @sio.on('exec_command')
 def on_exec_command(data):
@@ -676,6 +1498,7 @@ if WEBRTC_OK:
 
     async def _cerrar_webrtc():
         global _webrtc_pc, _webrtc_activo, _webrtc_prof
+        _bus.cancelar('webrtc')
         if _webrtc_pc: await _webrtc_pc.close()
         _webrtc_pc = None; _webrtc_activo = False; _webrtc_prof = None
 
@@ -687,7 +1510,8 @@ class _VentanaProfesor:
         self._label = tk.Label(self.top, bg='#0f1117', text="⏳ Esperando imagen…", fg='#718096', font=('Segoe UI', 12))
         self._label.pack(expand=True, fill='both')
         self._foto = None
-        self._img_raw = None   # PIL Image original sin redimensionar
+        self._img_raw = None   # frame original (bytes JPEG) sin decodificar
+        self._base = None      # frame decodificado, solo tras recibir parches
         self._after_id = None  # ID del after de redibujado pendiente
         self.top.protocol("WM_DELETE_WINDOW", self.destruir)
         self.top.bind('<Configure>', self._on_resize)
@@ -703,15 +1527,33 @@ class _VentanaProfesor:
         try:
             w = max(self.top.winfo_width(), 1)
             h = max(self.top.winfo_height(), 1)
-            img = self._img_raw.copy()
+            # Decodificar en cada render permite a thumbnail() usar el modo draft
+            # del JPEG (escala DCT 1/2, 1/4, 1/8) antes de filtrar; con parches
+            # se parte de la imagen ya compuesta
+            img = self._base.copy() if self._base is not None else Image.open(io.BytesIO(self._img_raw))
             img.thumbnail((w, h), Image.LANCZOS)
             self._foto = ImageTk.PhotoImage(img)
             self._label.config(image=self._foto, text='')
         except: pass
 
-    def actualizar(self, b64):
+    def actualizar(self, imagen):
+        """Muestra un frame del profesor: bytes JPEG o data-URI (servidores antiguos)."""
+        try:
+            if isinstance(imagen, str):
+                imagen = base64.b64decode(imagen.split(',', 1)[1])
+            self._img_raw = imagen
+            self._base = None
+            self._render()
+        except: pass
+
+    def parchear(self, tiles):
+        """Pinta sobre el último frame las regiones que han cambiado."""
+        if self._img_raw is None: return
         try:
-            self._img_raw = Image.open(io.BytesIO(base64.b64decode(b64.split(',', 1)[1])))
+            if self._base is None:
+                self._base = Image.open(io.BytesIO(self._img_raw)).convert('RGB')
+            for t in tiles:
+                self._base.paste(Image.open(io.BytesIO(t['image'])), (t['x'], t['y']))
             self._render()
         except: pass
 
@@ -794,7 +1636,8 @@ def ejecutar_interfaz():
                 d = _cola_profesor.get_nowait()
                 if d.get('activa'):
                     if not v_prof: v_prof = _VentanaProfesor(root)
-                    v_prof.actualizar(d.get('image'))
+                    if d.get('image') is not None: v_prof.actualizar(d['image'])
+                    if d.get('tiles'): v_prof.parchear(d['tiles'])
                 elif v_prof: v_prof.destruir(); v_prof = None
             while not _cola_bloqueo.empty():
                 if _cola_bloqueo.get_nowait():
@@ -842,7 +1685,7 @@ if __name__ == '__main__':
                 print(f"[VIGIA] Sin conexión con {ip}:5000, reintentando en 5 s… ({e})")
                 time.sleep(5)
     threading.Thread(target=lambda: _conectar(ip), daemon=True).start()
-    threading.Thread(target=bucle_capturas, daemon=True).start()
+    _iniciar_pipeline()
     if TK_OK: ejecutar_interfaz()
     else: 
         try: 
@@ -9,18 +9,28 @@ import os
 import sys
 import io
 import re
+import mmap
 import time
 import base64
+import bisect
+import hashlib
+import struct
+import itertools
+import importlib.util
+import json
 import threading
 import subprocess
 import webbrowser
 
 async_mode = 'eventlet'
 
+import queue
 import socket
+from collections import OrderedDict, deque
 from datetime import datetime
 from flask import Flask, render_template, jsonify, request, make_response
 from flask_socketio import SocketIO, emit, join_room
+from eventlet import tpool
 
 print(f"[*] Iniciando servidor VIGIA (modo: {async_mode})")
 
@@ -36,14 +46,388 @@ socketio = SocketIO(
     ping_interval=10,
 )
 
-# Almacén de alumnos: {sid: {name, ip, screenshot, last_seen, connected_at}}
+# Memoria que retienen los frames de los alumnos: los de _almacen (keyframes,
+# miniaturas e historial, una vez por contenido distinto) más los bloques delta
+# y cachés propios de cada alumno. Al pasar de LIMITE_MEMORIA se desalojan los
+# frames completos de los alumnos cuya pantalla lleva más tiempo sin cambiar
+# (ver _limitar_memoria).
+_memoria = {'total': 0, 'desalojos': 0}
+LIMITE_MEMORIA = int(os.environ.get('VIGIA_MEMORIA_MB', '256')) * 1024 * 1024
+
+# Historial de capturas por alumno: un anillo en memoria con los últimos
+# HISTORIAL_RING frames y un archivo en disco (_Archivo) que se conserva
+# RETENCION_HORAS (0: sin archivo en disco). Para acotar el disco se archiva como
+# mucho un frame de cada tipo por alumno cada HISTORIAL_INTERVALO segundos:
+# miniaturas a menudo, frames completos de vez en cuando.
+HISTORIAL_RING      = 60
+HISTORIAL_INTERVALO = {'thumb': 2.0, 'key': 60.0}
+HISTORIAL_DIR       = os.environ.get('VIGIA_HISTORIAL',
+                                     os.path.expanduser('~/.local/share/vigia/historial'))
+RETENCION_HORAS     = float(os.environ.get('VIGIA_RETENCION_HORAS', '2'))
+TAM_SEGMENTO        = 64 * 1024 * 1024   # bytes por fichero de segmento
+DURACION_SEGMENTO   = 15 * 60            # s antes de rotar a un segmento nuevo
+
+# Referencia para pasar instantes de time.monotonic() a hora local
+_RELOJ = (time.time(), time.monotonic())
+
+
+def _hora(t):
+    """'HH:MM:SS' del instante monotónico `t` (solo al enviarlo o mostrarlo)."""
+    return datetime.fromtimestamp(_RELOJ[0] + t - _RELOJ[1]).strftime('%H:%M:%S')
+
+
+class _AlmacenFrames:
+    """Frames direccionados por contenido, con contador de referencias.
+
+    Cuando toda la clase está en la misma diapositiva o pantalla de inicio,
+    sus keyframes y miniaturas son idénticos: se guardan una sola vez y los
+    alumnos comparten el mismo objeto bytes. Cada frame se cuenta en
+    _memoria['total'] al entrar y se descuenta al soltar su última referencia."""
+
+    def __init__(self):
+        self.frames = {}   # hash → [datos, referencias]
+
+    @staticmethod
+    def hash(datos):
+        return hashlib.blake2b(datos, digest_size=16).hexdigest()
+
+    def adquirir(self, datos):
+        """Añade una referencia a `datos`; devuelve (hash, copia compartida)."""
+        h = self.hash(datos)
+        e = self.frames.get(h)
+        if e is None:
+            e = self.frames[h] = [datos, 0]
+            _memoria['total'] += len(datos)
+        e[1] += 1
+        return h, e[0]
+
+    def soltar(self, h):
+        e = self.frames.get(h)
+        if e is None:
+            return
+        e[1] -= 1
+        if e[1] <= 0:
+            del self.frames[h]
+            _memoria['total'] -= len(e[0])
+
+
+_almacen = _AlmacenFrames()
+
+
+class Student:
+    """Registro de un alumno conectado.
+
+    key        último keyframe (bytes crudos) recibido del alumno
+    tiles      bloques delta [(x, y, jpeg)] recibidos después de `key`
+    screenshot frame completo compuesto (caché; None si hay bloques sin aplicar)
+    thumb      miniatura para la rejilla del dashboard (None: cliente antiguo sin miniaturas)
+    formato    formato de imagen elegido por el alumno ('jpeg', 'webp', 'avif')
+    seq        número de secuencia global del último frame recibido (ETag, cursores)
+    t_visto / t_conexion
+               instantes monotónicos; last_seen / connected_at los formatean
+    clave      identificador del historial del alumno en el archivo (único entre
+               los conectados; ver _clave_historial)
+    historial  anillo de frames recientes [(t, id, tipo, hash, datos)] (ver _archivar)
+    t_archivo  {tipo: time.time() del último frame archivado de ese tipo}
+    h_key / h_thumb
+               hash de `key` / `thumb` en _almacen (se fijan con fijar())
+    bytes      memoria propia de sus frames (bloques y caché de composición);
+               key, thumb e historial se cuentan en _almacen
+    """
+    __slots__ = ('name', 'ip', 'clave', 'key', 'kf', 'tiles', 'screenshot', 'thumb', 'formato',
+                 'seq', 't_visto', 't_conexion', 'locked', 'modo', 'pipeline',
+                 'historial', 't_archivo', 'h_key', 'h_thumb', 'bytes', 't_peticion')
+
+    def __init__(self, name, ip, clave=None):
+        self.name, self.ip = name, ip
+        self.clave = clave or name
+        self.key = self.kf = self.screenshot = self.thumb = self.pipeline = None
+        self.h_key = self.h_thumb = None
+        self.tiles = []
+        self.historial = deque(maxlen=HISTORIAL_RING)
+        self.t_archivo = {}
+        self.formato = 'jpeg'
+        self.seq = self.bytes = 0
+        self.t_peticion = 0.0   # último request_keyframe (ver _pedir_keyframe)
+        self.t_visto = self.t_conexion = time.monotonic()
+        self.locked = False
+        self.modo = 'normal'
+
+    @property
+    def last_seen(self):
+        return _hora(self.t_visto)
+
+    @property
+    def connected_at(self):
+        return _hora(self.t_conexion)
+
+    def fijar(self, campo, datos):
+        """Sustituye `key` o `thumb` por `datos` (None: lo suelta), compartido
+        por contenido en _almacen."""
+        _almacen.soltar(getattr(self, 'h_' + campo))
+        h, datos = _almacen.adquirir(datos) if datos is not None else (None, None)
+        setattr(self, 'h_' + campo, h)
+        setattr(self, campo, datos)
+
+    def ref(self, campo):
+        """(hash, datos) de `key` o `thumb` para la bandeja; None si no hay."""
+        datos = getattr(self, campo)
+        return None if datos is None else (getattr(self, 'h_' + campo), datos)
+
+    def contabilizar(self):
+        """Recalcula la memoria propia (bloques y caché) y ajusta el total."""
+        n = sum(len(j) for _, _, j in self.tiles)
+        if self.screenshot is not None and self.screenshot is not self.key:
+            n += len(self.screenshot)
+        _memoria['total'] += n - self.bytes
+        self.bytes = n
+
+    def desalojar(self):
+        """Suelta el frame completo y el anillo de historial (lo archivado en
+        disco sigue disponible) y conserva la miniatura. El siguiente delta del
+        alumno no tendrá base y provocará un request_keyframe."""
+        self.fijar('key', None)
+        self.kf = self.screenshot = None
+        self.tiles = []
+        for entrada in self.historial:
+            _almacen.soltar(entrada[3])
+        self.historial.clear()
+        self.contabilizar()
+
+    def liberar(self):
+        """Suelta todos sus frames (el alumno se ha desconectado)."""
+        self.desalojar()
+        self.fijar('thumb', None)
+
+
+# Alumnos conectados: {sid: Student}
 students = {}
 
+# Secuencia global de frames (todos los alumnos) y época del proceso: juntas
+# identifican un frame de forma única aunque el servidor se reinicie.
+_seq_frames = itertools.count(1)
+_EPOCA = format(int(time.time()), 'x')
+
 # Sesiones activas de vista/control: {student_sid: {prof_sid, mode}}
 viewers: dict = {}
 
-# Estado de compartir pantalla del profesor
-_teacher_capture = {'running': False, 'sid': None, 'sids': None}
+# Dashboards conectados y qué tarjetas tienen en pantalla:
+#   {prof_sid: None (aún sin informe: todo visible) | {'oculta': bool, 'sids': set}}
+dashboards: dict = {}
+
+# Bandeja de salida de frames por dashboard ("el último gana"):
+#   {prof_sid: {'pendiente': {student_sid: {'thumb', 'image', 'tiles'}},
+#               'detalle': sid del alumno abierto en el modal (recibe el frame completo),
+#               'sync': sids cuya imagen falta por enviar tras request_students,
+#               'conocidos': hashes de imágenes que el dashboard tiene en caché (LRU),
+#               'en_vuelo': lote enviado sin batch_ack, 't_envio': monotonic,
+#               'atrasados': frames encolados desde el último update_batch}}
+# Cada TICK_LOTES se envía lo pendiente en un único update_batch a los dashboards
+# que hayan confirmado el lote anterior. Entretanto, los frames nuevos de cada
+# alumno sustituyen (o se acumulan sobre) el pendiente en vez de encolarse.
+bandejas: dict = {}
+TICK_LOTES  = 0.25   # s entre lotes update_batch
+ACK_TIMEOUT = 5.0    # s sin batch_ack tras los que el lote se da por perdido
+ESPERA_KEYFRAME = 1.0   # s mínimos entre dos request_keyframe al mismo alumno
+PAGINA_SYNC = 12     # imágenes de la sincronización inicial por lote
+CACHE_IMAGENES = 64  # imágenes por hash que recuerda cada dashboard (ver _referenciar)
+_lotes = {'activo': False}
+
+# Dashboards en modo mosaico: el servidor compone las miniaturas en una sola
+# imagen con la disposición de su rejilla y solo recodifica las celdas sucias.
+# Componer y codificar va en un hilo del sistema (_fuera_del_loop).
+#   {prof_sid: {'rects': {sid: (x, y, w, h)}, 'tam': (w, h), 'columnas': n,
+#               'celda': (w, h), 'lienzo': PIL.Image (None: enviar el mosaico
+#               entero), 'sucias': set}}
+mosaicos: dict = {}
+MOSAICO_FRACCION_PARCHES = 0.5   # más celdas sucias que esta fracción en un tick → mosaico entero
+MOSAICO_MAX_CELDAS  = 256
+CALIDAD_MOSAICO     = 70
+FONDO_MOSAICO       = (10, 12, 20)   # #0a0c14, el fondo de .card-screen
+
+# Formatos de imagen que sabe decodificar cada dashboard: {prof_sid: set}
+formatos_dashboards: dict = {}
+FORMATOS_IMAGEN = ('avif', 'webp', 'jpeg')   # de más a menos compacto
+_formatos_anunciados = None                  # última lista enviada a los alumnos (image_formats)
+
+# Estado de compartir pantalla del profesor. Cada inicio abre una generación
+# nueva ('gen'); los bucles de captura llevan la suya y salen en cuanto deja de
+# ser la actual (_captura_vigente), sin esperar a que el manejador los pare.
+_teacher_capture = {'running': False, 'gen': 0, 'sid': None, 'sids': None, 'cambios': None}
+CACHE_VENTANAS = 2.0   # s que se reutiliza la lista de ventanas del selector (_VentanasX)
+
+# Iconos de las ventanas del selector (_IndiceIconos): índice de los .desktop
+# guardado en CACHE_ICONOS y data URIs ya codificados en memoria.
+DIRS_APLICACIONES = (
+    '/usr/share/applications',
+    os.path.expanduser('~/.local/share/applications'),
+    '/usr/local/share/applications',
+    '/var/lib/snapd/desktop/applications',
+    '/var/lib/flatpak/exports/share/applications',
+)
+CACHE_ICONOS    = os.environ.get('VIGIA_CACHE_ICONOS', os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'vigia', 'iconos.json'))
+MAX_ICONOS      = 128    # data URIs de iconos en el LRU
+REVISION_ICONOS = 30.0   # s mínimos entre comprobaciones del mtime de DIRS_APLICACIONES
+
+# Pantalla del profesor por multicast UDP (opcional): VIGIA_MULTICAST=grupo[:puerto].
+# Cada frame sale una sola vez hacia el grupo, troceado en datagramas de
+# FRAGMENTO_MULTICAST bytes, en lugar de una copia por alumno por Socket.IO. Por
+# Socket.IO solo va el anuncio del grupo (repetido cada ANUNCIO_MULTICAST s para
+# los que se conectan tarde) y los keyframes que piden los alumnos que pierden
+# fragmentos (teacher_keyframe). Los alumnos a los que no les llega el grupo
+# (multicast bloqueado en la red) lo dicen con teacher_keyframe {fallback} y
+# reciben la sesión por Socket.IO ('socketio'). Compartir solo con algunos
+# alumnos nunca va al grupo: cualquier equipo de la red podría unirse a él.
+MULTICAST           = os.environ.get('VIGIA_MULTICAST', '')
+PUERTO_MULTICAST    = 5008
+INTERFAZ_MULTICAST  = os.environ.get('VIGIA_MULTICAST_IF', '0.0.0.0')
+FRAGMENTO_MULTICAST = 1400   # bytes de datos por datagrama: caben en la MTU de Ethernet/Wi-Fi
+TTL_MULTICAST       = 1      # no sale de la subred del aula
+ANUNCIO_MULTICAST   = 2.0
+_multicast = {'emisor': None, 'error': False, 'activo': False, 'socketio': set()}
+
+# Captura de la pantalla del profesor: solo se envía lo que cambia. Cada captura
+# se compara con la última enviada sobre una copia reducida ESCALA_CAMBIOS veces,
+# por teselas de TESELA_PROFESOR px. Sin cambios no se envía nada (salvo un
+# keyframe de mantenimiento cada KEEPALIVE_PROFESOR s); con pocas teselas sucias
+# se envían solo esas franjas. El ritmo sube hacia FPS_MAX_PROFESOR mientras hay
+# movimiento (scroll, vídeo) y baja hacia FPS_MIN_PROFESOR en reposo.
+ANCHO_PROFESOR       = 1920
+CALIDAD_PROFESOR     = 70
+FPS_MIN_PROFESOR     = 2
+FPS_MAX_PROFESOR     = 15
+TESELA_PROFESOR      = 64
+ESCALA_CAMBIOS       = 4
+UMBRAL_CAMBIO        = 8      # diferencia por canal en la copia reducida que cuenta como cambio
+MAX_FRACCION_PARCHE  = 0.4    # si cambia más de esta fracción de teselas → keyframe
+KEEPALIVE_PROFESOR   = 10.0
+ANCHO_PREVIEW        = 480    # vista previa que ve el profesor en el dashboard
+PERIODO_PREVIEW      = 1.0
+
+# Carga del servidor, comunicada a los alumnos para que adapten su captura:
+#   lag_ms     retraso del event loop de eventlet en la última medición
+#   cola       frames de alumnos retenidos en la bandeja del dashboard más lento
+#              (ver _cola_salida)
+_carga = {'activo': False, 'lag_ms': 0.0, 'cola': 0}
+PERIODO_CARGA = 1.0   # segundos entre mediciones / avisos server_load
+
+
+def _frame_bytes(value):
+    """Normaliza un frame recibido a bytes JPEG crudos.
+
+    Los clientes actuales envían los frames como adjuntos binarios de Socket.IO
+    (bytes). Se siguen aceptando data-URIs base64 de clientes antiguos."""
+    if value is None or isinstance(value, bytes):
+        return value
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    if isinstance(value, str) and value.startswith('data:'):
+        try:
+            return base64.b64decode(value.split(',', 1)[1])
+        except Exception:
+            return None
+    return None
+
+
+# Codificador JPEG: libjpeg-turbo (PyTurboJPEG + NumPy, opcionales) si está
+# instalado, Pillow si no. None = sin comprobar todavía, False = no disponible.
+_turbo = None
+
+
+def _turbojpeg():
+    global _turbo
+    if _turbo is None:
+        try:
+            from turbojpeg import TurboJPEG   # sin NumPy ya falla al importarse
+            _turbo = TurboJPEG()
+        except Exception:
+            _turbo = False
+    return _turbo
+
+
+def _codificar_jpeg(img, calidad):
+    """Codifica una PIL.Image RGB a JPEG (bytes)."""
+    tj = _turbojpeg()
+    if tj:
+        import numpy as np
+        from turbojpeg import TJPF_RGB, TJSAMP_420
+        return tj.encode(np.asarray(img), quality=calidad, pixel_format=TJPF_RGB,
+                         jpeg_subsample=TJSAMP_420)
+    buf = io.BytesIO()
+    img.save(buf, 'JPEG', quality=calidad)
+    return buf.getvalue()
+
+
+def _codificar_jpeg_bgra(cap, calidad):
+    """Codifica una captura mss (buffer BGRA). Con turbo no se crea PIL.Image."""
+    tj = _turbojpeg()
+    if tj:
+        import numpy as np
+        from turbojpeg import TJPF_BGRA, TJSAMP_420
+        arr = np.frombuffer(cap.bgra, np.uint8).reshape(cap.height, cap.width, 4)
+        return tj.encode(arr, quality=calidad, pixel_format=TJPF_BGRA,
+                         jpeg_subsample=TJSAMP_420)
+    from PIL import Image
+    img = Image.frombytes('RGB', (cap.width, cap.height), cap.bgra, 'raw', 'BGRX')
+    return _codificar_jpeg(img, calidad)
+
+
+def _reducir(img, ancho):
+    """Reduce una PIL.Image a `ancho` px de ancho (nunca amplía): reduce() por el
+    factor entero y BOX para el resto, en lugar de LANCZOS sobre el frame completo."""
+    from PIL import Image
+    if img.width <= ancho:
+        return img
+    alto = max(1, round(img.height * ancho / img.width))
+    factor = img.width // ancho
+    if factor >= 2:
+        img = img.reduce(factor)
+    if img.size != (ancho, alto):
+        img = img.resize((ancho, alto), Image.BOX)
+    return img
+
+
+def _componer_frame(key, tiles):
+    """JPEG del keyframe `key` con los bloques delta `tiles` pegados encima."""
+    from PIL import Image
+    base = Image.open(io.BytesIO(key)).convert('RGB')
+    for x, y, jpeg in tiles:
+        base.paste(Image.open(io.BytesIO(jpeg)), (x, y))
+    return _codificar_jpeg(base, 85)
+
+
+def _frame_completo(st):
+    """Devuelve el frame actual del alumno como una sola imagen (para la API
+    HTTP), componiendo los bloques delta sobre el último keyframe en un hilo
+    del sistema. El resultado se cachea en `screenshot` pero nunca sustituye
+    al keyframe: recodificar la base en cada compactación acumularía pérdidas.
+    Los dashboards reciben keyframe + bloques y los componen ellos; cuando los
+    bloques pesan más que el keyframe se le pide uno nuevo al alumno."""
+    if st.screenshot is not None or st.key is None:
+        return st.screenshot
+    if not st.tiles:
+        st.screenshot = st.key
+        return st.screenshot
+    key, tiles = st.key, list(st.tiles)
+    try:
+        datos = _fuera_del_loop(_componer_frame, key, tiles)
+    except Exception as e:
+        print(f"[!] Error componiendo frame delta: {e}")
+        return key
+    if st.key is key and len(st.tiles) == len(tiles):   # no ha cambiado mientras tanto
+        st.screenshot = datos
+        st.contabilizar()
+    return datos
+
+
+def _pedir_keyframe(sid, st):
+    """request_keyframe al alumno, como mucho uno cada ESPERA_KEYFRAME s."""
+    ahora = time.monotonic()
+    if ahora - st.t_peticion < ESPERA_KEYFRAME:
+        return
+    st.t_peticion = ahora
+    socketio.emit('request_keyframe', {}, to=sid)
 
 
 def get_local_ip():
@@ -58,6 +442,298 @@ def get_local_ip():
         s.close()
 
 
+def _cola_salida():
+    """Frames que esperan a un dashboard que aún no ha confirmado su último
+    lote, en el dashboard más atrasado. Con los dashboards al día es 0 aunque la
+    clase entera envíe a buen ritmo: los frames salen en el siguiente tick."""
+    return max((b['atrasados'] for b in bandejas.values() if b['en_vuelo']), default=0)
+
+
+def _monitor_carga():
+    """Mide el retraso del event loop y la cola de salida hacia los dashboards,
+    y los difunde a los alumnos (sala 'students') para que ajusten intervalo,
+    ancho y calidad."""
+    while True:
+        t0 = time.monotonic()
+        socketio.sleep(PERIODO_CARGA)
+        lag = max(0.0, time.monotonic() - t0 - PERIODO_CARGA)
+        _carga['lag_ms'] = round(lag * 1000, 1)
+        _carga['cola'] = _cola_salida()
+        if students:
+            socketio.emit('server_load', {'lag_ms': _carga['lag_ms'], 'cola': _carga['cola']},
+                          to='students')
+
+
+# ── Historial de capturas ────────────────────────────────────────────────────
+
+class _Archivo:
+    """Archivo de capturas en disco: segmentos append-only mapeados en memoria
+    (mmap) con un índice temporal por alumno.
+
+    Cada segmento es un fichero '<ms de creación>.seg' de TAM_SEGMENTO bytes,
+    reservado al crearlo, en el que los registros (cabecera + alumno + datos)
+    se escriben uno detrás de otro: archivar un frame es copiarlo a la caché de
+    páginas, sin llamadas al sistema. Se rota por tamaño o cada
+    DURACION_SEGMENTO (el segmento cerrado se recorta a lo usado) y los
+    segmentos más antiguos que la retención se borran enteros. Al arrancar, el
+    índice se reconstruye recorriendo los segmentos que haya en el directorio.
+    Un frame se identifica como '<segmento>-<offset>'.
+
+    agregar(), rango() y leer() se llaman desde el event loop y nunca tocan el
+    disco: el hilo 'vigia-historial' reserva de antemano el siguiente segmento
+    (posix_fallocate escribe bloque a bloque en NFS y similares), recorta el
+    que se cierra y borra los caducados. Si al rotar aún no hay segmento
+    reservado, el frame solo queda en el anillo en memoria. El lock protege
+    segmentos e índice, y solo se retiene para cambios en memoria."""
+
+    _CABECERA = struct.Struct('<2sdBHI')   # magia, t (epoch), tipo, len(alumno), len(datos)
+    _MAGIA = b'VG'
+    _TIPOS = ('key', 'thumb')
+
+    def __init__(self, directorio, retencion=None, tam=None, duracion=None):
+        self.dir = directorio
+        self.retencion = RETENCION_HORAS * 3600 if retencion is None else retencion
+        self.tam = tam or TAM_SEGMENTO
+        self.duracion = duracion or DURACION_SEGMENTO
+        self.segmentos = {}   # número → {'mm': mmap | None, 't_fin': epoch del último frame}
+        self.indice = {}      # alumno → ([t], [(segmento, offset, tipo)])
+        self._actual = None   # (número, t_inicio) del segmento en escritura
+        self._pos = 0
+        self._siguiente = None   # (número, mmap) reservado por el hilo de fondo
+        self._error = None       # OSError del hilo de fondo (p. ej. disco lleno)
+        self._lock = threading.Lock()
+        self._tareas = queue.Queue()
+        os.makedirs(directorio, exist_ok=True)
+        for nombre in sorted(os.listdir(directorio)):
+            if nombre.endswith('.seg') and nombre[:-4].isdigit():
+                self._cargar(int(nombre[:-4]))
+        self.expirar()
+        self._reservar()
+        threading.Thread(target=self._bucle, daemon=True, name='vigia-historial').start()
+
+    def _ruta(self, num):
+        return os.path.join(self.dir, f'{num:013d}.seg')
+
+    @staticmethod
+    def _mapear(ruta):
+        try:
+            with open(ruta, 'r+b') as f:
+                return mmap.mmap(f.fileno(), 0)
+        except ValueError:   # fichero vacío: no se puede mapear
+            return None
+
+    def _cargar(self, num):
+        """Mapea un segmento existente y añade sus registros al índice."""
+        try:
+            mm = self._mapear(self._ruta(num))
+        except OSError:
+            return
+        cab, pos, t = self._CABECERA, 0, num / 1000
+        while mm is not None and pos + cab.size <= len(mm):
+            magia, t_reg, tipo, n_alumno, n_datos = cab.unpack_from(mm, pos)
+            fin = pos + cab.size + n_alumno + n_datos
+            if magia != self._MAGIA or tipo >= len(self._TIPOS) or fin > len(mm):
+                break   # final de lo escrito (resto del segmento a cero)
+            alumno = mm[pos + cab.size:pos + cab.size + n_alumno].decode('utf-8', 'replace')
+            self._indexar(alumno, t_reg, num, pos, self._TIPOS[tipo])
+            pos, t = fin, t_reg
+        self.segmentos[num] = {'mm': mm, 't_fin': t}
+
+    def _indexar(self, alumno, t, num, pos, tipo):
+        ts, entradas = self.indice.setdefault(alumno, ([], []))
+        ts.append(max(t, ts[-1]) if ts else t)   # el reloj de pared puede retroceder
+        entradas.append((num, pos, tipo))
+
+    def agregar(self, alumno, t, tipo, datos):
+        """Añade un frame al segmento actual; devuelve su id (None si no cabe o
+        aún no hay segmento reservado)."""
+        if self._error is not None:
+            raise self._error
+        nombre = alumno.encode('utf-8')[:1024]
+        n = self._CABECERA.size + len(nombre) + len(datos)
+        if n > self.tam:
+            return None
+        with self._lock:
+            if self._actual is None or self._pos + n > self.tam or t - self._actual[1] >= self.duracion:
+                if not self._rotar(t):
+                    return None
+            num, pos = self._actual[0], self._pos
+            seg = self.segmentos[num]
+            inicio = pos + self._CABECERA.size
+            self._CABECERA.pack_into(seg['mm'], pos, self._MAGIA, t, self._TIPOS.index(tipo),
+                                     len(nombre), len(datos))
+            seg['mm'][inicio:inicio + len(nombre)] = nombre
+            seg['mm'][inicio + len(nombre):pos + n] = datos
+            seg['t_fin'] = t
+            self._pos = pos + n
+            self._indexar(alumno, t, num, pos, tipo)
+        return f'{num}-{pos}'
+
+    def _rotar(self, t):
+        """Pasa a escribir en el segmento reservado (False si aún no lo hay) y
+        deja al hilo de fondo recortar el anterior, reservar otro y expirar."""
+        if self._siguiente is None:
+            return False
+        if self._actual is not None:
+            self._tareas.put(('recortar', self._actual[0], self._pos))
+        num, mm = self._siguiente
+        self._siguiente = None
+        self.segmentos[num] = {'mm': mm, 't_fin': t}
+        self._actual, self._pos = (num, t), 0
+        self._tareas.put(('reservar',))
+        self._tareas.put(('expirar', t))
+        return True
+
+    def _bucle(self):
+        while True:
+            tarea = self._tareas.get()
+            try:
+                if tarea is None:
+                    return
+                getattr(self, '_' + tarea[0])(*tarea[1:])
+            except OSError as e:
+                print(f"[!] Error en el historial en disco: {e}")
+                self._error = e
+            finally:
+                self._tareas.task_done()
+
+    def _reservar(self):
+        """Crea y mapea (fuera del event loop) el segmento al que se rotará."""
+        if self._siguiente is not None:
+            return
+        with self._lock:
+            num = max(int(time.time() * 1000), max(self.segmentos, default=0) + 1)
+        with open(self._ruta(num), 'w+b') as f:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, self.tam)   # disco lleno: OSError aquí y no SIGBUS al escribir
+            else:
+                f.truncate(self.tam)
+            self._siguiente = (num, mmap.mmap(f.fileno(), self.tam))
+
+    def _recortar(self, num, pos):
+        """Recorta un segmento cerrado a lo escrito y lo vuelve a mapear. Mientras
+        tanto leer() no lo ve: el mapa viejo pasaría del final del fichero (SIGBUS)."""
+        with self._lock:
+            seg = self.segmentos.get(num)
+            if seg is None:
+                return
+            viejo, seg['mm'] = seg['mm'], None
+        if viejo is not None:
+            viejo.close()
+        os.truncate(self._ruta(num), pos)
+        mm = self._mapear(self._ruta(num))
+        with self._lock:
+            if num in self.segmentos:
+                self.segmentos[num]['mm'], mm = mm, None
+        if mm is not None:
+            mm.close()
+
+    def _expirar(self, ahora):
+        self.expirar(ahora)
+
+    def expirar(self, ahora=None):
+        """Borra los segmentos cuyo último frame es anterior a la retención."""
+        limite = (time.time() if ahora is None else ahora) - self.retencion
+        with self._lock:
+            actual = self._actual and self._actual[0]
+            viejos = {num for num, seg in self.segmentos.items() if seg['t_fin'] < limite and num != actual}
+            if not viejos:
+                return
+            mapas = [self.segmentos.pop(num)['mm'] for num in viejos]
+            # Los segmentos viejos son los primeros: sus entradas, un prefijo de cada índice
+            for alumno, (ts, entradas) in list(self.indice.items()):
+                k = 0
+                while k < len(entradas) and entradas[k][0] in viejos:
+                    k += 1
+                del ts[:k], entradas[:k]
+                if not ts:
+                    del self.indice[alumno]
+        for mm in mapas:
+            if mm is not None:
+                mm.close()
+        for num in viejos:
+            try:
+                os.remove(self._ruta(num))
+            except OSError:
+                pass
+
+    def esperar(self):
+        """Espera a que el hilo de fondo termine lo pendiente."""
+        self._tareas.join()
+
+    def cerrar(self):
+        self._tareas.put(None)
+
+    def rango(self, alumno, desde, hasta, limite):
+        """[(t, id, tipo)] del alumno entre `desde` y `hasta`: los `limite` más recientes."""
+        with self._lock:
+            ts, entradas = self.indice.get(alumno, ((), ()))
+            i, j = bisect.bisect_left(ts, desde), bisect.bisect_right(ts, hasta)
+            return [(ts[k], f'{entradas[k][0]}-{entradas[k][1]}', entradas[k][2])
+                    for k in range(max(i, j - limite), j)]
+
+    def leer(self, alumno, id_):
+        """Bytes del frame `id_` si existe y pertenece a `alumno` (None si no)."""
+        with self._lock:
+            try:
+                num, pos = (int(v) for v in id_.split('-'))
+                mm = self.segmentos[num]['mm']
+                if pos < 0 or mm is None:
+                    return None
+                magia, _, _, n_alumno, n_datos = self._CABECERA.unpack_from(mm, pos)
+            except (ValueError, KeyError, struct.error):
+                return None
+            inicio = pos + self._CABECERA.size
+            if magia != self._MAGIA or mm[inicio:inicio + n_alumno] != alumno.encode('utf-8')[:1024]:
+                return None
+            return mm[inicio + n_alumno:inicio + n_alumno + n_datos]
+
+
+# Archivo en disco del historial, abierto al arrancar (None: desactivado o aún
+# recorriendo los segmentos existentes; mientras, solo el anillo en memoria)
+_historial = {'archivo': None, 'iniciado': False}
+
+
+def _iniciar_historial():
+    """Abre el archivo en disco en un hilo del sistema: recorrer los segmentos
+    y reservar el primero no retrasa el arranque ni el event loop."""
+    if _historial['iniciado'] or RETENCION_HORAS <= 0:
+        return
+    _historial['iniciado'] = True
+
+    def abrir():
+        try:
+            _historial['archivo'] = _Archivo(HISTORIAL_DIR)
+        except OSError as e:
+            print(f"[!] Historial en disco desactivado: {e}")
+
+    threading.Thread(target=abrir, daemon=True, name='vigia-historial-inicio').start()
+
+
+def _archivo():
+    return _historial['archivo']
+
+
+def _archivar(st, tipo, datos):
+    """Guarda el frame en el historial del alumno (anillo en memoria + disco) si
+    ha pasado HISTORIAL_INTERVALO desde el último archivado de ese tipo."""
+    t = time.time()
+    if t - st.t_archivo.get(tipo, 0.0) < HISTORIAL_INTERVALO[tipo]:
+        return
+    st.t_archivo[tipo] = t
+    archivo, id_ = _archivo(), None
+    if archivo is not None:
+        try:
+            id_ = archivo.agregar(st.clave, t, tipo, datos)
+        except OSError as e:
+            print(f"[!] Error archivando capturas, historial en disco desactivado: {e}")
+            _historial['archivo'] = None
+    if len(st.historial) == st.historial.maxlen:
+        _almacen.soltar(st.historial[0][3])   # el append descarta la entrada más antigua
+    h, datos = _almacen.adquirir(datos)
+    st.historial.append((t, id_ or f'm{st.seq}-{tipo}', tipo, h, datos))
+
+
 # ── Rutas HTTP ──────────────────────────────────────────────────────────────
 
 @app.route('/')
@@ -103,18 +779,105 @@ def web_manifest():
 @app.route('/api/students')
 def api_students():
     result = []
-    for sid, data in students.items():
+    for sid, st in students.items():
         result.append({
             'sid': sid,
-            'name': data['name'],
-            'ip': data['ip'],
-            'last_seen': data['last_seen'],
-            'connected_at': data['connected_at'],
-            'has_screenshot': data['screenshot'] is not None,
+            'name': st.name,
+            'ip': st.ip,
+            'last_seen': st.last_seen,
+            'connected_at': st.connected_at,
+            'has_screenshot': st.key is not None,
+            'seq': st.seq,
+            'bytes': st.bytes,
+            'formato': st.formato,
+            'pipeline': st.pipeline,
         })
     return jsonify(result)
 
 
+@app.route('/api/memory')
+def api_memory():
+    """Memoria retenida en frames de alumnos frente al límite configurado."""
+    return jsonify({
+        'total': _memoria['total'],
+        'limite': LIMITE_MEMORIA,
+        'desalojos': _memoria['desalojos'],
+        'alumnos': len(students),
+        'frames_distintos': len(_almacen.frames),
+        'referencias': sum(r for _, r in _almacen.frames.values()),
+    })
+
+
+def _tipo_imagen(datos):
+    """Tipo MIME por la firma del fichero (los alumnos envían JPEG, WebP o AVIF)."""
+    if datos[:4] == b'RIFF' and datos[8:12] == b'WEBP':
+        return 'image/webp'
+    if datos[4:8] == b'ftyp' and datos[8:11] == b'avi':
+        return 'image/avif'
+    return 'image/jpeg'
+
+
+@app.route('/api/students/<sid>/screenshot')
+def api_student_screenshot(sid):
+    """Último frame del alumno (?thumb=1: la miniatura de la rejilla). El ETag
+    sale del número de secuencia del frame: si no ha cambiado, 304 sin cuerpo."""
+    st = students.get(sid)
+    if st is None or (st.key is None and st.thumb is None):
+        return jsonify({'error': 'sin captura'}), 404
+    # Sin frame completo (desalojado por memoria) se sirve la miniatura
+    miniatura = st.thumb is not None and (request.args.get('thumb') == '1' or st.key is None)
+    etag = f"{_EPOCA}-{st.seq}{'-t' if miniatura else ''}"
+    if request.if_none_match.contains(etag):
+        resp = make_response('', 304)
+    else:
+        datos = st.thumb if miniatura else _frame_completo(st)
+        resp = make_response(datos)
+        resp.headers['Content-Type'] = _tipo_imagen(datos)
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = 'no-cache'   # revalidar siempre (If-None-Match)
+    return resp
+
+
+@app.route('/api/students/<sid>/history')
+def api_student_history(sid):
+    """Frames archivados del alumno entre ?desde= y ?hasta= (epoch en segundos),
+    del más antiguo al más reciente; como mucho ?limite= (los más recientes)."""
+    st = students.get(sid)
+    if st is None:
+        return jsonify({'error': 'alumno desconocido'}), 404
+    try:
+        desde = float(request.args.get('desde', 0))
+        hasta = float(request.args.get('hasta', 'inf'))
+        limite = max(1, int(request.args.get('limite', 1000)))
+    except ValueError:
+        return jsonify({'error': 'parámetros no válidos'}), 400
+    archivo = _archivo()
+    if archivo is not None:
+        frames = archivo.rango(st.clave, desde, hasta, limite)
+    else:
+        frames = [(t, id_, tipo) for t, id_, tipo, _, _ in st.historial if desde <= t <= hasta][-limite:]
+    return jsonify([{'id': id_, 't': t, 'tipo': tipo,
+                     'hora': datetime.fromtimestamp(t).strftime('%H:%M:%S')}
+                    for t, id_, tipo in frames])
+
+
+@app.route('/api/students/<sid>/history/<frame_id>')
+def api_student_history_frame(sid, frame_id):
+    """Un frame del historial: del anillo en memoria o, si ya salió, del disco."""
+    st = students.get(sid)
+    if st is None:
+        return jsonify({'error': 'alumno desconocido'}), 404
+    datos = next((d for _, id_, _, _, d in st.historial if id_ == frame_id), None)
+    if datos is None and _archivo() is not None:
+        datos = _archivo().leer(st.clave, frame_id)
+    if datos is None:
+        return jsonify({'error': 'frame no encontrado'}), 404
+    resp = make_response(datos)
+    resp.headers['Content-Type'] = _tipo_imagen(datos)
+    resp.headers['Cache-Control'] = 'private, max-age=86400, immutable'   # un frame archivado no cambia
+    return resp
+
+
 # ── Eventos Socket.IO ────────────────────────────────────────────────────────
 
 def _get_client_ip():
@@ -129,20 +892,106 @@ def on_connect():
 
 
 @socketio.on('register_teacher')
-def on_register_teacher():
-    """Dashboard joins the 'professors' room so broadcasts target only teachers."""
+def on_register_teacher(data=None):
+    """Dashboard joins the 'professors' room so broadcasts target only teachers.
+    Announces the image formats it can decode ({'formatos': [...]})."""
     join_room('professors')
+    dashboards[request.sid] = None
+    bandejas[request.sid] = {'pendiente': {}, 'detalle': None, 'sync': [],
+                             'conocidos': OrderedDict(), 'en_vuelo': False, 't_envio': 0.0,
+                             'atrasados': 0}
+    if not _lotes['activo']:
+        _lotes['activo'] = True
+        socketio.start_background_task(_bucle_lotes)
+    formatos = (data or {}).get('formatos') if isinstance(data, dict) else None
+    formatos_dashboards[request.sid] = set(formatos or ()) | {'jpeg'}
+    _actualizar_modos()
+    _anunciar_formatos()
     print(f"[👁] Dashboard registrado en sala 'professors': {request.sid}")
 
 
+def _formatos_servidor():
+    """Formatos que el Pillow del servidor puede decodificar (para componer deltas)."""
+    try:
+        from PIL import features
+        return {f for f in FORMATOS_IMAGEN if f == 'jpeg' or features.check(f)}
+    except Exception:
+        return {'jpeg'}
+
+
+def _formatos_comunes():
+    """Formatos que entienden todos los dashboards conectados y el servidor,
+    del más al menos compacto. JPEG siempre está incluido."""
+    comunes = _formatos_servidor()
+    for fmts in formatos_dashboards.values():
+        comunes &= fmts
+    return [f for f in FORMATOS_IMAGEN if f in comunes or f == 'jpeg']
+
+
+def _anunciar_formatos(to=None):
+    """Envía a los alumnos los formatos admitidos si han cambiado (o a `to`)."""
+    global _formatos_anunciados
+    formatos = _formatos_comunes()
+    if to is not None:
+        socketio.emit('image_formats', {'formatos': formatos}, to=to)
+    elif formatos != _formatos_anunciados:
+        socketio.emit('image_formats', {'formatos': formatos}, to='students')
+        _formatos_anunciados = formatos
+
+
+def _modo_captura(sid):
+    """'normal' si algún dashboard tiene la tarjeta en pantalla, 'lento' si
+    solo está fuera de la vista (scroll/filtro) y 'pausa' si nadie mira."""
+    lento = False
+    for vis in dashboards.values():
+        if vis is None or sid in vis['sids']:
+            return 'normal'
+        if not vis['oculta']:
+            lento = True
+    return 'lento' if lento else 'pausa'
+
+
+def _actualizar_modos():
+    """Avisa a los alumnos cuyo modo de captura ha cambiado (capture_mode)."""
+    for sid, st in students.items():
+        modo = _modo_captura(sid)
+        if modo != st.modo:
+            st.modo = modo
+            socketio.emit('capture_mode', {'modo': modo}, to=sid)
+
+
+@socketio.on('visible_students')
+def on_visible_students(data):
+    """El dashboard informa de las tarjetas visibles (IntersectionObserver +
+    Page Visibility). Los alumnos que nadie ve ralentizan o pausan la captura."""
+    if request.sid not in dashboards:
+        return
+    dashboards[request.sid] = {
+        'oculta': bool(data.get('oculta', False)),
+        'sids': set(data.get('sids') or []),
+    }
+    _actualizar_modos()
+
+
 @socketio.on('disconnect')
 def on_disconnect():
+    if dashboards.pop(request.sid, False) is not False:
+        formatos_dashboards.pop(request.sid, None)
+        bandejas.pop(request.sid, None)
+        mosaicos.pop(request.sid, None)
+        _actualizar_modos()
+        _anunciar_formatos()
     if request.sid == _teacher_capture.get('sid'):
-        _teacher_capture['running'] = False
-        socketio.emit('teacher_screen', {'activa': False}, broadcast=True)
+        _parar_captura_profesor()
+        _fin_multicast()
+        socketio.emit('teacher_screen', {'activa': False})
+    _multicast['socketio'].discard(request.sid)
     if request.sid in students:
-        name = students[request.sid]['name']
-        del students[request.sid]
+        st = students.pop(request.sid)
+        name = st.name
+        st.liberar()
+        for b in bandejas.values():
+            b['pendiente'].pop(request.sid, None)
         if request.sid in viewers:
             prof_sid = viewers.pop(request.sid)['prof_sid']
             socketio.emit('student_view_ended', {'sid': request.sid}, to=prof_sid)
@@ -150,39 +999,436 @@ def on_disconnect():
         socketio.emit('student_disconnected', {'sid': request.sid}, to='professors')
 
 
+def _clave_historial(name, id_cliente):
+    """Clave del historial: el id aleatorio que guarda cada cliente (o el nombre,
+    en clientes antiguos), con un sufijo si ya la usa otro alumno conectado.
+    Con imágenes clonadas varios equipos se llaman igual, y cada uno solo
+    debe ver su propio historial."""
+    base = f'{name} [{id_cliente}]' if isinstance(id_cliente, str) and id_cliente else name
+    usadas = {st.clave for st in students.values()}
+    clave, n = base, 1
+    while clave in usadas:
+        n += 1
+        clave = f'{base} ~{n}'
+    return clave
+
+
 @socketio.on('register')
 def on_register(data):
     client_ip = _get_client_ip()
     name = data.get('name', 'Alumno')
-    now = datetime.now().strftime('%H:%M:%S')
-    students[request.sid] = {
-        'name': name, 'ip': client_ip, 'screenshot': None,
-        'last_seen': now, 'connected_at': now, 'locked': False,
-    }
+    clave = _clave_historial(name, data.get('id'))
+    st = students[request.sid] = Student(name, client_ip, clave)
+    join_room('students')
+    if not _carga['activo']:
+        _carga['activo'] = True
+        socketio.start_background_task(_monitor_carga)
     print(f"[+] Registrado: {name}  ({client_ip})")
     emit('registered', {'status': 'ok', 'sid': request.sid})
-    socketio.emit('student_connected', {'sid': request.sid, 'name': name, 'ip': client_ip, 'connected_at': now}, to='professors')
+    _actualizar_modos()
+    _anunciar_formatos(to=request.sid)
+    socketio.emit('student_connected', {'sid': request.sid, 'name': name, 'ip': client_ip, 'connected_at': st.connected_at}, to='professors')
 
 
 @socketio.on('screenshot')
 def on_screenshot(data):
     if request.sid not in students: return
-    now = datetime.now().strftime('%H:%M:%S')
-    students[request.sid]['screenshot'] = data.get('image')
-    students[request.sid]['last_seen'] = now
-    socketio.emit('update_screenshot', {'sid': request.sid, 'image': data.get('image'), 'last_seen': now}, to='professors')
+    image = _frame_bytes(data.get('image'))
+    if not image: return
+    st = students[request.sid]
+    st.fijar('key', image)
+    st.screenshot = st.key
+    st.kf = data.get('kf')
+    st.tiles = []
+    if data.get('fmt') in FORMATOS_IMAGEN:
+        st.formato = data['fmt']
+    thumb = _frame_bytes(data.get('thumb'))
+    if thumb:
+        st.fijar('thumb', thumb)
+    st.t_visto = time.monotonic()
+    st.seq = next(_seq_frames)
+    _archivar(st, 'key', st.key)
+    if thumb:
+        _archivar(st, 'thumb', st.thumb)
+    st.contabilizar()
+    _encolar_frame(request.sid, image=st.ref('key'), thumb=st.ref('thumb') if thumb else None)
+    _limitar_memoria()
+
+
+@socketio.on('screenshot_delta')
+def on_screenshot_delta(data):
+    """Bloques que han cambiado desde el último frame (ver _CodificadorDelta en client.py)."""
+    st = students.get(request.sid)
+    if st is None: return
+    if st.key is None or data.get('kf') != st.kf:
+        _pedir_keyframe(request.sid, st)   # delta sin imagen base
+        return
+    tiles = []
+    for t in data.get('tiles') or []:
+        try:
+            x, y = int(t.get('x', 0)), int(t.get('y', 0))
+        except (AttributeError, TypeError, ValueError):
+            continue   # bloque mal formado
+        jpeg = _frame_bytes(t.get('image'))
+        if jpeg:
+            tiles.append((x, y, jpeg))
+    st.t_visto = time.monotonic()
+    st.seq = next(_seq_frames)
+    if tiles:
+        st.tiles.extend(tiles)
+        st.screenshot = None
+        # Cuando los bloques pendientes pesan más que el propio keyframe, el
+        # alumno envía uno nuevo (sin recodificar en el servidor)
+        if sum(len(j) for _, _, j in st.tiles) > len(st.key):
+            _pedir_keyframe(request.sid, st)
+    thumb = _frame_bytes(data.get('thumb'))
+    if thumb:
+        st.fijar('thumb', thumb)
+        _archivar(st, 'thumb', st.thumb)
+    st.contabilizar()
+    _encolar_frame(request.sid, tiles=tiles, thumb=st.ref('thumb') if thumb else None)
+    _limitar_memoria()
+
+
+def _limitar_memoria():
+    """Si los frames retenidos superan LIMITE_MEMORIA, desaloja frames completos
+    empezando por los alumnos cuya pantalla lleva más tiempo sin cambiar (menor
+    seq). Los abiertos en algún modal van los últimos; las miniaturas se conservan.
+
+    Si las miniaturas solas ya pasan del límite no se desaloja nada: no se
+    bajaría de él y cada keyframe se soltaría nada más llegar, para volver a
+    pedirlo con el siguiente delta."""
+    if _memoria['total'] <= LIMITE_MEMORIA:
+        return
+    miniaturas = {st.h_thumb for st in students.values()} - {None}
+    if sum(len(_almacen.frames[h][0]) for h in miniaturas) >= LIMITE_MEMORIA:
+        return
+    abiertos = {b['detalle'] for b in bandejas.values()}
+    for sid, st in sorted(students.items(), key=lambda e: (e[0] in abiertos, e[1].seq)):
+        if _memoria['total'] <= LIMITE_MEMORIA:
+            break
+        if st.key is not None:
+            st.desalojar()
+            _memoria['desalojos'] += 1
+
+
+def _encolar_frame(sid, image=None, tiles=(), thumb=None):
+    """Deja el frame en la bandeja de cada dashboard (sale en el siguiente tick).
+
+    La rejilla solo recibe la miniatura; el frame completo (keyframe y bloques
+    delta) va únicamente al dashboard que tiene a este alumno abierto en el
+    modal, o a todos si el cliente no envía miniaturas. Un keyframe sustituye lo
+    pendiente; los bloques se acumulan (como mucho los del keyframe actual: al
+    pesar más que él se le pide otro al alumno, ver on_screenshot_delta).
+    `image` y `thumb` son referencias (hash, datos) de Student.ref()."""
+    st = students[sid]
+    for b in bandejas.values():
+        b['atrasados'] += 1
+        p = b['pendiente'].setdefault(sid, {'thumb': None, 'image': None, 'tiles': []})
+        if thumb:
+            p['thumb'] = thumb
+        if b['detalle'] != sid and st.thumb is not None:
+            continue
+        if image is not None:
+            p['image'], p['tiles'] = image, []
+        p['tiles'].extend(tiles)
+
+
+@socketio.on('detail_student')
+def on_detail_student(data):
+    """El dashboard abre (sid) o cierra (None) el modal de un alumno: solo ese
+    alumno le llega a resolución completa. Se le envía el frame actual."""
+    b = bandejas.get(request.sid)
+    if b is None:
+        return
+    sid = (data or {}).get('sid')
+    b['detalle'] = sid if sid in students else None
+    st = students.get(b['detalle'])
+    if st is None:
+        return
+    if st.key is None:
+        _pedir_keyframe(sid, st)   # frame desalojado por memoria
+        return
+    p = b['pendiente'].setdefault(sid, {'thumb': None, 'image': None, 'tiles': []})
+    p['image'], p['tiles'] = st.ref('key'), list(st.tiles)
+
+
+def _paginar_sync(b, pendiente, prof_sid):
+    """Añade a `pendiente` la siguiente página de la sincronización inicial
+    (o del reenvío tras image_miss): primero las tarjetas que el dashboard
+    tiene en pantalla. Se salta a los alumnos que ya llevan imagen propia en
+    este lote."""
+    vis = dashboards.get(prof_sid)
+    b['sync'].sort(key=lambda sid: vis is not None and sid not in vis['sids'])
+    pagina, b['sync'] = b['sync'][:PAGINA_SYNC], b['sync'][PAGINA_SYNC:]
+    for sid in pagina:
+        st = students.get(sid)
+        p = pendiente.get(sid)
+        if st is None or (p and (p['thumb'] or p['image'])):
+            continue
+        p = pendiente.setdefault(sid, {'thumb': None, 'image': None, 'tiles': []})
+        p['thumb'] = st.ref('thumb')
+        if st.key is not None and (st.thumb is None or b['detalle'] == sid):
+            # Cliente sin miniaturas o alumno del modal: keyframe y bloques
+            p['image'], p['tiles'] = st.ref('key'), list(st.tiles)
+
+
+def _referenciar(b, frame, campo, ref):
+    """Pone en el frame `campo`_h (hash) y, si el dashboard no tiene ya esa
+    imagen, también sus bytes en `campo`.
+
+    `conocidos` replica la caché del dashboard: un LRU de CACHE_IMAGENES hashes
+    que ambos lados actualizan igual y en el mismo orden (miniatura y luego
+    imagen de cada frame, frame a frame). Así una diapositiva que comparte toda
+    la clase solo viaja una vez por dashboard."""
+    if ref is None:
+        return
+    h, datos = ref
+    conocidos = b['conocidos']
+    if h in conocidos:
+        conocidos.move_to_end(h)
+    else:
+        frame[campo] = datos
+        conocidos[h] = None
+        if len(conocidos) > CACHE_IMAGENES:
+            conocidos.popitem(last=False)
+    frame[campo + '_h'] = h
+
+
+@socketio.on('image_miss')
+def on_image_miss(data=None):
+    """El dashboard no tenía una imagen referenciada por hash (cachés
+    desincronizadas): ambos vacían la caché y se le reenvían esos alumnos."""
+    b = bandejas.get(request.sid)
+    if b is None:
+        return
+    b['conocidos'].clear()
+    data = data if isinstance(data, dict) else {}
+    sids = data.get('sids')
+    for sid in sids if isinstance(sids, list) else []:
+        if isinstance(sid, str) and sid in students and sid not in b['sync']:
+            b['sync'].append(sid)
+
+
+def _vaciar_bandeja(prof_sid):
+    """Envía lo pendiente como un único update_batch si el dashboard ha
+    confirmado el lote anterior.
+
+    Cuando no queda sincronización inicial por enviar, el lote lleva `cursor`:
+    la mayor `seq` de los alumnos conectados. Todo frame con seq menor o igual
+    ya ha salido hacia este dashboard, así que al reconectar le basta pedir
+    los alumnos con seq posterior (request_students {desde})."""
+    b, m = bandejas.get(prof_sid), mosaicos.get(prof_sid)
+    if not b or not (b['pendiente'] or b['sync'] or (m is not None and m['lienzo'] is None)):
+        return
+    if b['en_vuelo'] and time.monotonic() - b['t_envio'] < ACK_TIMEOUT:
+        return
+    pendiente, b['pendiente'], b['atrasados'] = b['pendiente'], {}, 0
+    if b['sync']:
+        _paginar_sync(b, pendiente, prof_sid)
+    if m is not None:
+        # Las miniaturas van al mosaico; el frame completo sigue yendo al modal
+        for sid, p in pendiente.items():
+            if p['thumb'] is not None or (p['image'] is not None and b['detalle'] != sid):
+                m['sucias'].add(sid)
+                p['thumb'] = None
+                if b['detalle'] != sid:
+                    p['image'], p['tiles'] = None, []
+    frames = []
+    for sid, p in pendiente.items():
+        st = students.get(sid)
+        if st is None:
+            continue
+        frame = {'sid': sid, 'last_seen': st.last_seen}
+        _referenciar(b, frame, 'thumb', p['thumb'])
+        _referenciar(b, frame, 'image', p['image'])
+        if p['tiles']:
+            frame['tiles'] = [{'x': x, 'y': y, 'image': j} for x, y, j in p['tiles']]
+        frames.append(frame)
+    lote = {'frames': frames}
+    if not b['sync']:
+        lote['cursor'] = max((st.seq for st in students.values()), default=0)
+    # En vuelo desde ya: mientras se compone el mosaico (fuera del event loop)
+    # otro tick no debe enviar ni tocar el mismo lienzo
+    b['en_vuelo'], b['t_envio'] = True, time.monotonic()
+    if m is not None and (m['sucias'] or m['lienzo'] is None):
+        lote['mosaico'] = _componer_mosaico(m)
+    socketio.emit('update_batch', lote, to=prof_sid)
+
+
+def _celda_mosaico(datos, w, h):
+    """Miniatura (bytes) ajustada sin deformar a una celda de w×h."""
+    from PIL import Image
+    celda = Image.new('RGB', (w, h), FONDO_MOSAICO)
+    if datos is None:
+        return celda
+    try:
+        img = Image.open(io.BytesIO(datos))
+        img.draft('RGB', (w, h))   # JPEG: decodificar ya reducido
+        img = img.convert('RGB')
+    except Exception:
+        return celda
+    escala = min(w / img.width, h / img.height)
+    tam = (max(1, round(img.width * escala)), max(1, round(img.height * escala)))
+    img = _reducir(img, tam[0]) if escala < 1 else img.resize(tam, Image.BILINEAR)
+    celda.paste(img, ((w - img.width) // 2, (h - img.height) // 2))
+    return celda
+
+
+def _celda_nueva(m, sid):
+    """Añade al final de la rejilla a un alumno que el dashboard aún no ha
+    colocado (se conectó después del último mosaic_mode)."""
+    if len(m['rects']) >= MOSAICO_MAX_CELDAS:
+        return False
+    i, (w, h) = len(m['rects']), m['celda']
+    m['rects'][sid] = ((i % m['columnas']) * w, (i // m['columnas']) * h, w, h)
+    m['tam'] = (m['columnas'] * w, max(m['tam'][1], (i // m['columnas'] + 1) * h))
+    return True
+
+
+def _componer_mosaico(m):
+    """Prepara en el event loop lo que hay que pintar (datos de las celdas
+    sucias) y lo compone y codifica en un hilo del sistema con _pintar_mosaico.
+    Un alumno sin celda se añade al final y se reenvía el mosaico entero, con
+    el nuevo mapa de celdas."""
+    nuevas = [sid for sid in m['sucias'] if sid not in m['rects'] and sid in students]
+    entero = m['lienzo'] is None or len(m['sucias']) > MOSAICO_FRACCION_PARCHES * len(m['rects'])
+    for sid in sorted(nuevas):
+        entero = _celda_nueva(m, sid) or entero
+    if m['lienzo'] is None or m['lienzo'].size != m['tam']:
+        m['sucias'] = set(m['rects'])
+    trabajo = []
+    for sid in m['sucias']:
+        rect, st = m['rects'].get(sid), students.get(sid)
+        if rect is None or st is None:
+            continue
+        # Cliente sin miniaturas: el último frame completo (sin compactar sus bloques)
+        datos = st.thumb or st.screenshot or st.key
+        trabajo.append((sid, rect, st.h_thumb or sid, datos))
+    m['sucias'] = set()
+    return _fuera_del_loop(_pintar_mosaico, m, trabajo, entero)
+
+
+def _pintar_mosaico(m, trabajo, entero):
+    """Pega las celdas en el lienzo y devuelve lo que hay que enviar: el
+    mosaico entero ({image, width, height, celdas}) o solo las celdas
+    recodificadas ({sids, tiles}). Corre fuera del event loop."""
+    from PIL import Image
+    if m['lienzo'] is None or m['lienzo'].size != m['tam']:
+        m['lienzo'] = Image.new('RGB', m['tam'], FONDO_MOSAICO)
+    pintadas, celdas = [], {}   # celdas: misma miniatura (mismo hash) → una sola decodificación
+    for sid, (x, y, w, h), clave, datos in trabajo:
+        if clave not in celdas:
+            celdas[clave] = _celda_mosaico(datos, w, h)
+        m['lienzo'].paste(celdas[clave], (x, y))
+        pintadas.append(sid)
+    if entero:
+        return {'image': _codificar_jpeg(m['lienzo'], CALIDAD_MOSAICO),
+                'width': m['tam'][0], 'height': m['tam'][1],
+                'celdas': {sid: list(r) for sid, r in m['rects'].items()}}
+    return {'sids': pintadas, 'tiles': [
+        {'x': x, 'y': y, 'image': _codificar_jpeg(m['lienzo'].crop((x, y, x + w, y + h)), CALIDAD_MOSAICO)}
+        for x, y, w, h in (m['rects'][sid] for sid in pintadas)]}
+
+
+@socketio.on('mosaic_mode')
+def on_mosaic_mode(data):
+    """El dashboard activa/desactiva el modo mosaico o cambia su rejilla:
+    {activo, columnas, ancho (px por celda), orden: [sid, ...]}. Con un cambio
+    de disposición se vuelve a enviar el mosaico entero."""
+    b = bandejas.get(request.sid)
+    if b is None:
+        return
+    data = data if isinstance(data, dict) else {}
+    if not data.get('activo'):
+        if mosaicos.pop(request.sid, None) is not None:
+            # Vuelven las miniaturas por tarjeta
+            b['sync'] = [sid for sid, st in students.items() if st.thumb is not None or st.key is not None]
+        return
+    try:
+        columnas = min(max(int(data.get('columnas', 1)), 1), 32)
+        ancho = min(max(int(data.get('ancho', 320)), 64), 640)
+    except (TypeError, ValueError):
+        return
+    alto = max(1, round(ancho * 9 / 16))
+    orden = [sid for sid in data.get('orden') or [] if sid in students][:MOSAICO_MAX_CELDAS]
+    filas = max(1, -(-len(orden) // columnas))
+    mosaicos[request.sid] = {
+        'rects': {sid: ((i % columnas) * ancho, (i // columnas) * alto, ancho, alto)
+                  for i, sid in enumerate(orden)},
+        'tam': (columnas * ancho, filas * alto),
+        'columnas': columnas,
+        'celda': (ancho, alto),
+        'lienzo': None,
+        'sucias': set(),
+    }
+
+
+def _enviar_lotes():
+    for prof_sid in list(bandejas):
+        _vaciar_bandeja(prof_sid)
+
+
+def _bucle_lotes():
+    """Tick del servidor: un update_batch por dashboard cada TICK_LOTES."""
+    while True:
+        socketio.sleep(TICK_LOTES)
+        try:
+            _enviar_lotes()
+        except Exception as e:
+            print(f"[!] Error enviando lotes: {e}")
+
+
+@socketio.on('batch_ack')
+def on_batch_ack(_data=None):
+    """El dashboard ha pintado el último lote: recibirá el siguiente en el próximo tick."""
+    b = bandejas.get(request.sid)
+    if b is not None:
+        b['en_vuelo'] = False
+
+
+@socketio.on('heartbeat')
+def on_heartbeat(_data=None):
+    """El alumno sigue vivo pero su pantalla no ha cambiado (no se reenvía nada)."""
+    st = students.get(request.sid)
+    if st is not None:
+        st.t_visto = time.monotonic()
+
+
+@socketio.on('pipeline_stats')
+def on_pipeline_stats(data):
+    """Tiempos medios por etapa del pipeline de captura del alumno (ms)."""
+    st = students.get(request.sid)
+    if st is not None and isinstance(data, dict):
+        st.pipeline = data
 
 
 @socketio.on('request_students')
-def on_request_students(_data=None):
-    payload = []
-    for sid, data in students.items():
-        payload.append({
-            'sid': sid, 'name': data['name'], 'ip': data['ip'],
-            'last_seen': data['last_seen'], 'connected_at': data['connected_at'],
-            'image': data['screenshot'], 'locked': data.get('locked', False),
-        })
-    emit('full_student_list', payload)
+def on_request_students(data=None):
+    """Sincronización inicial del dashboard: primero solo los metadatos, en un
+    mensaje pequeño; las imágenes salen después por la bandeja, PAGINA_SYNC por
+    lote y las tarjetas visibles primero.
+
+    `{epoca, desde}` es el cursor del último lote que pintó el dashboard: si el
+    servidor no se ha reiniciado, solo se reenvían los alumnos con frames
+    posteriores a `desde`."""
+    data = data if isinstance(data, dict) else {}
+    desde = 0
+    if data.get('epoca') == _EPOCA:
+        try:
+            desde = int(data.get('desde') or 0)
+        except (TypeError, ValueError):
+            pass
+    alumnos = [{
+        'sid': sid, 'name': st.name, 'ip': st.ip,
+        'last_seen': st.last_seen, 'connected_at': st.connected_at,
+        'locked': st.locked,
+    } for sid, st in students.items()]
+    emit('full_student_list', {'epoca': _EPOCA, 'alumnos': alumnos})
+    b = bandejas.get(request.sid)
+    if b is not None:
+        b['sync'] = [sid for sid, st in students.items()
+                     if (st.thumb or st.key) is not None and st.seq > desde]
 
 
 @socketio.on('quit_student')
@@ -190,14 +1436,14 @@ def on_quit_student(data):
     sid = data.get('sid')
     if sid in students:
         socketio.emit('quit_app', {}, to=sid)
-        print(f"[*] Apagando equipo: {students[sid]['name']}")
+        print(f"[*] Apagando equipo: {students[sid].name}")
 
 
 @socketio.on('quit_all_students')
 def on_quit_all_students(_data):
     for sid in list(students.keys()):
         socketio.emit('quit_app', {}, to=sid)
-    print(f"[*] Apagando todos los equipos")
+    print("[*] Apagando todos los equipos")
 
 
 @socketio.on('send_message')
@@ -224,7 +1470,7 @@ def on_send_message_to(data):
         }
         socketio.emit('show_message', payload, to=sid)
         n = len(payload['attachments'])
-        print(f"[*] Mensaje enviado a {students[sid]['name']}: {payload['title']}" + (f" ({n} adjunto(s))" if n else ""))
+        print(f"[*] Mensaje enviado a {students[sid].name}: {payload['title']}" + (f" ({n} adjunto(s))" if n else ""))
 
 
 @socketio.on('lock_student')
@@ -232,13 +1478,160 @@ def on_lock_student(data):
     sid = data.get('sid')
     locked = bool(data.get('locked', True))
     if sid in students:
-        students[sid]['locked'] = locked
+        students[sid].locked = locked
         socketio.emit('lock_screen' if locked else 'unlock_screen', {}, to=sid)
         socketio.emit('student_lock_state', {'sid': sid, 'locked': locked}, to='professors')
-        print(f"[*] {students[sid]['name']} -> {'BLOQUEADO' if locked else 'desbloqueado'}")
+        print(f"[*] {students[sid].name} -> {'BLOQUEADO' if locked else 'desbloqueado'}")
+
+
+def _texto_x(valor, codificacion='utf-8'):
+    """Texto de una propiedad X11 de formato 8 (bytes en python-xlib reciente)."""
+    if isinstance(valor, (bytes, bytearray)):
+        return valor.decode(codificacion, 'replace')
+    return valor or ''
+
+
+class _VentanasX:
+    """Consultas de ventanas a X11 con una sola conexión python-xlib persistente.
+
+    Sustituye a los xprop/xdotool por ventana: las propiedades de todas las
+    ventanas se piden de una tacada (con defer, python-xlib envía cada petición
+    al crearla y solo espera al leer su respuesta), así que listar cuesta un
+    viaje de ida y vuelta al servidor X en lugar de varios procesos por ventana.
+    La lista se reutiliza CACHE_VENTANAS s. Se llama desde hilos del sistema,
+    nunca desde el event loop, con un lock porque la conexión no es thread-safe.
+    Sin python-xlib o sin DISPLAY los métodos devuelven None y se recurre a
+    xprop/xdotool."""
+
+    def __init__(self):
+        self._d = None
+        self._error = False
+        self._atomos = {}
+        self._lock = threading.Lock()
+        self._lista = (0.0, None)   # (instante, ventanas)
+
+    def _consultar(self, fn, *args):
+        with self._lock:
+            if self._d is None:
+                if self._error:
+                    return None
+                try:
+                    from Xlib import display
+                    self._d = display.Display()
+                    self._atomos = {}
+                except Exception:
+                    self._error = True
+                    return None
+            try:
+                return fn(self._d, *args)
+            except Exception as e:
+                from Xlib.error import ConnectionClosedError
+                if isinstance(e, (ConnectionClosedError, OSError)):
+                    self._d = None   # se reconecta en la siguiente consulta
+                return None
+
+    def _atomo(self, d, nombre):
+        if nombre not in self._atomos:
+            self._atomos[nombre] = d.intern_atom(nombre)
+        return self._atomos[nombre]
+
+    def listar(self):
+        """Ventanas visibles: [{wid, x, y, w, h, title, clases}] (None sin Xlib)."""
+        t, lista = self._lista
+        if lista is not None and time.monotonic() - t < CACHE_VENTANAS:
+            return lista
+        lista = self._consultar(self._listar)
+        if lista is not None:
+            self._lista = (time.monotonic(), lista)
+        return lista
+
+    def _listar(self, d):
+        from Xlib import X
+        from Xlib.protocol import request
+        root = d.screen().root
+        clientes = root.get_full_property(self._atomo(d, '_NET_CLIENT_LIST'), X.AnyPropertyType)
+        if clientes is None:
+            return []
+        oculta = self._atomo(d, '_NET_WM_STATE_HIDDEN')
+
+        def prop(w, nombre):
+            return request.GetProperty(display=d.display, defer=True, delete=False, window=w,
+                                       property=self._atomo(d, nombre), type=X.AnyPropertyType,
+                                       long_offset=0, long_length=1024)
+
+        pedidas = [(w, prop(w, '_NET_WM_STATE'), prop(w, '_NET_WM_NAME'), prop(w, 'WM_NAME'),
+                    prop(w, 'WM_CLASS'),
+                    request.GetGeometry(display=d.display, defer=True, drawable=w),
+                    request.TranslateCoords(display=d.display, defer=True, src_wid=w,
+                                            dst_wid=root.id, src_x=0, src_y=0))
+                   for w in clientes.value]
+        d.flush()
+
+        def valor(r):
+            r.reply()
+            return r.value[1] if r.property_type and r.value else None
+
+        ventanas = []
+        for w, estado, nombre, nombre_x, clase, geom, pos in pedidas:
+            try:
+                if oculta in (valor(estado) or ()):
+                    continue
+                titulo = _texto_x(valor(nombre)) or _texto_x(valor(nombre_x), 'latin-1')
+                geom.reply(); pos.reply()
+            except Exception:
+                continue   # la ventana se cerró entre medias (BadWindow)
+            if not titulo or 'VIGIA' in titulo or geom.width < 100 or geom.height < 100:
+                continue
+            try:
+                clases = [c for c in _texto_x(valor(clase), 'latin-1').split('\0') if c]
+            except Exception:
+                clases = []
+            ventanas.append({'wid': hex(w), 'x': pos.x, 'y': pos.y, 'w': geom.width,
+                             'h': geom.height, 'title': titulo, 'clases': clases})
+        return ventanas
+
+    def region(self, wid):
+        """Región de pantalla actual de la ventana, en el formato de mss."""
+        def consulta(d):
+            w = d.create_resource_object('window', int(wid, 16))
+            g = w.get_geometry()
+            pos = d.screen().root.translate_coords(w, 0, 0)
+            return {'left': pos.x, 'top': pos.y, 'width': g.width, 'height': g.height}
+        return self._consultar(consulta)
+
+    def miniatura(self, wid, max_w=192):
+        """Miniatura JPEG del contenido de la ventana (X GetImage). Con un
+        compositor (KWin, Mutter) es el contenido real aunque esté tapada."""
+        def consulta(d):
+            from Xlib import X
+            w = d.create_resource_object('window', int(wid, 16))
+            g = w.get_geometry()
+            if g.width < 1 or g.height < 1:
+                return None
+            return g.width, g.height, w.get_image(0, 0, g.width, g.height, X.ZPixmap, 0xffffffff).data
+        res = self._consultar(consulta)
+        if not res:
+            return None
+        try:
+            from PIL import Image
+            w, h, datos = res
+            # ZPixmap con profundidad 24/32: datos en formato BGRA (little-endian)
+            img = Image.frombytes('RGB', (w, h), datos, 'raw', 'BGRX')
+            return _codificar_jpeg(_reducir(img, max_w), 60)
+        except Exception:
+            return None
+
+
+_ventanas_x = _VentanasX()
 
 
 def _get_window_list():
+    """Ventanas visibles: con python-xlib si está disponible, si no con xprop/xdotool."""
+    ventanas = _ventanas_x.listar()
+    return ventanas if ventanas is not None else _get_window_list_xprop()
+
+
+def _get_window_list_xprop():
     """Devuelve ventanas visibles usando xprop (_NET_CLIENT_LIST + _NET_WM_NAME)."""
     try:
         r = subprocess.run(['xprop', '-root', '-notype', '_NET_CLIENT_LIST'],
@@ -284,7 +1677,10 @@ def _get_window_list():
 
 
 def _get_window_region(wid):
-    """Devuelve la región actual de una ventana vía xdotool."""
+    """Devuelve la región actual de una ventana (python-xlib o xdotool)."""
+    region = _ventanas_x.region(wid)
+    if region is not None:
+        return region
     try:
         gr = subprocess.run(['xdotool', 'getwindowgeometry', '--shell', wid],
                             capture_output=True, text=True, timeout=2)
@@ -297,124 +1693,459 @@ def _get_window_region(wid):
     return None
 
 
-def _teacher_capture_loop():
-    """Captura la pantalla del profesor con mss y emite los frames por Socket.IO."""
-    try:
+class _EmisorMulticast:
+    """Envía los frames del profesor al grupo multicast, troceados en datagramas
+    con la cabecera (magia, sesión, nº de frame, índice de fragmento, nº de
+    fragmentos, tipo). Los parches van empaquetados con _empaquetar_parches y
+    solo valen sobre el frame anterior. Cada vez que se empieza a compartir se
+    abre una sesión nueva para que los alumnos descarten los fragmentos de la
+    anterior."""
+
+    CABECERA = struct.Struct('!2sHIHHB')
+    MAGIA = b'VP'
+    TIPOS = ('key', 'parche')
+
+    def __init__(self, grupo, puerto=PUERTO_MULTICAST, interfaz=INTERFAZ_MULTICAST):
+        self.destino = (grupo, puerto)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, TTL_MULTICAST)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if interfaz != '0.0.0.0':
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interfaz))
+        self.sesion = int.from_bytes(os.urandom(2), 'big')   # distinta tras reiniciar el servidor
+        self.frame = 0
+        self.ultimo = None
+        self.t_anuncio = 0.0
+
+    def nueva_sesion(self):
+        self.sesion = (self.sesion + 1) & 0xFFFF
+        self.frame = 0
+        self.ultimo = None
+        self.t_anuncio = 0.0
+
+    def anuncio(self):
+        return {'grupo': self.destino[0], 'puerto': self.destino[1], 'sesion': self.sesion}
+
+    def enviar(self, datos, tipo='key'):
+        """Envía un frame; devuelve el número de datagramas."""
+        self.frame += 1
+        self.ultimo = datos if tipo == 'key' else None   # un parche deja viejo el último keyframe
+        trozos = range(0, len(datos), FRAGMENTO_MULTICAST) or [0]
+        for i, ini in enumerate(trozos):
+            cab = self.CABECERA.pack(self.MAGIA, self.sesion, self.frame, i, len(trozos),
+                                     self.TIPOS.index(tipo))
+            self.sock.sendto(cab + datos[ini:ini + FRAGMENTO_MULTICAST], self.destino)
+        return len(trozos)
+
+
+def _emisor_multicast():
+    """Emisor de VIGIA_MULTICAST, creado al primer uso (None si no se usa o falla)."""
+    if _multicast['emisor'] is None and MULTICAST and not _multicast['error']:
+        grupo, _, puerto = MULTICAST.partition(':')
+        try:
+            _multicast['emisor'] = _EmisorMulticast(grupo, int(puerto or PUERTO_MULTICAST))
+            print(f"[📺] Pantalla del profesor por multicast: {grupo}:{puerto or PUERTO_MULTICAST}")
+        except (OSError, ValueError) as e:
+            _multicast['error'] = True
+            print(f"[!] Multicast no disponible ({e}); se usa Socket.IO")
+    return _multicast['emisor']
+
+
+def _fin_multicast():
+    """Cierra la sesión multicast al dejar de compartir."""
+    _multicast['activo'] = False
+    _multicast['socketio'].clear()
+    if _multicast['emisor'] is not None:
+        _multicast['emisor'].nueva_sesion()
+
+
+def _empaquetar_parches(tiles):
+    """Parches [(x, y, jpeg)] en un solo bloque de bytes para el multicast."""
+    return b''.join(struct.pack('!HHI', x, y, len(jpeg)) + jpeg for x, y, jpeg in tiles)
+
+
+def _difundir_profesor(tipo, datos, sids=None):
+    """Envía un frame del profesor ('key': jpeg, 'parche': [(x, y, jpeg)]) a los
+    alumnos `sids` (None: a todos): a toda la clase, una vez al grupo multicast
+    si está configurado; si no (o solo a algunos alumnos) una copia por
+    Socket.IO a cada uno."""
+    em = None if sids else _emisor_multicast()
+    if tipo == 'key':
+        payload = {'activa': True, 'image': datos}
+    else:
+        payload = {'activa': True, 'tiles': [{'x': x, 'y': y, 'image': j} for x, y, j in datos]}
+    if em is not None:
+        _multicast['activo'] = True
+        for sid in _multicast['socketio']:   # no les llega el grupo
+            socketio.emit('teacher_screen', payload, to=sid)
+        ahora = time.monotonic()
+        payload = None
+        if ahora - em.t_anuncio >= ANUNCIO_MULTICAST:
+            em.t_anuncio = ahora
+            payload = {'activa': True, 'multicast': em.anuncio()}
+    if payload is not None:
+        if sids:
+            for sid in sids:
+                socketio.emit('teacher_screen', payload, to=sid)
+        else:
+            socketio.emit('teacher_screen', payload)   # sin 'to': a todos
+    if em is not None:
+        em.enviar(datos if tipo == 'key' else _empaquetar_parches(datos), tipo)
+
+
+class _CambiosProfesor:
+    """Decide qué enviar de cada captura del profesor y a qué ritmo.
+
+    Compara la captura con la última enviada sobre copias reducidas (solo
+    llamadas C de Pillow: diferencia, umbral y reduce() por teselas) y devuelve
+    None si no cambia nada, ('parche', [(x, y, jpeg)]) con las franjas de
+    teselas sucias o ('key', jpeg) con el frame entero. `fps` sube con cada
+    frame con cambios y baja con cada frame quieto."""
+
+    def __init__(self, tesela=TESELA_PROFESOR, escala=ESCALA_CAMBIOS, umbral=UMBRAL_CAMBIO,
+                 max_fraccion=MAX_FRACCION_PARCHE, keepalive=KEEPALIVE_PROFESOR):
+        self.tesela = tesela
+        self.escala = escala
+        self.umbral = umbral
+        self.max_fraccion = max_fraccion
+        self.keepalive = keepalive
+        self.fps = FPS_MIN_PROFESOR
+        self._img = None        # último frame enviado (lo que ven los alumnos)
+        self._reducida = None
+        self._t_key = 0.0
+        self._jpeg_key = None   # keyframe de _img ya codificado
+        self._lock = threading.Lock()   # codificar() corre en el hilo de captura
+
+    def forzar_keyframe(self):
+        self._reducida = None
+
+    def teselas(self, prev, actual):
+        """Filas de booleanos: teselas con algún cambio entre dos copias reducidas."""
+        from PIL import ImageChops
+        d = ImageChops.difference(prev, actual).point(lambda v: 255 if v > self.umbral else 0)
+        r, g, b = d.split()
+        rejilla = ImageChops.lighter(ImageChops.lighter(r, g), b).reduce(self.tesela // self.escala)
+        cols, datos = rejilla.width, rejilla.tobytes()
+        return [[v > 0 for v in datos[i:i + cols]] for i in range(0, len(datos), cols)]
+
+    def rectangulos(self, mascara, ancho, alto):
+        """Agrupa teselas contiguas de cada fila en franjas (x, y, w, h) en píxeles."""
+        t = self.tesela
+        rects = []
+        for f, fila in enumerate(mascara):
+            c, n = 0, len(fila)
+            while c < n:
+                if not fila[c]:
+                    c += 1
+                    continue
+                ini = c
+                while c < n and fila[c]:
+                    c += 1
+                x, y = ini * t, f * t
+                rects.append((x, y, min(c * t, ancho) - x, min(t, alto - y)))
+        return rects
+
+    def codificar(self, img, calidad=CALIDAD_PROFESOR, ahora=None, cap=None):
+        """`cap` es la captura mss de la que sale `img` si no se ha reducido: los
+        keyframes se codifican entonces directamente de su buffer BGRA."""
+        with self._lock:
+            return self._codificar(img, calidad, ahora, cap)
+
+    def _codificar(self, img, calidad, ahora, cap=None):
+        ahora = time.monotonic() if ahora is None else ahora
+        reducida = img.reduce(self.escala)
+        prev = self._reducida
+        if prev is None or prev.size != reducida.size or ahora - self._t_key >= self.keepalive:
+            return self._keyframe(img, reducida, calidad, ahora, cap)
+        mascara = self.teselas(prev, reducida)
+        sucias = sum(map(sum, mascara))
+        if not sucias:
+            self.fps = max(FPS_MIN_PROFESOR, self.fps / 1.5)
+            return None
+        self.fps = min(FPS_MAX_PROFESOR, self.fps * 1.5)
+        if sucias > self.max_fraccion * len(mascara) * len(mascara[0]):
+            return self._keyframe(img, reducida, calidad, ahora, cap)
+        self._img, self._reducida, self._jpeg_key = img, reducida, None
+        return 'parche', [(x, y, _codificar_jpeg(img.crop((x, y, x + w, y + h)), calidad))
+                          for x, y, w, h in self.rectangulos(mascara, img.width, img.height)]
+
+    def _keyframe(self, img, reducida, calidad, ahora, cap=None):
+        self._img, self._reducida, self._t_key = img, reducida, ahora
+        if cap is not None and _turbojpeg():
+            self._jpeg_key = _codificar_jpeg_bgra(cap, calidad)
+        else:
+            self._jpeg_key = _codificar_jpeg(img, calidad)
+        return 'key', self._jpeg_key
+
+    def keyframe(self, calidad=CALIDAD_PROFESOR):
+        """JPEG del frame que ven ahora los alumnos (para quien perdió parches)."""
+        with self._lock:
+            if self._jpeg_key is None and self._img is not None:
+                self._jpeg_key = _codificar_jpeg(self._img, calidad)
+            return self._jpeg_key
+
+
+def _captura_vigente(gen):
+    """True mientras la generación `gen` sea la captura del profesor en curso."""
+    return _teacher_capture['running'] and _teacher_capture['gen'] == gen
+
+
+def _parar_captura_profesor():
+    """Deja obsoleta la captura en curso: sus bucles lo ven y terminan solos."""
+    _teacher_capture['gen'] += 1
+    _teacher_capture['running'] = False
+    _teacher_capture['cambios'] = None
+
+
+def _fuera_del_loop(fn, *args):
+    """Ejecuta `fn` en un hilo del sistema (tpool de eventlet) y espera su
+    resultado sin bloquear el event loop."""
+    return tpool.execute(fn, *args)
+
+
+def _grab_profesor(sct):
+    """Captura lo que se comparte: la ventana elegida (None si ya no existe) o el monitor."""
+    if _teacher_capture.get('type') == 'window':
+        region = _get_window_region(_teacher_capture['wid'])
+        return sct.grab(region) if region else None
+    return sct.grab(sct.monitors[_teacher_capture.get('monitor', 1)])
+
+
+def _hilo_captura_profesor(gen, cola, cambios, capturar=None):
+    """Hilo del sistema que captura, compara y codifica la pantalla del profesor.
+
+    Pillow suelta el GIL en las operaciones pesadas (conversión, reduce,
+    diferencia, JPEG), así que este trabajo ya no retiene el event loop de
+    eventlet: a `cola` solo llegan los mensajes listos para emitir,
+    (envío, vista previa o None), y None al terminar. Sale en cuanto la
+    generación `gen` deja de ser la vigente."""
+    from PIL import Image
+
+    def entregar(item):
+        # Con la cola llena se reintenta, pero sin quedarse colgado si el
+        # green thread ya se ha ido porque la generación es obsoleta
+        while _captura_vigente(gen):
+            try:
+                cola.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    sct = None
+    if capturar is None:
         import mss
-        from PIL import Image
-    except ImportError:
+        sct = mss.mss()   # se abre en este hilo: mss no se comparte entre hilos
+        capturar = lambda: _grab_profesor(sct)
+    t_preview = 0.0
+    try:
+        while _captura_vigente(gen):
+            t0 = time.monotonic()
+            try:
+                cap = capturar()
+                if cap is None:
+                    time.sleep(0.5)
+                    continue
+                img = Image.frombytes('RGB', (cap.width, cap.height), cap.bgra, 'raw', 'BGRX')
+                reducida = _reducir(img, ANCHO_PROFESOR)
+                envio = cambios.codificar(reducida, CALIDAD_PROFESOR, t0,
+                                          cap if reducida is img else None)
+                if envio:
+                    preview = None
+                    if t0 - t_preview >= PERIODO_PREVIEW:
+                        t_preview = t0
+                        preview = _codificar_jpeg(_reducir(img, ANCHO_PREVIEW), 70)
+                    entregar((envio, preview))
+            except Exception as e:
+                print(f'[!] Error capturando pantalla del profesor: {e}')
+            time.sleep(max(0.0, 1 / cambios.fps - (time.monotonic() - t0)))
+    finally:
+        if sct is not None:
+            sct.close()
+        try:
+            cola.put_nowait(None)
+        except queue.Full:
+            pass   # el green thread ya no lee la cola
+
+
+def _teacher_capture_loop(gen, capturar=None):
+    """Emite por Socket.IO (o multicast) los cambios de la pantalla del profesor,
+    al ritmo que marca _CambiosProfesor. Capturar y codificar se hace en
+    _hilo_captura_profesor; este green thread solo recibe los bytes y emite,
+    mientras `gen` sea la generación vigente."""
+    modulos = ('PIL',) if capturar is not None else ('mss', 'PIL')
+    if not all(sys.modules.get(m) is not None or importlib.util.find_spec(m) is not None
+               for m in modulos):
         socketio.emit('teacher_screen_preview', {'error': 'Instala mss y Pillow en el servidor: pip install mss Pillow'},
                       to=_teacher_capture['sid'])
         return
 
-    with mss.mss() as sct:
-        while _teacher_capture['running']:
-            try:
-                if _teacher_capture.get('type') == 'window':
-                    region = _get_window_region(_teacher_capture['wid'])
-                    if region is None:
-                        socketio.sleep(0.5)
-                        continue
-                    cap = sct.grab(region)
-                else:
-                    mon = sct.monitors[_teacher_capture.get('monitor', 1)]
-                    cap = sct.grab(mon)
-                img = Image.frombytes('RGB', (cap.width, cap.height), cap.rgb)
-                max_w = 1920
-                if img.width > max_w:
-                    ratio = max_w / img.width
-                    img = img.resize((max_w, int(img.height * ratio)), Image.LANCZOS)
-                buf = io.BytesIO()
-                img.save(buf, 'JPEG', quality=70)
-                data_uri = 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode()
-                _sids = _teacher_capture.get('sids')
-                if _sids:
-                    for _sid in _sids:
-                        socketio.emit('teacher_screen', {'activa': True, 'image': data_uri}, to=_sid)
-                else:
-                    socketio.emit('teacher_screen', {'activa': True, 'image': data_uri}, broadcast=True)
-                socketio.emit('teacher_screen_preview', {'image': data_uri}, to=_teacher_capture['sid'])
-            except Exception as e:
-                print(f'[!] Error capturando pantalla del profesor: {e}')
-            socketio.sleep(0.1)  # 10 FPS — cede el event loop de eventlet
+    cola = queue.Queue(maxsize=4)   # si el loop se atasca, el hilo espera en lugar de acumular
+    if not _captura_vigente(gen):
+        return   # otro start_teacher_capture llegó antes de arrancar este
+    cambios = _teacher_capture['cambios'] = _CambiosProfesor()
+    threading.Thread(target=_hilo_captura_profesor, args=(gen, cola, cambios, capturar),
+                     daemon=True, name='vigia-captura-profesor').start()
+    while True:
+        item = _fuera_del_loop(cola.get)
+        if item is None or not _captura_vigente(gen):
+            break
+        envio, preview = item
+        try:
+            _difundir_profesor(*envio, _teacher_capture.get('sids'))
+            if preview:
+                socketio.emit('teacher_screen_preview', {'image': preview}, to=_teacher_capture['sid'])
+        except Exception as e:
+            print(f'[!] Error enviando pantalla del profesor: {e}')
 
 
 def _capture_thumb(sct, region, max_w=192):
-    """Captura y devuelve un thumbnail JPEG base64 de una región de pantalla."""
+    """Captura y devuelve un thumbnail JPEG (bytes) de una región de pantalla."""
     try:
         from PIL import Image
         cap = sct.grab(region)
-        img = Image.frombytes('RGB', (cap.width, cap.height), cap.rgb)
-        th = max(1, round(max_w * img.height / img.width))
-        img = img.resize((max_w, th), Image.LANCZOS)
-        buf = io.BytesIO()
-        img.save(buf, 'JPEG', quality=60)
-        return 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode()
-    except Exception:
-        return None
-
-
-def _capture_window_thumb(wid_hex, max_w=192):
-    """Captura thumbnail de ventana via Xlib GetImage.
-    En compositors (KWin, Mutter) obtiene el contenido real de la ventana
-    aunque esté oculta detrás de otras ventanas."""
-    try:
-        from Xlib import display as xlib_display, X
-        from PIL import Image
-        wid = int(wid_hex, 16)
-        d = xlib_display.Display()
-        win = d.create_resource_object('window', wid)
-        geom = win.get_geometry()
-        w, h = geom.width, geom.height
-        if w < 1 or h < 1:
-            return None
-        raw = win.get_image(0, 0, w, h, X.ZPixmap, 0xffffffff)
-        # ZPixmap con profundidad 24/32: datos en formato BGRA (little-endian)
-        img = Image.frombytes('RGBA', (w, h), raw.data, 'raw', 'BGRA')
-        img = img.convert('RGB')
-        th = max(1, round(max_w * h / w))
-        img = img.resize((max_w, th), Image.LANCZOS)
-        buf = io.BytesIO()
-        img.save(buf, 'JPEG', quality=60)
-        return 'data:image/jpeg;base64,' + base64.b64encode(buf.getvalue()).decode()
+        img = Image.frombytes('RGB', (cap.width, cap.height), cap.bgra, 'raw', 'BGRX')
+        return _codificar_jpeg(_reducir(img, max_w), 60)
     except Exception:
         return None
 
 
-def _find_desktop_icon(classes):
-    """Devuelve el nombre de icono de la app buscando en archivos .desktop por WM_CLASS."""
-    lower = [c.lower() for c in classes]
-    dirs = [
-        '/usr/share/applications',
-        os.path.expanduser('~/.local/share/applications'),
-        '/usr/local/share/applications',
-        '/var/lib/snapd/desktop/applications',
-        '/var/lib/flatpak/exports/share/applications',
-    ]
-    second_pass = []  # coincidencias por nombre de archivo (menor prioridad)
-    for d in dirs:
-        if not os.path.isdir(d):
-            continue
-        for fname in os.listdir(d):
+class _IndiceIconos:
+    """Índice WM_CLASS → icono de los .desktop, persistente entre arranques.
+
+    Cada directorio de DIRS_APLICACIONES se lee una sola vez y se resume en
+    dos tablas (StartupWMClass → Icon y nombre del .desktop → Icon) junto con
+    su mtime. El índice se guarda en CACHE_ICONOS con las rutas que ha
+    resuelto el tema GTK; al arrancar solo se releen los directorios cuyo
+    mtime ha cambiado (instalar o quitar una app crea o borra su .desktop), y
+    entonces se olvidan las rutas resueltas. Los data URIs ya codificados se
+    guardan en un LRU de MAX_ICONOS: volver a abrir el selector no lee nada
+    del disco. Se usa desde el hilo de miniaturas, de ahí el lock."""
+
+    VERSION = 1
+
+    def __init__(self, ruta=None, dirs=None):
+        self.ruta = ruta or CACHE_ICONOS
+        self.dirs = list(DIRS_APLICACIONES if dirs is None else dirs)
+        self.lecturas = 0            # directorios leídos (listdir + .desktop)
+        self._indice = None          # dir → {'mtime', 'clases', 'nombres'}
+        self._rutas = {}             # nombre de icono → ruta (None: no encontrado)
+        self._uris = OrderedDict()   # ruta → data URI (None: no se pudo leer)
+        self._t_revision = 0.0
+        self._sucio = False
+        self._lock = threading.Lock()
+
+    def _cargar(self):
+        self._indice, self._rutas = {}, {}
+        try:
+            with open(self.ruta, encoding='utf-8') as f:
+                datos = json.load(f)
+            if datos.get('version') == self.VERSION:
+                self._indice, self._rutas = dict(datos['dirs']), dict(datos['rutas'])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            pass   # sin caché o de otra versión: se reconstruye
+
+    def _leer_dir(self, d):
+        """(StartupWMClass → Icon, nombre del .desktop → Icon) de un directorio."""
+        self.lecturas += 1
+        clases, nombres = {}, {}
+        try:
+            ficheros = sorted(os.listdir(d))
+        except OSError:
+            return clases, nombres
+        for fname in ficheros:
             if not fname.endswith('.desktop'):
                 continue
             try:
                 text = open(os.path.join(d, fname), encoding='utf-8', errors='ignore').read()
-                icon_m = re.search(r'^Icon=(.+)$', text, re.MULTILINE)
-                if not icon_m:
-                    continue
-                icon = icon_m.group(1).strip()
-                # 1ª prioridad: StartupWMClass exacto
-                swm = re.search(r'^StartupWMClass=(.+)$', text, re.MULTILINE)
-                if swm and swm.group(1).strip().lower() in lower:
-                    return icon
-                # 2ª prioridad: nombre del .desktop == clase (filezilla.desktop → filezilla)
-                stem = fname[:-8].lower()
-                if stem in lower:
-                    second_pass.append(icon)
-            except Exception:
-                pass
-    return second_pass[0] if second_pass else None
+            except OSError:
+                continue
+            icon_m = re.search(r'^Icon=(.+)$', text, re.MULTILINE)
+            if not icon_m:
+                continue
+            icon = icon_m.group(1).strip()
+            swm = re.search(r'^StartupWMClass=(.+)$', text, re.MULTILINE)
+            if swm:
+                clases.setdefault(swm.group(1).strip().lower(), icon)
+            # filezilla.desktop → filezilla
+            nombres.setdefault(fname[:-8].lower(), icon)
+        return clases, nombres
+
+    def _revisar(self):
+        """Relee los directorios cuyo mtime ha cambiado (como mucho cada REVISION_ICONOS s)."""
+        ahora = time.monotonic()
+        if self._indice is not None and ahora - self._t_revision < REVISION_ICONOS:
+            return
+        self._t_revision = ahora
+        if self._indice is None:
+            self._cargar()
+        cambiado = False
+        for d in self.dirs:
+            try:
+                mtime = os.stat(d).st_mtime
+            except OSError:
+                mtime = None
+            e = self._indice.get(d)
+            if e is not None and e['mtime'] == mtime:
+                continue
+            clases, nombres = self._leer_dir(d) if mtime is not None else ({}, {})
+            self._indice[d] = {'mtime': mtime, 'clases': clases, 'nombres': nombres}
+            cambiado = True
+        if cambiado:
+            self._rutas.clear()
+            self._uris.clear()
+            self._sucio = True
+
+    def _buscar(self, lower):
+        entradas = [self._indice[d] for d in self.dirs if d in self._indice]
+        # 1ª prioridad: StartupWMClass exacto; 2ª: nombre del .desktop == clase
+        for tabla in ('clases', 'nombres'):
+            for e in entradas:
+                for c in lower:
+                    if c in e[tabla]:
+                        return e[tabla][c]
+        return None
+
+    def icono(self, classes):
+        """Data URI del icono de la app con esas WM_CLASS (None si no hay)."""
+        lower = [c.lower() for c in classes]
+        with self._lock:
+            self._revisar()
+            nombre = self._buscar(lower) or lower[-1]
+            if nombre not in self._rutas:
+                self._rutas[nombre] = _find_icon_path(nombre)
+                self._sucio = True
+            ruta = self._rutas[nombre]
+            if ruta is None:
+                return None
+            if ruta in self._uris:
+                self._uris.move_to_end(ruta)
+                return self._uris[ruta]
+            uri = self._uris[ruta] = _icon_to_b64(ruta)
+            if len(self._uris) > MAX_ICONOS:
+                self._uris.popitem(last=False)
+            return uri
+
+    def guardar(self):
+        """Escribe el índice en CACHE_ICONOS si ha cambiado desde la última vez."""
+        try:
+            with self._lock:
+                if not self._sucio:
+                    return
+                # Se serializa con el lock tomado: el hilo de miniaturas sigue
+                # resolviendo rutas mientras se escribe el archivo
+                texto = json.dumps({'version': self.VERSION, 'dirs': self._indice,
+                                    'rutas': self._rutas})
+                self._sucio = False
+            os.makedirs(os.path.dirname(self.ruta) or '.', exist_ok=True)
+            tmp = self.ruta + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(texto)
+            os.replace(tmp, self.ruta)
+        except (OSError, TypeError, ValueError) as e:
+            print(f'[!] No se pudo guardar la caché de iconos: {e}')
+
+
+_iconos = _IndiceIconos()
 
 
 def _find_icon_path(name, preferred_size=48):
@@ -463,55 +2194,90 @@ def _icon_to_b64(path):
         return None
 
 
-def _get_window_app_icon(wid_hex):
-    """Obtiene el icono de la aplicación de una ventana via WM_CLASS y .desktop."""
+def _get_window_app_icon(wid_hex, classes=None):
+    """Obtiene el icono de la aplicación de una ventana via WM_CLASS y .desktop
+    (`classes` viene ya en la lista de _VentanasX; si no, se pregunta a xprop)."""
     try:
-        r = subprocess.run(['xprop', '-id', wid_hex, '-notype', 'WM_CLASS'],
-                           capture_output=True, text=True, timeout=1)
-        classes = re.findall(r'"([^"]+)"', r.stdout)
+        if classes is None:
+            r = subprocess.run(['xprop', '-id', wid_hex, '-notype', 'WM_CLASS'],
+                               capture_output=True, text=True, timeout=1)
+            classes = re.findall(r'"([^"]+)"', r.stdout)
         if not classes:
             return None
-        icon_name = _find_desktop_icon(classes) or classes[-1].lower()
-        return _icon_to_b64(_find_icon_path(icon_name))
+        return _iconos.icono(classes)
     except Exception:
         return None
 
 
-@socketio.on('get_screens')
-def on_get_screens():
+def _listar_pantallas():
+    """Monitores (según mss) y ventanas visibles, sin miniaturas."""
+    import mss
+    with mss.mss() as sct:
+        monitores = list(sct.monitors)
+    return monitores, _get_window_list()
+
+
+def _hilo_miniaturas(monitores, ventanas, cola):
+    """Hilo del sistema: miniatura de cada opción del selector (e icono de
+    cada ventana), a `cola` según está lista; None al terminar."""
     try:
         import mss
-        screens = []
         with mss.mss() as sct:
-            for i, mon in enumerate(sct.monitors):
-                label = f'Pantalla completa ({mon["width"]}×{mon["height"]})' if i == 0 \
-                        else f'Monitor {i} ({mon["width"]}×{mon["height"]})'
-                screens.append({
-                    'type': 'monitor', 'index': i, 'label': label,
-                    'thumb': _capture_thumb(sct, mon),
-                })
-            for win in _get_window_list():
-                # Capturar via Xlib (contenido real de la ventana, sin solapamiento)
-                # Si falla, usar mss como fallback (región de pantalla)
-                thumb = _capture_window_thumb(win['wid'])
+            for i, mon in enumerate(monitores):
+                cola.put({'id': f'monitor-{i}', 'thumb': _capture_thumb(sct, mon)})
+            for win in ventanas:
+                # Contenido real de la ventana vía Xlib; si falla, la región de pantalla
+                thumb = _ventanas_x.miniatura(win['wid'])
                 if thumb is None:
-                    region = {'left': win['x'], 'top': win['y'],
-                              'width': win['w'], 'height': win['h']}
-                    thumb = _capture_thumb(sct, region)
-                screens.append({
-                    'type': 'window', 'wid': win['wid'], 'label': win['title'],
-                    'thumb': thumb,
-                    'icon': _get_window_app_icon(win['wid']),
-                })
-        emit('screens_list', {'screens': screens})
+                    thumb = _capture_thumb(sct, {'left': win['x'], 'top': win['y'],
+                                                 'width': win['w'], 'height': win['h']})
+                cola.put({'id': win['wid'], 'thumb': thumb,
+                          'icon': _get_window_app_icon(win['wid'], win.get('clases'))})
+    except Exception as e:
+        print(f'[!] Error capturando miniaturas de pantallas: {e}')
+    finally:
+        cola.put(None)
+        _iconos.guardar()
+
+
+def _enviar_miniaturas(sid, monitores, ventanas):
+    """Emite un screen_thumb por opción del selector según salen del hilo."""
+    cola = queue.Queue()
+    threading.Thread(target=_hilo_miniaturas, args=(monitores, ventanas, cola),
+                     daemon=True, name='vigia-miniaturas').start()
+    while True:
+        item = _fuera_del_loop(cola.get)
+        if item is None:
+            break
+        socketio.emit('screen_thumb', item, to=sid)
+
+
+@socketio.on('get_screens')
+def on_get_screens():
+    """Selector de pantalla/ventana: la lista sale enseguida y sin miniaturas;
+    cada miniatura llega después en su propio screen_thumb. Las consultas a
+    X11 y las capturas van en hilos del sistema, fuera del event loop."""
+    try:
+        monitores, ventanas = _fuera_del_loop(_listar_pantallas)
     except Exception as e:
         emit('screens_list', {'error': f'Error al obtener pantallas: {e}\nAsegúrate de tener mss instalado: pip install mss Pillow'})
+        return
+    screens = []
+    for i, mon in enumerate(monitores):
+        label = f'Pantalla completa ({mon["width"]}×{mon["height"]})' if i == 0 \
+                else f'Monitor {i} ({mon["width"]}×{mon["height"]})'
+        screens.append({'type': 'monitor', 'index': i, 'id': f'monitor-{i}', 'label': label})
+    for win in ventanas:
+        screens.append({'type': 'window', 'wid': win['wid'], 'id': win['wid'], 'label': win['title']})
+    emit('screens_list', {'screens': screens})
+    socketio.start_background_task(_enviar_miniaturas, request.sid, monitores, ventanas)
 
 
 @socketio.on('start_teacher_capture')
 def on_start_teacher_capture(data=None):
-    _teacher_capture['running'] = False  # detener captura previa si la hubiera
-    time.sleep(0.1)
+    # La captura previa, si la hubiera, sale sola al ver su generación obsoleta:
+    # cambiar de monitor o ventana no espera a que termine
+    _parar_captura_profesor()
     data = data or {}
     _teacher_capture['sid'] = request.sid
     _teacher_capture['type'] = data.get('type', 'monitor')
@@ -519,24 +2285,33 @@ def on_start_teacher_capture(data=None):
     _teacher_capture['wid'] = data.get('wid')
     _teacher_capture['sids'] = data.get('sids') or None  # lista de sids destino (None = todos)
     _teacher_capture['running'] = True
+    _fin_multicast()
     # start_background_task crea un green thread de eventlet (no un hilo OS),
-    # garantizando que socketio.emit(broadcast=True) llegue a todos los clientes.
-    socketio.start_background_task(_teacher_capture_loop)
+    # garantizando que socketio.emit() sin destinatario llegue a todos los clientes;
+    # la captura en sí va en un hilo del sistema (_hilo_captura_profesor).
+    socketio.start_background_task(_teacher_capture_loop, _teacher_capture['gen'])
     print('[📺] Compartir pantalla del profesor: iniciado')
 
 
 @socketio.on('stop_teacher_capture')
 def on_stop_teacher_capture():
-    _teacher_capture['running'] = False
-    socketio.emit('teacher_screen', {'activa': False}, broadcast=True)
+    _parar_captura_profesor()
+    _fin_multicast()
+    socketio.emit('teacher_screen', {'activa': False})
     print('[📺] Compartir pantalla del profesor: detenido')
 
 
 @socketio.on('teacher_screenshot')
 def on_teacher_screenshot(data):
     activa = data.get('activa', True)
-    payload = {'activa': activa, 'image': data.get('image') if activa else None}
     sids = data.get('sids')
+    if activa:
+        jpeg = _frame_bytes(data.get('image'))
+        if jpeg:
+            _difundir_profesor('key', jpeg, sids)
+        return
+    _fin_multicast()
+    payload = {'activa': False, 'image': None}
     if sids:
         for sid in sids:
             socketio.emit('teacher_screen', payload, to=sid)
@@ -544,6 +2319,36 @@ def on_teacher_screenshot(data):
         emit('teacher_screen', payload, broadcast=True)
 
 
+@socketio.on('teacher_keyframe')
+def on_teacher_keyframe(data=None):
+    """Un alumno perdió fragmentos multicast, no le llega el grupo o recibió
+    parches sin tener la imagen base: se le reenvía por Socket.IO la pantalla
+    actual, con el número de frame para que descarte los anteriores. Con
+    {fallback: true} el grupo no le llega en absoluto: desde entonces recibe
+    la sesión por Socket.IO. Solo a los alumnos a los que va la pantalla."""
+    destino = _teacher_capture['sids']
+    if request.sid not in students or (destino is not None and request.sid not in destino):
+        return
+    data = data if isinstance(data, dict) else {}
+    em = _multicast['emisor'] if _multicast['activo'] else None
+    if em is not None:
+        if request.sid not in _multicast['socketio'] and data.get('sesion') != em.sesion:
+            return
+        if data.get('fallback'):
+            _multicast['socketio'].add(request.sid)
+        if request.sid in _multicast['socketio']:
+            em = None   # ya no sigue el grupo: keyframe normal
+    cambios = _teacher_capture.get('cambios') if _teacher_capture['running'] else None
+    ultimo = _multicast['emisor'].ultimo if _multicast['activo'] else None
+    datos = _fuera_del_loop(cambios.keyframe) if cambios else ultimo
+    if datos is None:
+        return
+    payload = {'activa': True, 'image': datos}
+    if em is not None:
+        payload.update(frame=em.frame, multicast=em.anuncio())
+    emit('teacher_screen', payload)
+
+
 @socketio.on('run_command')
 def on_run_command(data):
     sids = data.get('sids', [])
@@ -567,7 +2372,7 @@ def on_command_output(data):
         return
     socketio.emit('command_result', {
         'sid': sid,
-        'name': students[sid]['name'],
+        'name': students[sid].name,
         'cmd_id': data.get('cmd_id', ''),
         'command': data.get('command', ''),
         'stdout': data.get('stdout', ''),
@@ -602,7 +2407,7 @@ def on_start_view(data):
     if student_sid in students:
         viewers[student_sid] = {'prof_sid': request.sid, 'mode': mode}
         socketio.emit('viewer_start', {'mode': mode}, to=student_sid)
-        print(f"[👁] Modo {mode} iniciado en: {students[student_sid]['name']}")
+        print(f"[👁] Modo {mode} iniciado en: {students[student_sid].name}")
 
 
 @socketio.on('stop_view')
@@ -611,7 +2416,7 @@ def on_stop_view(data):
     if student_sid in viewers and viewers[student_sid]['prof_sid'] == request.sid:
         viewers.pop(student_sid)
         socketio.emit('viewer_stop', {}, to=student_sid)
-        print(f"[👁] Modo observación finalizado.")
+        print("[👁] Modo observación finalizado.")
 
 
 @socketio.on('remote_frame')
@@ -621,7 +2426,7 @@ def on_remote_frame(data):
     if v_data:
         socketio.emit('live_frame', {
             'sid':    request.sid,
-            'image':  data.get('image'),
+            'image':  _frame_bytes(data.get('image')),
             'orig_w': data.get('orig_w', 1280),
             'orig_h': data.get('orig_h', 720),
         }, to=v_data['prof_sid'])
@@ -708,7 +2513,7 @@ if __name__ == '__main__':
     ip = get_local_ip()
     sep = '=' * 52
     print(f"\n{sep}")
-    print(f"  VIGIA — Servidor del Profesor")
+    print("  VIGIA — Servidor del Profesor")
     print(sep)
     print(f"  Dashboard: http://{ip}:{port}")
     print(f"  Alumnos se conectan a IP: {ip}  puerto: {port}")
@@ -724,4 +2529,5 @@ if __name__ == '__main__':
                 pass
 
         threading.Thread(target=_abrir_navegador, daemon=True).start()
+    _iniciar_historial()
     socketio.run(app, host='0.0.0.0', port=port, debug=False)
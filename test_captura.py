@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+"""
+test_captura.py — Pruebas de la captura/codificación de pantalla del cliente
+
+Verifica la lógica de codificación de client.py (bloques delta, etc.) con
+Pillow y NumPy reales, sin X11 ni servidor.
+
+Ejecutar:  python3 test_captura.py
+"""
+
+import sys
+import os
+import io
+import time
+import types
+import importlib.util
+import unittest
+from unittest.mock import patch, MagicMock
+
+# ── Importar client.py con mss/socketio/tkinter simulados ──────────────────
+# Pillow y NumPy deben ser los reales; test_remote_control.py los sustituye por
+# mocks en sys.modules, así que se carga una copia aislada de client.py y los
+# módulos reales de PIL se reinstalan durante cada test.
+
+try:
+    import numpy  # noqa: F401  (nadie lo simula: se importa una sola vez)
+except ImportError:
+    numpy = None
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+_MODULOS_REALES = {}
+
+
+def _cargar_cliente():
+    mock_mss = types.ModuleType('mss')
+    mock_mss.mss = MagicMock()
+    fake_client = MagicMock()
+    fake_client.on    = lambda event_name: (lambda f: f)
+    fake_client.event = lambda f: f
+    mock_sio = types.ModuleType('socketio')
+    mock_sio.Client = MagicMock(return_value=fake_client)
+    with patch.dict(sys.modules):
+        for nombre in list(sys.modules):
+            if nombre == 'PIL' or nombre.startswith('PIL.'):
+                del sys.modules[nombre]
+        sys.modules.update({'mss': mock_mss, 'socketio': mock_sio, 'tkinter': None})
+        if numpy is None:
+            raise ImportError('numpy')
+        from PIL import Image
+        Image.init()
+        _MODULOS_REALES.update({n: m for n, m in sys.modules.items()
+                                if n == 'PIL' or n.startswith('PIL.')})
+        spec = importlib.util.spec_from_file_location('vigia_client', os.path.join(_DIR, 'client.py'))
+        mod = importlib.util.module_from_spec(spec)
+        with patch('shutil.which', return_value=None):
+            spec.loader.exec_module(mod)
+        return mod
+
+
+try:
+    client = _cargar_cliente()
+except ImportError:
+    client = None
+
+
+def _imagen(w=256, h=128, color=(0, 0, 0)):
+    return client.Image.new('RGB', (w, h), color)
+
+
+@unittest.skipIf(client is None, 'Pillow/NumPy no disponibles')
+class _BaseCaptura(unittest.TestCase):
+    """Reinstala Pillow real en sys.modules durante cada test."""
+
+    def setUp(self):
+        modulos = patch.dict(sys.modules, _MODULOS_REALES)
+        modulos.start()
+        self.addCleanup(modulos.stop)
+
+
+class TestCodificadorDelta(_BaseCaptura):
+    """Bloques delta: solo se codifican las regiones que cambian."""
+
+    def setUp(self):
+        super().setUp()
+        self.cod = client._CodificadorDelta(tam=64, keyframe_seg=10.0, max_fraccion=0.5)
+
+    def test_primer_frame_es_keyframe(self):
+        tipo, datos = self.cod.codificar(_imagen(), 60, now=0.0)
+        self.assertEqual(tipo, 'key')
+        self.assertTrue(datos.startswith(b'\xff\xd8'))
+        self.assertEqual(self.cod.kf, 1)
+
+    def test_frame_identico_no_envia_bloques(self):
+        self.cod.codificar(_imagen(), 60, now=0.0)
+        self.assertEqual(self.cod.codificar(_imagen(), 60, now=1.0), ('delta', []))
+
+    def test_bloque_cambiado(self):
+        self.cod.codificar(_imagen(), 60, now=0.0)
+        img = _imagen()
+        img.putpixel((130, 70), (255, 255, 255))
+        tipo, bloques = self.cod.codificar(img, 60, now=1.0)
+        self.assertEqual(tipo, 'delta')
+        self.assertEqual([(x, y) for x, y, _ in bloques], [(128, 64)])
+        self.assertEqual(client.Image.open(io.BytesIO(bloques[0][2])).size, (64, 64))
+
+    def test_bloques_contiguos_forman_una_franja(self):
+        mascara = client.np.array([[True, True, False, True]])
+        self.assertEqual(self.cod.rectangulos(mascara, 250, 64),
+                         [(0, 0, 128, 64), (192, 0, 58, 64)])
+
+    def test_bordes_no_multiplo_del_bloque(self):
+        self.cod.codificar(_imagen(100, 70), 60, now=0.0)
+        img = _imagen(100, 70)
+        img.putpixel((99, 69), (255, 0, 0))
+        _, bloques = self.cod.codificar(img, 60, now=1.0)
+        x, y, jpeg = bloques[0]
+        self.assertEqual((x, y), (64, 64))
+        self.assertEqual(client.Image.open(io.BytesIO(jpeg)).size, (36, 6))
+
+    def test_keyframe_periodico(self):
+        self.cod.codificar(_imagen(), 60, now=0.0)
+        self.assertEqual(self.cod.codificar(_imagen(), 60, now=11.0)[0], 'key')
+
+    def test_demasiados_cambios_envia_keyframe(self):
+        self.cod.codificar(_imagen(), 60, now=0.0)
+        self.assertEqual(self.cod.codificar(_imagen(color=(255, 255, 255)), 60, now=1.0)[0], 'key')
+
+    def test_forzar_keyframe(self):
+        self.cod.codificar(_imagen(), 60, now=0.0)
+        self.cod.forzar_keyframe()
+        self.assertEqual(self.cod.codificar(_imagen(), 60, now=1.0)[0], 'key')
+
+
+def _captura(w=320, h=180, color=(0, 0, 0), cambios=()):
+    """Simula un mss.ScreenShot (buffer BGRA crudo)."""
+    px = bytearray(bytes((color[2], color[1], color[0], 255)) * (w * h))
+    for x, y, (r, g, b) in cambios:
+        i = (y * w + x) * 4
+        px[i:i + 3] = bytes((b, g, r))
+    return types.SimpleNamespace(bgra=bytes(px), width=w, height=h, size=(w, h))
+
+
+class TestCodificadorJPEG(_BaseCaptura):
+    """Backends JPEG: Pillow siempre; libjpeg-turbo si está instalado."""
+
+    def _backends(self):
+        return ['pillow'] + (['turbo'] if client.TURBO_OK else [])
+
+    def _decodificar(self, jpeg):
+        return client.Image.open(io.BytesIO(jpeg)).convert('RGB')
+
+    def test_desde_bgra_respeta_colores(self):
+        for backend in self._backends():
+            with self.subTest(backend=backend):
+                cod = client._CodificadorImagen(backend)
+                img = self._decodificar(cod.bgra(_captura(64, 32, color=(200, 30, 30)), 90))
+                self.assertEqual(img.size, (64, 32))
+                r, g, b = img.getpixel((10, 10))
+                self.assertGreater(r, 180); self.assertLess(g, 60); self.assertLess(b, 60)
+
+    def test_recorte_de_array(self):
+        arr = client.np.zeros((64, 128, 3), client.np.uint8)
+        arr[:, 64:] = (0, 0, 255)
+        for backend in self._backends():
+            with self.subTest(backend=backend):
+                img = self._decodificar(client._CodificadorImagen(backend).array(arr[0:32, 64:128], 90))
+                self.assertEqual(img.size, (64, 32))
+                self.assertGreater(img.getpixel((5, 5))[2], 225)
+
+    def test_backend_por_defecto(self):
+        esperado = 'turbo' if client.TURBO_OK else 'pillow'
+        self.assertEqual(client._CodificadorImagen().backend, esperado)
+
+
+class TestFormatoMiniaturas(_BaseCaptura):
+    """El cliente elige el formato preferido entre los que anuncia el servidor."""
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(setattr, client._miniaturas, 'formato', 'jpeg')
+
+    def test_elige_webp_si_se_admite(self):
+        client.on_image_formats({'formatos': ['avif', 'webp', 'jpeg']})
+        esperado = 'webp' if client._formato_disponible('webp') else 'jpeg'
+        self.assertEqual(client._miniaturas.formato, esperado)
+
+    def test_solo_jpeg(self):
+        client.on_image_formats({'formatos': ['jpeg']})
+        self.assertEqual(client._miniaturas.formato, 'jpeg')
+
+    @unittest.skipUnless(client and client._formato_disponible('webp'), 'Pillow sin WebP')
+    def test_miniatura_webp(self):
+        cod = client._CodificadorImagen(formato='webp')
+        datos = cod.imagen(_imagen(), 60)
+        self.assertEqual((datos[:4], datos[8:12]), (b'RIFF', b'WEBP'))
+        client._miniaturas.formato = 'webp'
+        with patch.object(client, '_delta', None):
+            msgs = client._codificar_captura(_imagen(), 60)
+        self.assertEqual(msgs[0][1]['fmt'], 'webp')
+
+
+class TestEscalado(_BaseCaptura):
+    """Reducción rápida (reduce() + BOX / promedio por áreas) de las capturas."""
+
+    def test_reducir_tamano_exacto(self):
+        for w, h, ancho, esperado in ((1920, 1080, 1280, (1280, 720)),
+                                      (3840, 2160, 1280, (1280, 720)),
+                                      (1366, 768, 192, (192, 108))):
+            with self.subTest(origen=(w, h), ancho=ancho):
+                self.assertEqual(client._reducir(_imagen(w, h), ancho).size, esperado)
+
+    def test_reducir_no_amplia(self):
+        img = _imagen(100, 50)
+        self.assertIs(client._reducir(img, 192), img)
+
+    def test_promedio_areas(self):
+        arr = client.np.zeros((4, 4, 3), client.np.uint8)
+        arr[0, 0] = 200; arr[1, 1] = 200
+        res = client._promedio_areas(arr, 2)
+        self.assertEqual(res.shape, (2, 2, 3))
+        self.assertEqual(res[0, 0, 0], 100)
+        self.assertEqual(res[1, 1, 0], 0)
+
+    def test_numpy_y_pillow_equivalentes(self):
+        cambios = [(x, y, (255, 255, 255)) for x in range(0, 640, 7) for y in range(0, 360, 5)]
+        cap = _captura(640, 360, color=(30, 60, 90), cambios=cambios)
+        a = client.np.asarray(client._escalar_captura(cap, 160, 'pillow'), client.np.int16)
+        b = client.np.asarray(client._escalar_captura(cap, 160, 'numpy'), client.np.int16)
+        self.assertEqual(a.shape, b.shape)
+        self.assertLess(client.np.abs(a - b).mean(), 2)
+
+
+class TestDetectorCambios(_BaseCaptura):
+    """Hash perceptual: las pantallas sin cambios no se codifican."""
+
+    def setUp(self):
+        super().setUp()
+        self.det = client._DetectorCambios(umbral=0, rejilla=(16, 9), refresco_max=30.0)
+
+    def _bloque(self, x0, y0, color=(255, 255, 255), lado=12):
+        return [(x, y, color) for x in range(x0, x0 + lado) for y in range(y0, y0 + lado)]
+
+    def test_primera_captura_siempre_cambia(self):
+        self.assertTrue(self.det.cambio(_captura(), now=0.0))
+
+    def test_captura_identica_no_cambia(self):
+        self.det.cambio(_captura(), now=0.0)
+        self.assertFalse(self.det.cambio(_captura(), now=1.0))
+
+    def test_cambio_visible_se_detecta(self):
+        self.det.cambio(_captura(), now=0.0)
+        self.assertTrue(self.det.cambio(_captura(cambios=self._bloque(100, 100)), now=1.0))
+
+    def test_umbral_tolera_celdas(self):
+        det = client._DetectorCambios(umbral=1, rejilla=(16, 9), refresco_max=30.0)
+        det.cambio(_captura(), now=0.0)
+        self.assertFalse(det.cambio(_captura(cambios=self._bloque(100, 100)), now=1.0))
+
+    def test_refresco_forzado(self):
+        self.det.cambio(_captura(), now=0.0)
+        self.assertTrue(self.det.cambio(_captura(), now=31.0))
+
+    def test_reiniciar_fuerza_envio(self):
+        self.det.cambio(_captura(), now=0.0)
+        self.det.reiniciar()
+        self.assertTrue(self.det.cambio(_captura(), now=1.0))
+
+    def test_cambio_de_resolucion(self):
+        self.det.cambio(_captura(), now=0.0)
+        self.assertTrue(self.det.cambio(_captura(640, 360), now=1.0))
+
+
+class TestControlAdaptativo(_BaseCaptura):
+    """El cliente degrada/recupera la captura según la carga del servidor."""
+
+    def setUp(self):
+        super().setUp()
+        self.ctl = client._ControlAdaptativo(niveles=4, lag_objetivo=50,
+                                             cola_objetivo=60, reportes_recuperar=3)
+
+    def test_sin_carga_usa_valores_maximos(self):
+        self.assertEqual(self.ctl.intervalo, client.INTERVALO_SEG)
+        self.assertEqual(self.ctl.ancho, client.ANCHO_IMAGEN)
+        self.assertEqual(self.ctl.calidad, client.CALIDAD_JPEG)
+
+    def test_lag_alto_degrada(self):
+        self.ctl.actualizar(200, 0)
+        self.assertEqual(self.ctl.nivel, 1)
+        self.assertGreater(self.ctl.intervalo, client.INTERVALO_SEG)
+        self.assertLess(self.ctl.ancho, client.ANCHO_IMAGEN)
+        self.assertLess(self.ctl.calidad, client.CALIDAD_JPEG)
+
+    def test_cola_alta_degrada(self):
+        self.ctl.actualizar(0, 120)
+        self.assertEqual(self.ctl.nivel, 1)
+
+    def test_limites_configurados(self):
+        for _ in range(10):
+            self.ctl.actualizar(1000, 1000)
+        self.assertEqual(self.ctl.nivel, 4)
+        self.assertEqual(self.ctl.intervalo, client.INTERVALO_MAX)
+        self.assertEqual(self.ctl.ancho, client.ANCHO_MIN)
+        self.assertEqual(self.ctl.calidad, client.CALIDAD_MIN)
+
+    def test_recupera_tras_varios_informes_holgados(self):
+        self.ctl.actualizar(200, 0)
+        self.ctl.actualizar(0, 0); self.ctl.actualizar(0, 0)
+        self.assertEqual(self.ctl.nivel, 1)
+        self.ctl.actualizar(0, 0)
+        self.assertEqual(self.ctl.nivel, 0)
+
+    def test_ancho_multiplo_de_16(self):
+        for _ in range(3):
+            self.ctl.actualizar(1000, 0)
+            self.assertEqual(self.ctl.ancho % 16, 0)
+
+
+class TestPipeline(_BaseCaptura):
+    """Buzones 'el último gana' entre las etapas captura → codificación → envío."""
+
+    def test_el_ultimo_gana(self):
+        b = client._Buzon()
+        b.poner('vivo', 1); b.poner('vivo', 2)
+        self.assertEqual(b.sacar(timeout=0), ('vivo', 2))
+        self.assertEqual(b.descartados, 1)
+        self.assertIsNone(b.sacar(timeout=0))
+
+    def test_tipos_independientes_en_orden(self):
+        b = client._Buzon()
+        b.poner('captura', 'a'); b.poner('vivo', 'b'); b.poner('captura', 'c')
+        self.assertEqual(b.sacar(timeout=0), ('captura', 'c'))
+        self.assertEqual(b.sacar(timeout=0), ('vivo', 'b'))
+
+    def test_sacar_espera_al_productor(self):
+        import threading
+        b = client._Buzon()
+        threading.Timer(0.05, b.poner, args=('vivo', 'x')).start()
+        self.assertEqual(b.sacar(timeout=2), ('vivo', 'x'))
+
+    def _delta(self, *xs):
+        return [('screenshot_delta', {'kf': 1, 'tiles': [{'x': x, 'y': 0, 'image': b'j'} for x in xs]})]
+
+    def test_deltas_pendientes_se_acumulan(self):
+        res = client._combinar_capturas(self._delta(0), self._delta(64))
+        self.assertEqual(len(res), 1)
+        self.assertEqual([t['x'] for t in res[0][1]['tiles']], [0, 64])
+
+    def test_keyframe_sustituye_lo_pendiente(self):
+        key = [('screenshot', {'image': b'k', 'kf': 2})]
+        self.assertEqual(client._combinar_capturas(self._delta(0), key), key)
+
+    def test_delta_tras_keyframe_pendiente_se_encadena(self):
+        key = [('screenshot', {'image': b'k', 'kf': 1})]
+        res = client._combinar_capturas(key, self._delta(0))
+        self.assertEqual([ev for ev, _ in res], ['screenshot', 'screenshot_delta'])
+
+    def test_heartbeat_no_pisa_un_frame(self):
+        hb = [('heartbeat', {})]
+        self.assertEqual(client._combinar_capturas(self._delta(0), hb), self._delta(0))
+        self.assertEqual(client._combinar_capturas(hb, self._delta(0)), self._delta(0))
+
+    def test_deltas_combinados_llevan_la_ultima_miniatura(self):
+        a, b = self._delta(0), self._delta(64)
+        a[0][1]['thumb'], b[0][1]['thumb'] = b'vieja', b'nueva'
+        self.assertEqual(client._combinar_capturas(a, b)[0][1]['thumb'], b'nueva')
+
+    def test_miniatura_acompana_al_frame(self):
+        with patch.object(client, '_delta', None):
+            msgs = client._codificar_captura(_imagen(1280, 720), 60)
+        thumb = client.Image.open(io.BytesIO(msgs[0][1]['thumb']))
+        self.assertEqual(thumb.size, (client.ANCHO_MINIATURA, 180))
+
+    def test_estadisticas_media_movil(self):
+        est = client._EstadisticasPipeline(alfa=0.5)
+        est.registrar('captura', 0.010)
+        est.registrar('captura', 0.020)
+        self.assertEqual(est.resumen()['captura'], 15.0)
+
+
+
+class TestBusFrames(_BaseCaptura):
+    """Una sola captura compartida por miniaturas, vista en vivo y WebRTC."""
+
+    def setUp(self):
+        super().setUp()
+        import threading
+        self.grabs = 0
+        def capturar():
+            self.grabs += 1
+            return _captura(32, 18)
+        self.bus = client._BusFrames(capturar=capturar)
+        threading.Thread(target=self.bus.bucle, daemon=True).start()
+
+    def test_sin_suscriptores_captura_bajo_demanda(self):
+        seq, cap = self.bus.siguiente(0, timeout=2)
+        self.assertEqual(seq, 1)
+        time.sleep(0.1)
+        self.assertEqual(self.grabs, 1)
+
+    def test_frame_reciente_se_reutiliza(self):
+        a = self.bus.reciente(10.0, timeout=2)
+        b = self.bus.reciente(10.0, timeout=2)
+        self.assertIs(a[1], b[1])
+        self.assertEqual(self.grabs, 1)
+
+    def test_suscriptor_marca_el_ritmo(self):
+        self.bus.suscribir('vivo', 50)
+        time.sleep(0.3)
+        self.bus.cancelar('vivo')
+        n = self.grabs
+        self.assertGreater(n, 5)
+        self.assertLess(n, 30)
+        time.sleep(0.1)
+        self.assertLessEqual(self.grabs, n + 1)
+
+    def test_el_mas_exigente_manda(self):
+        self.bus.suscribir('vivo', 20); self.bus.suscribir('webrtc', 30)
+        self.assertEqual(self.bus.fps, 30)
+        self.bus.cancelar('webrtc')
+        self.assertEqual(self.bus.fps, 20)
+        self.bus.cancelar('vivo')
+
+    def test_consumidores_comparten_frame(self):
+        self.bus.suscribir('webrtc', 30)
+        seq, cap = self.bus.siguiente(0, timeout=2)
+        seq2, cap2 = self.bus.reciente(1.0)
+        self.assertIs(cap, cap2)
+        self.bus.cancelar('webrtc')
+
+    def test_dimensiones_del_monitor(self):
+        self.assertEqual(self.bus.dimensiones(timeout=2), (32, 18))
+
+
+class TestReceptorMulticast(_BaseCaptura):
+    """Recomposición de los frames del profesor que llegan troceados por multicast."""
+
+    GRUPO = '239.255.42.98'
+
+    def setUp(self):
+        super().setUp()
+        self.entregados, self.peticiones = [], []
+        self.r = client._ReceptorMulticast(self.GRUPO, 0, 7, self.entregados.append,
+                                           self.peticiones.append)
+
+    def _trozos(self, frame, datos, n=3, sesion=7, tipo=0):
+        paso = -(-len(datos) // n)
+        return [client.CABECERA_MULTICAST.pack(client.MAGIA_MULTICAST, sesion, frame, i, n, tipo)
+                + datos[i * paso:(i + 1) * paso] for i in range(n)]
+
+    def _parche(self, frame, jpeg=b'jpeg'):
+        import struct
+        return self._trozos(frame, struct.pack('!HHI', 64, 128, len(jpeg)) + jpeg, n=1, tipo=1)
+
+    def _imagenes(self):
+        return [m.get('image') for m in self.entregados]
+
+    def test_recompone_fuera_de_orden(self):
+        a, b, c = self._trozos(1, b'0123456789')
+        for d in (c, a, b):
+            self.r.recibir(d)
+        self.assertEqual(self._imagenes(), [b'0123456789'])
+        self.assertEqual(self.r.ultimo, 1)
+
+    def test_descarta_otra_sesion_y_frames_viejos(self):
+        for d in self._trozos(2, b'nuevo'):
+            self.r.recibir(d)
+        for d in self._trozos(1, b'viejo') + self._trozos(3, b'ajeno', sesion=8):
+            self.r.recibir(d)
+        self.assertEqual(self._imagenes(), [b'nuevo'])
+
+    def test_parches_seguidos_se_entregan(self):
+        for d in self._trozos(1, b'base') + self._parche(2) + self._parche(3, b'otro'):
+            self.r.recibir(d)
+        self.assertEqual(self.entregados[1:], [
+            {'activa': True, 'tiles': [{'x': 64, 'y': 128, 'image': b'jpeg'}]},
+            {'activa': True, 'tiles': [{'x': 64, 'y': 128, 'image': b'otro'}]}])
+
+    def test_parche_tras_un_hueco_pide_keyframe(self):
+        for d in self._trozos(1, b'base') + self._parche(3) + self._parche(4):
+            self.r.recibir(d)
+        self.assertEqual(len(self.entregados), 1)
+        self.assertTrue(self.r.roto)
+        self.r.revisar()
+        self.assertEqual(self.peticiones, [7])
+        self.r.cubrir(4)   # keyframe por Socket.IO
+        self.r.recibir(self._parche(5)[0])
+        self.assertEqual(len(self.entregados), 2)
+
+    def test_parche_sin_keyframe_se_ignora(self):
+        self.r.recibir(self._parche(1)[0])
+        self.assertEqual(self.entregados, [])
+
+    def test_frame_incompleto_pide_keyframe(self):
+        self.r.ultimo = 1
+        self.r.recibir(self._trozos(2, b'abcdef')[0])
+        self.r.revisar(time.monotonic() + client.ESPERA_FRAGMENTOS + 0.1)
+        self.assertEqual(self.peticiones, [7])
+        self.assertEqual(self.r._parciales, {})
+        self.r.revisar(time.monotonic() + client.ESPERA_FRAGMENTOS + 0.2)
+        self.assertEqual(self.peticiones, [7])   # una petición por ESPERA_KEYFRAME
+
+    def test_keyframe_cubre_frames_pendientes(self):
+        self.r.recibir(self._trozos(4, b'abcdef')[0])
+        self.r.cubrir(5)
+        self.assertEqual(self.r._parciales, {})
+        for d in self._trozos(5, b'repetido'):
+            self.r.recibir(d)
+        self.assertEqual(self.entregados, [])
+
+    def test_sin_datagramas_tras_el_keyframe_pasa_a_socketio(self):
+        mudos = []
+        r = client._ReceptorMulticast(self.GRUPO, 0, 7, self.entregados.append,
+                                      self.peticiones.append, mudos.append)
+        r._activo = True
+        for d in self._trozos(1, b'primero'):
+            r.recibir(d)
+        r.cubrir(2)   # keyframe por Socket.IO: ya no está roto
+        ahora = time.monotonic()
+        r.revisar(ahora + client.SILENCIO_MULTICAST / 2)
+        self.assertEqual((mudos, self.peticiones), ([], []))
+        r.revisar(ahora + client.SILENCIO_MULTICAST + 1)
+        self.assertEqual(mudos, [7])
+        self.assertFalse(r._activo)
+        r.revisar(ahora + client.SILENCIO_MULTICAST + 2)
+        self.assertEqual(mudos, [7])   # se avisa una sola vez
+
+    def test_cubrir_desde_otro_hilo(self):
+        import threading
+        errores, fin = [], threading.Event()
+
+        def socketio():
+            frame = 0
+            while not fin.is_set():
+                frame += 1
+                self.r.cubrir(frame)
+
+        hilo = threading.Thread(target=socketio)
+        hilo.start()
+        try:
+            for f in range(1, 3000):
+                try:
+                    self.r.recibir(self._trozos(10 ** 6 + f, b'abcdef')[0])
+                    self.r.revisar(time.monotonic() + client.ESPERA_FRAGMENTOS + 0.1)
+                except RuntimeError as e:
+                    errores.append(e)
+        finally:
+            fin.set()
+            hilo.join()
+        self.assertEqual(errores, [])
+
+    def test_loopback(self):
+        import queue
+        import socket
+        cola = queue.Queue()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.bind(('127.0.0.1', 0))
+            puerto = s.getsockname()[1]
+        r = client._ReceptorMulticast(self.GRUPO, puerto, 7, cola.put, self.peticiones.append,
+                                      interfaz='127.0.0.1')
+        try:
+            r.iniciar()
+        except OSError as e:
+            self.skipTest(f'sin multicast en loopback: {e}')
+        self.addCleanup(r.detener)
+        datos = os.urandom(5000)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton('127.0.0.1'))
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            for d in self._trozos(1, datos, n=4):
+                s.sendto(d, (self.GRUPO, puerto))
+        self.assertEqual(cola.get(timeout=2), {'activa': True, 'image': datos})
+
+
+class TestColaProfesor(_BaseCaptura):
+    """Si la ventana del profesor va retrasada no se pierden parches."""
+
+    def setUp(self):
+        super().setUp()
+        self._pendientes()
+        self.addCleanup(self._pendientes)
+
+    def _pendientes(self):
+        res = []
+        while not client._cola_profesor.empty():
+            res.append(client._cola_profesor.get_nowait())
+        return res
+
+    def test_parches_se_acumulan_sobre_el_keyframe(self):
+        tile = lambda n: {'x': n, 'y': 0, 'image': b'j'}
+        client._encolar_profesor({'activa': True, 'image': b'key'})
+        client._encolar_profesor({'activa': True, 'tiles': [tile(1)]})
+        client._encolar_profesor({'activa': True, 'tiles': [tile(2)]})
+        self.assertEqual(self._pendientes(), [
+            {'activa': True, 'image': b'key', 'tiles': [tile(1), tile(2)]}])
+
+    def test_keyframe_sustituye_lo_pendiente(self):
+        client._encolar_profesor({'activa': True, 'image': b'a'})
+        client._encolar_profesor({'activa': True, 'tiles': [{'x': 0, 'y': 0, 'image': b'j'}]})
+        client._encolar_profesor({'activa': True, 'image': b'b'})
+        self.assertEqual(self._pendientes(), [{'activa': True, 'image': b'b'}])
+
+    def test_al_reconectar_los_parches_esperan_un_keyframe(self):
+        client.on_teacher_screen({'activa': True, 'image': b'key'})
+        self._pendientes()
+        with patch.object(client, '_id_cliente', return_value='id'), \
+                patch.object(client, '_seguir_multicast'), \
+                patch.dict(client._profesor, t_peticion=0.0):
+            client.connect()
+            client.sio.emit.reset_mock()
+            client.on_teacher_screen({'activa': True, 'tiles': [{'x': 0, 'y': 0, 'image': b'j'}]})
+        self.assertEqual(self._pendientes(), [])
+        client.sio.emit.assert_called_once_with('teacher_keyframe', {})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
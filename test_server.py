@@ -0,0 +1,1273 @@
+#!/usr/bin/env python3
+"""
+test_server.py — Pruebas del servidor VIGIA (relay de capturas)
+
+Usa el cliente de pruebas de Flask-SocketIO: no abre puertos ni necesita X11.
+Requiere flask, flask-socketio y eventlet (requirements_servidor.txt).
+
+Ejecutar:  python3 test_server.py
+"""
+
+import sys
+import os
+import io
+import base64
+import shutil
+import socket
+import tempfile
+import threading
+import types
+import importlib.util
+import unittest
+from unittest.mock import ANY, patch
+
+# ── Importar server.py con los módulos reales ──────────────────────────────
+# test_remote_control.py sustituye socketio/PIL/mss por mocks en sys.modules.
+# Se cargan aquí los módulos reales en un sys.modules aislado para que el
+# orden de ejecución de los tests no importe. server.py importa PIL dentro de
+# las funciones, así que los módulos reales se reinstalan durante cada test.
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+_RAICES = ('socketio', 'engineio', 'flask_socketio', 'PIL', 'mss')
+_MODULOS_REALES = {}
+
+
+def _es_mock(mod):
+    return mod is None or getattr(mod, '__file__', None) is None
+
+
+def _cargar_servidor():
+    with patch.dict(sys.modules):
+        for nombre in list(sys.modules):
+            raiz = nombre.split('.')[0]
+            if raiz in _RAICES and _es_mock(sys.modules[nombre]):
+                del sys.modules[nombre]
+        spec = importlib.util.spec_from_file_location('vigia_server', os.path.join(_DIR, 'server.py'))
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        try:
+            # server.py importa PIL de forma perezosa: se carga ya para guardarlo
+            importlib.import_module('PIL.Image')
+        except ImportError:
+            pass
+        _MODULOS_REALES.update({n: m for n, m in sys.modules.items()
+                                if n.split('.')[0] in _RAICES})
+        return mod
+
+
+try:
+    server = _cargar_servidor()
+except ImportError as e:   # dependencias del servidor no instaladas
+    server = None
+    _MOTIVO = str(e)
+
+_JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 32 + b'\xff\xd9'
+
+
+def _eventos(cliente, nombre):
+    return [ev['args'][0] for ev in cliente.get_received() if ev['name'] == nombre]
+
+
+def _tick(cliente):
+    """Ejecuta un tick de lotes y devuelve los frames de update_batch recibidos."""
+    server._enviar_lotes()
+    return [f for lote in _eventos(cliente, 'update_batch') for f in lote['frames']]
+
+
+@unittest.skipIf(server is None, 'dependencias del servidor no instaladas')
+class _BaseServidor(unittest.TestCase):
+    """Conecta un dashboard y un alumno contra el servidor en memoria."""
+
+    def setUp(self):
+        modulos = patch.dict(sys.modules, _MODULOS_REALES)
+        modulos.start()
+        self.addCleanup(modulos.stop)
+        server.students.clear()
+        server.viewers.clear()
+        server.dashboards.clear()
+        server.formatos_dashboards.clear()
+        server.bandejas.clear()
+        server._memoria.update(total=0, desalojos=0)
+        server._almacen.frames.clear()
+        server._historial.update(archivo=None, iniciado=True)   # sin archivo en disco
+        server._formatos_anunciados = None
+        self.prof = server.socketio.test_client(server.app)
+        self.prof.emit('register_teacher')
+        self.alumno = server.socketio.test_client(server.app)
+        self.alumno.emit('register', {'name': 'alumno - pc01'})
+        self.sid = next(iter(server.students))
+        self.prof.get_received(); self.alumno.get_received()
+
+    def tearDown(self):
+        for c in (self.prof, self.alumno):
+            if c.is_connected():
+                c.disconnect()
+
+
+class TestFramesBinarios(_BaseServidor):
+    """Los frames viajan como bytes JPEG crudos de extremo a extremo."""
+
+    def test_screenshot_binario_se_guarda_como_bytes(self):
+        self.alumno.emit('screenshot', {'image': _JPEG})
+        self.assertEqual(server.students[self.sid].screenshot, _JPEG)
+
+    def test_lote_reenvia_bytes(self):
+        self.alumno.emit('screenshot', {'image': _JPEG})
+        frames = _tick(self.prof)
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(frames[0]['image'], _JPEG)
+
+    def test_data_uri_antiguo_se_decodifica(self):
+        uri = 'data:image/jpeg;base64,' + base64.b64encode(_JPEG).decode()
+        self.alumno.emit('screenshot', {'image': uri})
+        self.assertEqual(server.students[self.sid].screenshot, _JPEG)
+
+    def test_screenshot_vacio_se_ignora(self):
+        self.alumno.emit('screenshot', {})
+        self.assertIsNone(server.students[self.sid].screenshot)
+        self.assertEqual(_tick(self.prof), [])
+
+    def test_heartbeat_actualiza_last_seen_sin_reenviar(self):
+        server.students[self.sid].t_visto = 0.0
+        self.alumno.emit('heartbeat', {})
+        self.assertGreater(server.students[self.sid].t_visto, 0.0)
+        server._enviar_lotes()
+        self.assertEqual(self.prof.get_received(), [])
+
+
+def _jpeg(w, h, color):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (w, h), color).save(buf, 'JPEG', quality=95)
+    return buf.getvalue()
+
+
+class TestDelta(_BaseServidor):
+    """Bloques delta: se reenvían al dashboard y se componen bajo demanda."""
+
+    def test_delta_sin_keyframe_pide_keyframe(self):
+        self.alumno.emit('screenshot_delta', {'kf': 1, 'tiles': []})
+        self.assertEqual(len(_eventos(self.alumno, 'request_keyframe')), 1)
+
+    def test_delta_con_kf_distinto_pide_keyframe(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 2})
+        self.alumno.emit('screenshot_delta', {'kf': 1, 'tiles': []})
+        self.assertEqual(len(_eventos(self.alumno, 'request_keyframe')), 1)
+
+    def test_delta_se_reenvia_y_compone(self):
+        from PIL import Image
+        self.alumno.emit('screenshot', {'image': _jpeg(128, 64, 'black'), 'kf': 1})
+        _tick(self.prof)
+        self.prof.emit('batch_ack')
+        self.alumno.emit('screenshot_delta', {'kf': 1, 'tiles': [
+            {'x': 64, 'y': 0, 'image': _jpeg(64, 64, 'white')}]})
+        frames = _tick(self.prof)
+        self.assertEqual(len(frames), 1)
+        self.assertNotIn('image', frames[0])
+        self.assertEqual(frames[0]['tiles'][0]['x'], 64)
+        st = server.students[self.sid]
+        self.assertIsNone(st.screenshot)   # pendiente de componer
+        key = st.key
+        img = Image.open(io.BytesIO(server._frame_completo(st)))
+        self.assertLess(img.getpixel((10, 10))[0], 30)
+        self.assertGreater(img.getpixel((100, 10))[0], 225)
+        # La composición solo se cachea: el keyframe base no se recodifica
+        self.assertIs(st.key, key)
+        self.assertEqual(len(st.tiles), 1)
+        self.assertIsNotNone(st.screenshot)
+
+    def test_request_students_envia_keyframe_y_bloques(self):
+        key = _jpeg(128, 64, 'black')
+        self.alumno.emit('screenshot', {'image': key, 'kf': 1})
+        self.alumno.emit('screenshot_delta', {'kf': 1, 'tiles': [
+            {'x': 0, 'y': 0, 'image': _jpeg(64, 64, 'white')}]})
+        (primero,) = _tick(self.prof); self.prof.emit('batch_ack')
+        self.prof.emit('request_students')
+        (frame,) = _tick(self.prof)
+        self.assertEqual(primero['image'], key)
+        self.assertEqual(frame['image_h'], primero['image_h'])   # ya en la caché
+        self.assertEqual([t['x'] for t in frame['tiles']], [0])
+
+    def test_bloque_mal_formado_se_ignora(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.alumno.emit('screenshot_delta', {'kf': 1, 'tiles': [
+            {'x': 'a', 'y': 0, 'image': _JPEG}, 'basura', {'x': 64, 'y': None, 'image': _JPEG},
+            {'x': 64, 'y': 0, 'image': _JPEG}]})
+        self.assertEqual(server.students[self.sid].tiles, [(64, 0, _JPEG)])
+
+
+class TestLotes(_BaseServidor):
+    """Frames agrupados en update_batch por tick; el último de cada alumno gana."""
+
+    def _tile(self, x):
+        return {'kf': 1, 'tiles': [{'x': x, 'y': 0, 'image': _jpeg(64, 64, 'white')}]}
+
+    def test_un_lote_por_tick_con_todos_los_alumnos(self):
+        otro = server.socketio.test_client(server.app)
+        otro.emit('register', {'name': 'alumno - pc02'})
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        otro.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.prof.get_received()
+        server._enviar_lotes()
+        lotes = _eventos(self.prof, 'update_batch')
+        self.assertEqual(len(lotes), 1)
+        self.assertEqual(len(lotes[0]['frames']), 2)
+        otro.disconnect()
+
+    def test_nada_se_envia_fuera_del_tick(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.assertEqual(_eventos(self.prof, 'update_batch'), [])
+
+    def test_sin_ack_se_guarda_solo_el_ultimo(self):
+        self.alumno.emit('screenshot', {'image': b'\xff\xd8uno', 'kf': 1})
+        self.assertEqual([f['image'] for f in _tick(self.prof)], [b'\xff\xd8uno'])
+        self.alumno.emit('screenshot', {'image': b'\xff\xd8dos', 'kf': 1})
+        self.alumno.emit('screenshot', {'image': b'\xff\xd8tres', 'kf': 1})
+        self.assertEqual(_tick(self.prof), [])   # lote anterior sin confirmar
+        self.prof.emit('batch_ack')
+        self.assertEqual([f['image'] for f in _tick(self.prof)], [b'\xff\xd8tres'])
+
+    def test_cola_de_carga_cuenta_solo_lo_retenido(self):
+        for _ in range(3):
+            self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.assertEqual(server._cola_salida(), 0)   # dashboard al día: sale en el tick
+        _tick(self.prof)
+        for _ in range(4):
+            self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.assertEqual(server._cola_salida(), 4)   # esperando batch_ack
+        self.prof.emit('batch_ack'); _tick(self.prof)
+        self.assertEqual(server._cola_salida(), 0)
+
+    def test_bloques_pendientes_se_acumulan(self):
+        self.alumno.emit('screenshot', {'image': _jpeg(1024, 64, 'black'), 'kf': 1})
+        _tick(self.prof); self.prof.emit('batch_ack')
+        self.alumno.emit('screenshot_delta', self._tile(0))
+        self.alumno.emit('screenshot_delta', self._tile(64))
+        frames = _tick(self.prof)
+        self.assertEqual([[t['x'] for t in f['tiles']] for f in frames], [[0, 64]])
+
+    def test_bloques_que_superan_el_frame_piden_keyframe(self):
+        key = _jpeg(128, 64, 'black')
+        self.alumno.emit('screenshot', {'image': key, 'kf': 1})
+        _tick(self.prof); self.prof.emit('batch_ack')
+        self.alumno.get_received()
+        for x in (0, 64, 0, 64, 0, 64):
+            self.alumno.emit('screenshot_delta', self._tile(x))
+        self.assertEqual(len(_eventos(self.alumno, 'request_keyframe')), 1)   # una por ESPERA_KEYFRAME
+        self.assertIs(server.students[self.sid].key, key)   # sin recodificar en el servidor
+        self.assertEqual(len(_tick(self.prof)[0]['tiles']), 6)
+
+    def test_dashboard_rapido_no_espera_al_lento(self):
+        rapido = server.socketio.test_client(server.app)
+        rapido.emit('register_teacher')
+        rapido.get_received()
+        n_rapido = n_lento = 0
+        for _ in range(3):
+            self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+            server._enviar_lotes()
+            n_rapido += len(_eventos(rapido, 'update_batch'))
+            n_lento += len(_eventos(self.prof, 'update_batch'))
+            rapido.emit('batch_ack')
+        self.assertEqual((n_rapido, n_lento), (3, 1))
+        rapido.disconnect()
+
+    def test_ack_perdido_caduca(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        _tick(self.prof)
+        next(iter(server.bandejas.values()))['t_envio'] -= server.ACK_TIMEOUT
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.assertEqual(len(_tick(self.prof)), 1)
+
+    def test_alumno_desconectado_sale_de_la_bandeja(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.alumno.disconnect()
+        self.assertEqual(_tick(self.prof), [])
+
+
+class TestMiniaturas(_BaseServidor):
+    """La rejilla recibe miniaturas; el frame completo solo el modal abierto."""
+
+    _THUMB = b'\xff\xd8mini'
+
+    def _key(self, image=_JPEG):
+        self.alumno.emit('screenshot', {'image': image, 'kf': 1, 'thumb': self._THUMB})
+
+    def test_rejilla_solo_recibe_miniatura(self):
+        self._key()
+        frame = _tick(self.prof)[0]
+        self.assertEqual(frame['thumb'], self._THUMB)
+        self.assertNotIn('image', frame)
+
+    def test_modal_recibe_frame_completo(self):
+        self._key()
+        self.prof.emit('detail_student', {'sid': self.sid})
+        frame = _tick(self.prof)[0]
+        self.assertEqual((frame['thumb'], frame['image']), (self._THUMB, _JPEG))
+
+    def test_al_abrir_el_modal_se_envia_el_frame_actual(self):
+        self._key()
+        _tick(self.prof); self.prof.emit('batch_ack')
+        self.prof.emit('detail_student', {'sid': self.sid})
+        self.assertEqual(_tick(self.prof)[0]['image'], _JPEG)
+
+    def test_bloques_solo_al_modal(self):
+        self.alumno.emit('screenshot', {'image': _jpeg(1024, 64, 'black'), 'kf': 1, 'thumb': self._THUMB})
+        otro = server.socketio.test_client(server.app)
+        otro.emit('register_teacher')
+        otro.emit('detail_student', {'sid': self.sid})
+        _tick(self.prof); _tick(otro)
+        self.prof.emit('batch_ack'); otro.emit('batch_ack')
+        self.alumno.emit('screenshot_delta', {'kf': 1, 'thumb': self._THUMB, 'tiles': [
+            {'x': 0, 'y': 0, 'image': _jpeg(64, 64, 'white')}]})
+        self.assertNotIn('tiles', _tick(self.prof)[0])
+        self.assertEqual(len(_tick(otro)[0]['tiles']), 1)
+        otro.disconnect()
+
+    def test_lista_inicial_con_miniaturas(self):
+        self._key()
+        _tick(self.prof); self.prof.emit('batch_ack')
+        self.prof.emit('request_students')
+        frame = _tick(self.prof)[0]
+        # El dashboard ya tenía la miniatura: solo viaja su hash
+        self.assertEqual(frame['thumb_h'], server._almacen.hash(self._THUMB))
+        self.assertNotIn('thumb', frame)
+        self.assertNotIn('image', frame)
+
+
+class TestSincronizacion(_BaseServidor):
+    """request_students: metadatos primero, imágenes por páginas y cursor por seq."""
+
+    def setUp(self):
+        super().setUp()
+        self.otro = server.socketio.test_client(server.app)
+        self.otro.emit('register', {'name': 'alumno - pc02'})
+        self.sid2 = [s for s in server.students if s != self.sid][0]
+        for c in (self.alumno, self.otro):
+            c.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': _jpeg(32, 18, 'red')})
+        self.cursor = self._sincronizar()
+
+    def tearDown(self):
+        if self.otro.is_connected():
+            self.otro.disconnect()
+        super().tearDown()
+
+    def _sincronizar(self):
+        """Vacía la bandeja (con ack) y devuelve el cursor del último lote."""
+        server._enviar_lotes()
+        lotes = _eventos(self.prof, 'update_batch')
+        self.prof.emit('batch_ack')
+        return lotes[-1]['cursor']
+
+    def _pedir(self, **cursor):
+        self.prof.emit('request_students', cursor)
+        return _eventos(self.prof, 'full_student_list')[0]
+
+    def test_lista_solo_con_metadatos(self):
+        lista = self._pedir()
+        self.assertEqual(lista['epoca'], server._EPOCA)
+        self.assertEqual({a['sid'] for a in lista['alumnos']}, {self.sid, self.sid2})
+        for a in lista['alumnos']:
+            self.assertNotIn('thumb', a)
+            self.assertNotIn('image', a)
+
+    def test_imagenes_por_paginas_con_visibles_primero(self):
+        self.prof.emit('visible_students', {'sids': [self.sid2]})
+        self._pedir()
+        with patch.object(server, 'PAGINA_SYNC', 1):
+            server._enviar_lotes()
+            lote = _eventos(self.prof, 'update_batch')[0]
+            self.assertEqual([f['sid'] for f in lote['frames']], [self.sid2])
+            self.assertNotIn('cursor', lote)   # aún queda sincronización pendiente
+            self.prof.emit('batch_ack')
+            server._enviar_lotes()
+            lote = _eventos(self.prof, 'update_batch')[0]
+            self.assertEqual([f['sid'] for f in lote['frames']], [self.sid])
+            self.assertEqual(lote['cursor'], server.students[self.sid2].seq)
+
+    def test_reconexion_solo_recibe_lo_cambiado(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 2, 'thumb': _jpeg(32, 18, 'blue')})
+        self._sincronizar()   # el dashboard anterior se perdió este lote
+        self._pedir(epoca=server._EPOCA, desde=self.cursor)
+        self.assertEqual([f['sid'] for f in _tick(self.prof)], [self.sid])
+
+    def test_al_dia_no_recibe_imagenes(self):
+        self._pedir(epoca=server._EPOCA, desde=self.cursor)
+        self.assertEqual(_tick(self.prof), [])
+
+    def test_otra_epoca_lo_reenvia_todo(self):
+        self._pedir(epoca='otra', desde=self.cursor)
+        self.assertEqual({f['sid'] for f in _tick(self.prof)}, {self.sid, self.sid2})
+
+
+class TestCapturaHTTP(_BaseServidor):
+    """GET /api/students/<sid>/screenshot con ETag por número de secuencia."""
+
+    def setUp(self):
+        super().setUp()
+        self.http = server.app.test_client()
+        self.url = f'/api/students/{self.sid}/screenshot'
+
+    def test_sin_captura_404(self):
+        self.assertEqual(self.http.get(self.url).status_code, 404)
+        self.assertEqual(self.http.get('/api/students/nadie/screenshot').status_code, 404)
+
+    def test_sirve_el_frame_con_etag(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        resp = self.http.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, _JPEG)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertTrue(resp.headers['ETag'])
+
+    def test_304_si_no_ha_cambiado(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        etag = self.http.get(self.url).headers['ETag']
+        resp = self.http.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+    def test_frame_nuevo_cambia_el_etag(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        etag = self.http.get(self.url).headers['ETag']
+        self.alumno.emit('heartbeat', {})
+        self.assertEqual(self.http.get(self.url, headers={'If-None-Match': etag}).status_code, 304)
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.assertEqual(self.http.get(self.url, headers={'If-None-Match': etag}).status_code, 200)
+
+    def test_miniatura_y_tipo_webp(self):
+        webp = b'RIFF\x00\x00\x00\x00WEBPVP8 '
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': webp})
+        resp = self.http.get(self.url + '?thumb=1')
+        self.assertEqual((resp.data, resp.mimetype), (webp, 'image/webp'))
+        self.assertNotEqual(resp.headers['ETag'], self.http.get(self.url).headers['ETag'])
+
+    def test_listado_incluye_seq(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.assertGreater(self.http.get('/api/students').get_json()[0]['seq'], 0)
+
+
+class TestMemoria(_BaseServidor):
+    """Registro Student: bytes retenidos por alumno y límite de memoria."""
+
+    _THUMB = b'\xff\xd8thumb\xff\xd9'
+
+    def setUp(self):
+        super().setUp()
+        self.otro = server.socketio.test_client(server.app)
+        self.otro.emit('register', {'name': 'alumno - pc02'})
+        self.sid2 = [s for s in server.students if s != self.sid][0]
+
+    def tearDown(self):
+        if self.otro.is_connected():
+            self.otro.disconnect()
+        super().tearDown()
+
+    # Frames distintos por alumno (los idénticos se comparten: TestDeduplicacion)
+    _J2, _T2 = _JPEG + b'\x00', _THUMB + b'\x00'
+    _TOTAL = 2 * (len(_JPEG) + len(_THUMB)) + 2
+
+    def _frames(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': self._THUMB})
+        self.otro.emit('screenshot', {'image': self._J2, 'kf': 1, 'thumb': self._T2})
+
+    def test_registro_sin_dict(self):
+        st = server.students[self.sid]
+        self.assertFalse(hasattr(st, '__dict__'))
+        self.assertRegex(st.last_seen, r'^\d\d:\d\d:\d\d$')
+
+    def test_contabiliza_bytes_y_los_libera_al_desconectar(self):
+        self._frames()
+        self.assertEqual(server._memoria['total'], self._TOTAL)
+        self.otro.disconnect()
+        self.assertEqual(server._memoria['total'], len(_JPEG) + len(self._THUMB))
+        self.assertEqual(len(server._almacen.frames), 2)
+
+    def test_limite_desaloja_el_frame_mas_antiguo(self):
+        with patch.object(server, 'LIMITE_MEMORIA', self._TOTAL - 1):
+            self._frames()
+        viejo, nuevo = server.students[self.sid], server.students[self.sid2]
+        self.assertIsNone(viejo.key)
+        self.assertEqual(viejo.thumb, self._THUMB)   # la rejilla no se queda sin imagen
+        self.assertEqual(nuevo.key, self._J2)
+        self.assertEqual(server._memoria['desalojos'], 1)
+        memoria = server.app.test_client().get('/api/memory').get_json()
+        self.assertEqual(memoria['total'], self._TOTAL - len(_JPEG))
+        # Sin base, el siguiente delta pide keyframe (uno por ESPERA_KEYFRAME)
+        for _ in range(3):
+            self.alumno.emit('screenshot_delta', {'kf': 1, 'tiles': []})
+        self.assertEqual(len(_eventos(self.alumno, 'request_keyframe')), 1)
+
+    def test_no_desaloja_si_las_miniaturas_ya_superan_el_limite(self):
+        with patch.object(server, 'LIMITE_MEMORIA', len(self._THUMB)):
+            self._frames()
+        self.assertEqual(server.students[self.sid].key, _JPEG)
+        self.assertEqual(server.students[self.sid2].key, self._J2)
+        self.assertEqual(server._memoria['desalojos'], 0)
+
+    def test_el_alumno_del_modal_se_desaloja_el_ultimo(self):
+        self.prof.emit('detail_student', {'sid': self.sid})
+        with patch.object(server, 'LIMITE_MEMORIA', self._TOTAL - 1):
+            self._frames()
+        self.assertEqual(server.students[self.sid].key, _JPEG)
+        self.assertIsNone(server.students[self.sid2].key)
+
+    def test_modal_de_alumno_desalojado_pide_keyframe(self):
+        with patch.object(server, 'LIMITE_MEMORIA', 2 * len(self._THUMB) + 2):
+            self._frames()
+        self.alumno.get_received()
+        self.prof.emit('detail_student', {'sid': self.sid})
+        self.assertEqual(len(_eventos(self.alumno, 'request_keyframe')), 1)
+
+
+class TestDeduplicacion(_BaseServidor):
+    """Frames idénticos entre alumnos: una copia en memoria y un envío por dashboard."""
+
+    _THUMB = b'\xff\xd8diapositiva\xff\xd9'
+
+    def setUp(self):
+        super().setUp()
+        self.otros = [server.socketio.test_client(server.app) for _ in range(2)]
+        for i, c in enumerate(self.otros):
+            c.emit('register', {'name': f'alumno - pc1{i}'})
+
+    def tearDown(self):
+        for c in self.otros:
+            if c.is_connected():
+                c.disconnect()
+        super().tearDown()
+
+    def _misma_pantalla(self):
+        for c in [self.alumno] + self.otros:
+            c.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': self._THUMB})
+
+    def test_una_copia_compartida(self):
+        self._misma_pantalla()
+        sts = list(server.students.values())
+        self.assertTrue(all(st.thumb is sts[0].thumb and st.key is sts[0].key for st in sts))
+        self.assertEqual(server._memoria['total'], len(_JPEG) + len(self._THUMB))
+        for c in self.otros:
+            c.disconnect()
+        self.assertEqual(server._memoria['total'], len(_JPEG) + len(self._THUMB))
+        self.alumno.disconnect()
+        self.assertEqual((server._memoria['total'], server._almacen.frames), (0, {}))
+
+    def test_bytes_una_vez_y_luego_hash(self):
+        self._misma_pantalla()
+        frames = _tick(self.prof)
+        h = server._almacen.hash(self._THUMB)
+        self.assertEqual([f['thumb_h'] for f in frames], [h] * 3)
+        self.assertEqual(sum('thumb' in f for f in frames), 1)
+        self.prof.emit('batch_ack')
+        # Un dashboard nuevo no tiene la imagen: la recibe con bytes
+        otro = server.socketio.test_client(server.app)
+        otro.emit('register_teacher')
+        self.alumno.emit('screenshot_delta', {'kf': 1, 'thumb': self._THUMB, 'tiles': []})
+        self.assertNotIn('thumb', _tick(self.prof)[0])
+        self.assertEqual(_tick(otro)[0]['thumb'], self._THUMB)
+        otro.disconnect()
+
+    def test_lru_replica_la_cache_del_dashboard(self):
+        with patch.object(server, 'CACHE_IMAGENES', 2):
+            for i in range(3):
+                self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': b'thumb%d' % i})
+                _tick(self.prof); self.prof.emit('batch_ack')
+            self.assertEqual(list(next(iter(server.bandejas.values()))['conocidos']),
+                             [server._almacen.hash(b'thumb1'), server._almacen.hash(b'thumb2')])
+
+    def test_image_miss_reenvia_con_bytes(self):
+        self._misma_pantalla()
+        _tick(self.prof); self.prof.emit('batch_ack')
+        self.prof.emit('image_miss', {'sids': [self.sid]})
+        frame = _tick(self.prof)[0]
+        self.assertEqual((frame['sid'], frame['thumb']), (self.sid, self._THUMB))
+
+    def test_image_miss_mal_formado_se_ignora(self):
+        for data in ('sids', ['x'], {'sids': 'abc'}, {'sids': [['x'], 3]}):
+            self.prof.emit('image_miss', data)
+        self.assertEqual(next(iter(server.bandejas.values()))['sync'], [])
+
+
+class TestMosaico(_BaseServidor):
+    """Modo mosaico: una imagen compuesta por el servidor para toda la rejilla."""
+
+    def setUp(self):
+        super().setUp()
+        self.otro = server.socketio.test_client(server.app)
+        self.otro.emit('register', {'name': 'alumno - pc02'})
+        self.sid2 = [s for s in server.students if s != self.sid][0]
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': _jpeg(320, 180, 'red')})
+        self.otro.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': _jpeg(320, 180, 'blue')})
+        self.prof.emit('mosaic_mode', {'activo': True, 'columnas': 2, 'ancho': 160,
+                                       'orden': [self.sid, self.sid2]})
+
+    def tearDown(self):
+        if self.otro.is_connected():
+            self.otro.disconnect()
+        super().tearDown()
+
+    def _lote(self):
+        server._enviar_lotes()
+        lote = _eventos(self.prof, 'update_batch')[0]
+        self.prof.emit('batch_ack')
+        return lote
+
+    def test_mosaico_entero_con_mapa_de_celdas(self):
+        from PIL import Image
+        lote = self._lote()
+        self.assertTrue(all('thumb' not in f and 'thumb_h' not in f for f in lote['frames']))
+        m = lote['mosaico']
+        self.assertEqual((m['width'], m['height']), (320, 90))
+        self.assertEqual(m['celdas'], {self.sid: [0, 0, 160, 90], self.sid2: [160, 0, 160, 90]})
+        img = Image.open(io.BytesIO(m['image'])).convert('RGB')
+        self.assertGreater(img.getpixel((80, 45))[0], 200)    # rojo
+        self.assertGreater(img.getpixel((240, 45))[2], 200)   # azul
+
+    def test_solo_se_recodifican_las_celdas_sucias(self):
+        from PIL import Image
+        self._lote()
+        self.otro.emit('screenshot_delta', {'kf': 1, 'tiles': [], 'thumb': _jpeg(320, 180, 'green')})
+        m = self._lote()['mosaico']
+        self.assertNotIn('image', m)
+        self.assertEqual(m['sids'], [self.sid2])
+        (tile,) = m['tiles']
+        self.assertEqual((tile['x'], tile['y']), (160, 0))
+        img = Image.open(io.BytesIO(tile['image'])).convert('RGB')
+        self.assertEqual(img.size, (160, 90))
+        self.assertGreater(img.getpixel((80, 45))[1], 100)   # verde
+
+    def test_demasiadas_celdas_sucias_envia_el_mosaico_entero(self):
+        self._lote()
+        with patch.object(server, 'MOSAICO_FRACCION_PARCHES', 0.5):   # 2 de 2 celdas
+            for c in (self.alumno, self.otro):
+                c.emit('screenshot_delta', {'kf': 1, 'tiles': [], 'thumb': _jpeg(320, 180, 'white')})
+            self.assertIn('image', self._lote()['mosaico'])
+
+    def test_alumno_que_llega_despues_se_anade_al_final(self):
+        from PIL import Image
+        self._lote()
+        nuevo = server.socketio.test_client(server.app)
+        self.addCleanup(nuevo.disconnect)
+        nuevo.emit('register', {'name': 'alumno - pc03'})
+        sid3 = [s for s in server.students if s not in (self.sid, self.sid2)][0]
+        nuevo.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': _jpeg(320, 180, 'green')})
+        m = self._lote()['mosaico']
+        self.assertEqual((m['width'], m['height']), (320, 180))
+        self.assertEqual(m['celdas'][sid3], [0, 90, 160, 90])
+        img = Image.open(io.BytesIO(m['image'])).convert('RGB')
+        self.assertGreater(img.getpixel((80, 135))[1], 100)   # verde
+        self.assertGreater(img.getpixel((80, 45))[0], 200)    # las demás siguen ahí
+
+    def test_se_compone_fuera_del_loop(self):
+        hilos = []
+        pintar = server._pintar_mosaico
+        with patch.object(server, '_pintar_mosaico',
+                          lambda *a: hilos.append(threading.get_ident()) or pintar(*a)):
+            self.assertIn('image', self._lote()['mosaico'])
+        self.assertNotEqual(hilos, [threading.get_ident()])
+
+    def test_el_modal_sigue_recibiendo_el_frame_completo(self):
+        self._lote()
+        self.prof.emit('detail_student', {'sid': self.sid})
+        (frame,) = self._lote()['frames']
+        self.assertEqual(frame['image'], _JPEG)
+
+    def test_al_desactivar_vuelven_las_miniaturas(self):
+        self._lote()
+        self.prof.emit('mosaic_mode', {'activo': False})
+        lote = self._lote()
+        self.assertNotIn('mosaico', lote)
+        self.assertEqual({f['sid'] for f in lote['frames'] if 'thumb_h' in f}, {self.sid, self.sid2})
+
+
+@unittest.skipIf(server is None, 'dependencias del servidor no instaladas')
+class TestArchivo(unittest.TestCase):
+    """_Archivo: segmentos mmap append-only con índice temporal."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def _archivo(self, **kw):
+        a = server._Archivo(self.dir, **kw)
+        self.addCleanup(a.cerrar)
+        return a
+
+    def _agregar(self, a, *args):
+        id_ = a.agregar(*args)
+        a.esperar()   # el hilo de fondo reserva el siguiente segmento
+        return id_
+
+    def test_rango_y_lectura(self):
+        a = self._archivo(retencion=3600)
+        t = 1_000_000.0
+        ids = [a.agregar('pc01', t + i, 'thumb', b'frame%d' % i) for i in range(5)]
+        a.agregar('pc02', t + 2, 'key', b'otro')
+        self.assertEqual([f[1] for f in a.rango('pc01', t + 1, t + 3, 100)], ids[1:4])
+        self.assertEqual([f[1] for f in a.rango('pc01', 0, float('inf'), 2)], ids[3:])
+        self.assertEqual(a.leer('pc01', ids[2]), b'frame2')
+        self.assertIsNone(a.leer('pc02', ids[2]))   # frame de otro alumno
+        self.assertIsNone(a.leer('pc01', '1-x'))
+
+    def test_reconstruye_indice_al_reabrir(self):
+        a = self._archivo(retencion=1e12, tam=200)
+        ids = [self._agregar(a, 'pc01', 1000.0 + i, 'key', bytes([i]) * 50) for i in range(6)]
+        self.assertGreater(len(os.listdir(self.dir)), 1)   # ha rotado por tamaño
+        b = self._archivo(retencion=1e12, tam=200)
+        self.assertEqual([f[1] for f in b.rango('pc01', 0, float('inf'), 100)], ids)
+        self.assertEqual(b.leer('pc01', ids[4]), bytes([4]) * 50)
+
+    def test_retencion_borra_segmentos_viejos(self):
+        a = self._archivo(retencion=60, duracion=10)
+        viejo = self._agregar(a, 'pc01', 1000.0, 'thumb', b'viejo')
+        nuevo = self._agregar(a, 'pc01', 1100.0, 'thumb', b'nuevo')
+        self.assertEqual(len(a.segmentos), 1)
+        self.assertEqual(len(os.listdir(self.dir)), 2)   # el actual y el ya reservado
+        self.assertIsNone(a.leer('pc01', viejo))
+        self.assertEqual([f[1] for f in a.rango('pc01', 0, float('inf'), 100)], [nuevo])
+
+    def test_rotar_no_toca_el_disco_en_el_event_loop(self):
+        a = self._archivo(retencion=1e12, tam=200)
+        a.esperar()
+        hilos = []
+        reservar, truncar = os.posix_fallocate, os.truncate
+        with patch.object(server.os, 'posix_fallocate',
+                          lambda *x: hilos.append(threading.get_ident()) or reservar(*x)), \
+             patch.object(server.os, 'truncate',
+                          lambda *x: hilos.append(threading.get_ident()) or truncar(*x)):
+            ids = [self._agregar(a, 'pc01', 1000.0 + i, 'key', bytes([i]) * 50) for i in range(4)]
+        self.assertTrue(hilos)
+        self.assertNotIn(threading.get_ident(), hilos)
+        self.assertEqual([a.leer('pc01', i) for i in ids], [bytes([i]) * 50 for i in range(4)])
+
+    def test_sin_segmento_reservado_se_queda_en_memoria(self):
+        a = self._archivo(retencion=1e12, tam=200)
+        a._siguiente = None   # el hilo de fondo aún no ha reservado
+        self.assertIsNone(a.agregar('pc01', 1000.0, 'key', b'x'))
+
+
+class TestIndiceIconos(_BaseServidor):
+    """_IndiceIconos: índice de .desktop persistente y LRU de data URIs."""
+
+    def setUp(self):
+        super().setUp()
+        from PIL import Image
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.apps = os.path.join(self.dir, 'applications')
+        os.mkdir(self.apps)
+        self.cache = os.path.join(self.dir, 'cache', 'iconos.json')
+        self.png = os.path.join(self.dir, 'editor.png')
+        Image.new('RGBA', (16, 16), (200, 0, 0, 255)).save(self.png)
+        self._desktop('org.editor.desktop', 'StartupWMClass=Editor\nIcon=' + self.png)
+        self._desktop('terminal.desktop', 'Icon=' + self.png)
+
+    def _desktop(self, nombre, cuerpo):
+        with open(os.path.join(self.apps, nombre), 'w') as f:
+            f.write('[Desktop Entry]\nType=Application\n' + cuerpo + '\n')
+
+    def _indice(self):
+        return server._IndiceIconos(self.cache, [self.apps, os.path.join(self.dir, 'no-existe')])
+
+    def test_segunda_vez_sin_tocar_el_disco(self):
+        idx = self._indice()
+        uri = idx.icono(['editor', 'Editor'])
+        self.assertTrue(uri.startswith('data:image/png;base64,'))
+        self.assertEqual(idx.icono(['terminal', 'Terminal']), uri)   # por nombre del .desktop
+        self.assertEqual(idx.lecturas, 1)
+        with patch.object(server, '_find_icon_path') as ruta, \
+             patch.object(server, '_icon_to_b64') as codificar, \
+             patch.object(server.os, 'listdir') as listdir:
+            self.assertEqual(idx.icono(['editor', 'Editor']), uri)
+        ruta.assert_not_called()
+        codificar.assert_not_called()
+        listdir.assert_not_called()
+
+    def test_persiste_entre_arranques(self):
+        idx = self._indice()
+        uri = idx.icono(['editor', 'Editor'])
+        idx.guardar()
+        otro = self._indice()
+        with patch.object(server, '_find_icon_path') as ruta:
+            self.assertEqual(otro.icono(['editor', 'Editor']), uri)
+        ruta.assert_not_called()
+        self.assertEqual(otro.lecturas, 0)
+
+    def test_se_serializa_con_el_lock_tomado(self):
+        idx = self._indice()
+        idx.icono(['editor', 'Editor'])
+        dumps = server.json.dumps
+        bloqueado = []
+
+        def serializar(obj):
+            bloqueado.append(idx._lock.locked())
+            return dumps(obj)
+        with patch.object(server.json, 'dumps', side_effect=serializar):
+            idx.guardar()
+        self.assertEqual(bloqueado, [True])
+
+    def test_mtime_invalida_el_directorio(self):
+        idx = self._indice()
+        idx.icono(['editor', 'Editor'])
+        idx.guardar()
+        self._desktop('nuevo.desktop', 'StartupWMClass=Nuevo\nIcon=nuevo-icono')
+        mtime = os.stat(self.apps).st_mtime + 10
+        os.utime(self.apps, (mtime, mtime))
+        otro = self._indice()
+        with patch.object(server, '_find_icon_path', return_value=None) as ruta:
+            self.assertIsNone(otro.icono(['nuevo', 'Nuevo']))
+        ruta.assert_called_once_with('nuevo-icono')
+        self.assertEqual(otro.lecturas, 1)
+
+    def test_lru_acotado(self):
+        idx = self._indice()
+        with patch.object(server, 'MAX_ICONOS', 2), \
+             patch.object(server, '_find_icon_path', side_effect=lambda n: '/' + n), \
+             patch.object(server, '_icon_to_b64', side_effect=lambda r: 'data:' + r):
+            for clase in ('a', 'b', 'c', 'b'):
+                idx.icono([clase])
+        self.assertEqual(list(idx._uris), ['/c', '/b'])
+
+
+class TestHistorial(_BaseServidor):
+    """Historial por alumno: anillo en memoria, archivo en disco y API de consulta."""
+
+    _THUMB = b'\xff\xd8thumb\xff\xd9'
+
+    def setUp(self):
+        super().setUp()
+        self.http = server.app.test_client()
+        self.url = f'/api/students/{self.sid}/history'
+
+    def _lista(self, **params):
+        return self.http.get(self.url, query_string=params).get_json()
+
+    def _con_disco(self):
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        server._historial['archivo'] = server._Archivo(d)
+        self.addCleanup(server._historial['archivo'].cerrar)
+
+    def test_archiva_keyframe_y_miniatura(self):
+        self._con_disco()
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': self._THUMB})
+        frames = self._lista()
+        self.assertEqual([f['tipo'] for f in frames], ['key', 'thumb'])
+        resp = self.http.get(f"{self.url}/{frames[0]['id']}")
+        self.assertEqual((resp.data, resp.mimetype), (_JPEG, 'image/jpeg'))
+        # Fuera del anillo en memoria se lee del disco
+        server.students[self.sid].historial.clear()
+        self.assertEqual(self.http.get(f"{self.url}/{frames[1]['id']}").data, self._THUMB)
+
+    def test_intervalo_por_tipo(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1, 'thumb': self._THUMB})
+        with patch.dict(server.HISTORIAL_INTERVALO, thumb=0.0):
+            self.alumno.emit('screenshot_delta', {'kf': 1, 'thumb': self._THUMB, 'tiles': []})
+        self.alumno.emit('screenshot_delta', {'kf': 1, 'thumb': self._THUMB, 'tiles': []})
+        self.assertEqual([f['tipo'] for f in self._lista()], ['key', 'thumb', 'thumb'])
+
+    def test_rango_temporal_sin_disco(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        t = self._lista()[0]['t']
+        self.assertEqual(len(self._lista(desde=t + 1)), 0)
+        self.assertEqual(len(self._lista(hasta=t)), 1)
+        self.assertEqual(self.http.get(f"{self.url}/{self._lista()[0]['id']}").data, _JPEG)
+        self.assertEqual(self.http.get(f'{self.url}/m999-key').status_code, 404)
+        self.assertEqual(self.http.get(self.url + '?desde=x').status_code, 400)
+
+    def test_alumnos_con_el_mismo_nombre_no_comparten_historial(self):
+        self._con_disco()
+        gemelo = server.socketio.test_client(server.app)
+        self.addCleanup(gemelo.disconnect)
+        gemelo.emit('register', {'name': 'alumno - pc01', 'id': 'b2'})
+        sid2 = [s for s in server.students if s != self.sid][0]
+        self.assertNotEqual(server.students[sid2].clave, server.students[self.sid].clave)
+        self.assertEqual(server._clave_historial('alumno - pc01', None), 'alumno - pc01 ~2')
+        gemelo.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.assertEqual(self._lista(), [])
+        (frame,) = self.http.get(f'/api/students/{sid2}/history').get_json()
+        server.students[sid2].historial.clear()   # que se lea del disco
+        self.assertEqual(self.http.get(f"{self.url}/{frame['id']}").status_code, 404)
+        self.assertEqual(self.http.get(f"/api/students/{sid2}/history/{frame['id']}").data, _JPEG)
+
+    def test_anillo_cuenta_en_memoria(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1})
+        self.alumno.emit('screenshot', {'image': _JPEG + b'2', 'kf': 2})
+        st = server.students[self.sid]
+        # El keyframe archivado ya no es el actual: ambos cuentan
+        self.assertEqual(server._memoria['total'], 2 * len(_JPEG) + 1)
+        st.desalojar()
+        self.assertEqual(len(st.historial), 0)
+        self.assertEqual(server._memoria['total'], 0)
+
+
+class TestVisibilidad(_BaseServidor):
+    """Los alumnos que ningún dashboard ve capturan más despacio o se pausan."""
+
+    def _modos(self):
+        return [d['modo'] for d in _eventos(self.alumno, 'capture_mode')]
+
+    def test_tarjeta_fuera_de_pantalla_ralentiza(self):
+        self.prof.emit('visible_students', {'sids': [], 'oculta': False})
+        self.assertEqual(self._modos(), ['lento'])
+
+    def test_pestana_oculta_pausa(self):
+        self.prof.emit('visible_students', {'sids': [], 'oculta': True})
+        self.assertEqual(self._modos(), ['pausa'])
+
+    def test_tarjeta_visible_reanuda(self):
+        self.prof.emit('visible_students', {'sids': [], 'oculta': True})
+        self.prof.emit('visible_students', {'sids': [self.sid], 'oculta': False})
+        self.assertEqual(self._modos(), ['pausa', 'normal'])
+
+    def test_sin_cambio_de_modo_no_se_notifica(self):
+        self.prof.emit('visible_students', {'sids': [self.sid], 'oculta': False})
+        self.assertEqual(self._modos(), [])
+
+    def test_basta_un_dashboard_que_lo_vea(self):
+        otro = server.socketio.test_client(server.app)
+        otro.emit('register_teacher')
+        self.prof.emit('visible_students', {'sids': [], 'oculta': True})
+        self.assertEqual(self._modos(), [])
+        otro.disconnect()
+        self.assertEqual(self._modos(), ['pausa'])
+
+    def test_sin_dashboards_pausa(self):
+        self.prof.disconnect()
+        self.assertEqual(self._modos(), ['pausa'])
+
+
+class TestMulticastProfesor(_BaseServidor):
+    """La pantalla del profesor sale una vez al grupo multicast (en loopback)."""
+
+    GRUPO = '239.255.42.97'
+
+    def setUp(self):
+        super().setUp()
+        self.rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.rx.close)
+        self.rx.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rx.bind(('', 0))
+        self.rx.settimeout(2)
+        try:
+            self.rx.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                               socket.inet_aton(self.GRUPO) + socket.inet_aton('127.0.0.1'))
+        except OSError as e:
+            self.skipTest(f'sin multicast en loopback: {e}')
+        self.em = server._EmisorMulticast(self.GRUPO, self.rx.getsockname()[1], interfaz='127.0.0.1')
+        server._multicast['emisor'] = self.em
+        self.addCleanup(server._multicast.update, emisor=None, activo=False)
+        self.addCleanup(server._multicast['socketio'].clear)
+
+    def _recibir_frame(self):
+        cab = server._EmisorMulticast.CABECERA
+        trozos = {}
+        while True:
+            d = self.rx.recv(65536)
+            magia, sesion, frame, idx, total, tipo = cab.unpack_from(d)
+            trozos[idx] = d[cab.size:]
+            if len(trozos) == total:
+                return sesion, frame, b''.join(trozos[i] for i in range(total))
+
+    def test_frame_va_al_grupo_y_solo_se_anuncia(self):
+        datos = os.urandom(5000)
+        self.prof.emit('teacher_screenshot', {'image': datos})
+        self.assertEqual(self._recibir_frame(), (self.em.sesion, 1, datos))
+        recibido = _eventos(self.alumno, 'teacher_screen')
+        self.assertEqual(len(recibido), 1)
+        self.assertNotIn('image', recibido[0])
+        self.assertEqual(recibido[0]['multicast']['sesion'], self.em.sesion)
+
+    def test_parches_van_empaquetados(self):
+        tiles = [(64, 0, b'abc'), (0, 128, b'de')]
+        server._difundir_profesor('parche', tiles)
+        d = self.rx.recv(65536)
+        cab = server._EmisorMulticast.CABECERA
+        self.assertEqual(cab.unpack_from(d)[-1], 1)
+        self.assertEqual(d[cab.size:], server._empaquetar_parches(tiles))
+        self.assertIsNone(self.em.ultimo)   # el último keyframe ya no es la pantalla actual
+
+    def test_frame_vacio_no_se_difunde(self):
+        self.prof.emit('teacher_screenshot', {})
+        self.prof.emit('teacher_screenshot', {'image': None})
+        self.assertEqual(self.em.frame, 0)
+        self.assertEqual(_eventos(self.alumno, 'teacher_screen'), [])
+
+    def test_anuncio_no_se_repite_en_cada_frame(self):
+        self.prof.emit('teacher_screenshot', {'image': _JPEG})
+        self.prof.emit('teacher_screenshot', {'image': _JPEG})
+        self.assertEqual(len(_eventos(self.alumno, 'teacher_screen')), 1)
+        self.assertEqual(self.em.frame, 2)
+
+    def test_keyframe_por_socketio(self):
+        self.prof.emit('teacher_screenshot', {'image': _JPEG})
+        self.alumno.get_received()
+        self.alumno.emit('teacher_keyframe', {'sesion': self.em.sesion})
+        kf = _eventos(self.alumno, 'teacher_screen')
+        self.assertEqual(kf[0]['image'], _JPEG)
+        self.assertEqual(kf[0]['frame'], 1)
+        self.alumno.emit('teacher_keyframe', {'sesion': self.em.sesion + 1})
+        self.assertEqual(_eventos(self.alumno, 'teacher_screen'), [])
+
+    def test_dejar_de_compartir_cierra_la_sesion(self):
+        self.prof.emit('teacher_screenshot', {'image': _JPEG})
+        sesion = self.em.sesion
+        self.alumno.get_received()
+        self.prof.emit('teacher_screenshot', {'activa': False})
+        self.assertFalse(_eventos(self.alumno, 'teacher_screen')[0]['activa'])
+        self.assertNotEqual(self.em.sesion, sesion)
+        self.assertIsNone(self.em.ultimo)
+
+    def test_compartir_con_algunos_no_va_al_grupo(self):
+        self.rx.settimeout(0.2)
+        self.prof.emit('teacher_screenshot', {'image': _JPEG, 'sids': [self.sid]})
+        self.assertEqual(_eventos(self.alumno, 'teacher_screen')[0]['image'], _JPEG)
+        self.assertRaises(socket.timeout, self.rx.recv, 65536)
+        self.assertEqual(self.em.frame, 0)
+
+    def test_fallback_pasa_el_alumno_a_socketio(self):
+        self.prof.emit('teacher_screenshot', {'image': _JPEG})
+        self.alumno.get_received()
+        self.alumno.emit('teacher_keyframe', {'sesion': self.em.sesion, 'fallback': True})
+        kf = _eventos(self.alumno, 'teacher_screen')
+        self.assertEqual(kf[0]['image'], _JPEG)
+        self.assertNotIn('multicast', kf[0])
+        self.prof.emit('teacher_screenshot', {'image': b'otro'})
+        self.assertEqual([m.get('image') for m in _eventos(self.alumno, 'teacher_screen')], [b'otro'])
+        self.assertEqual(self._recibir_frame()[1:], (1, _JPEG))   # el resto sigue por el grupo
+        self.prof.emit('teacher_screenshot', {'activa': False})
+        self.assertEqual(server._multicast['socketio'], set())
+
+    def test_sin_multicast_va_por_socketio(self):
+        server._multicast['emisor'] = None
+        self.prof.emit('teacher_screenshot', {'image': _JPEG})
+        self.assertEqual(_eventos(self.alumno, 'teacher_screen')[0]['image'], _JPEG)
+
+
+class TestCambiosProfesor(_BaseServidor):
+    """La captura del profesor solo envía lo que cambia, al ritmo del movimiento."""
+
+    def setUp(self):
+        super().setUp()
+        from PIL import Image
+        self.Image = Image
+        self.c = server._CambiosProfesor()
+        self.base = Image.new('RGB', (640, 360), (30, 40, 50))
+        self.assertEqual(self.c.codificar(self.base, ahora=0.0)[0], 'key')
+
+    def _con_cuadro(self, x, y, lado=10):
+        img = self.base.copy()
+        img.paste((255, 255, 255), (x, y, x + lado, y + lado))
+        return img
+
+    def test_pantalla_quieta_no_envia_y_baja_el_ritmo(self):
+        self.c.fps = server.FPS_MAX_PROFESOR
+        for t in range(1, 10):
+            self.assertIsNone(self.c.codificar(self.base.copy(), ahora=float(t)))
+        self.assertEqual(self.c.fps, server.FPS_MIN_PROFESOR)
+
+    def test_cambio_pequeno_envia_parche_y_sube_el_ritmo(self):
+        tipo, tiles = self.c.codificar(self._con_cuadro(100, 70), ahora=1.0)
+        self.assertEqual(tipo, 'parche')
+        self.assertEqual([(x, y) for x, y, _ in tiles], [(64, 64)])
+        self.assertEqual(self.Image.open(io.BytesIO(tiles[0][2])).size, (64, 64))
+        self.assertGreater(self.c.fps, server.FPS_MIN_PROFESOR)
+
+    def test_teselas_contiguas_forman_una_franja(self):
+        tipo, tiles = self.c.codificar(self._con_cuadro(120, 0, lado=20), ahora=1.0)
+        self.assertEqual(tipo, 'parche')
+        self.assertEqual(self.Image.open(io.BytesIO(tiles[0][2])).size, (128, 64))
+
+    def test_mucho_cambio_o_keepalive_envian_keyframe(self):
+        otra = self.Image.new('RGB', (640, 360), (200, 10, 10))
+        self.assertEqual(self.c.codificar(otra, ahora=1.0)[0], 'key')
+        self.assertEqual(self.c.codificar(otra, ahora=1.0 + server.KEEPALIVE_PROFESOR)[0], 'key')
+
+    def test_keyframe_de_captura_sin_reducir_se_codifica_del_bgra(self):
+        cap = types.SimpleNamespace(bgra=self.base.tobytes('raw', 'BGRX'), width=640, height=360)
+        otra = server._CambiosProfesor()
+        with patch.object(server, '_turbojpeg', return_value=True), \
+                patch.object(server, '_codificar_jpeg_bgra', return_value=b'bgra') as bgra:
+            self.assertEqual(otra.codificar(self.base, ahora=0.0, cap=cap), ('key', b'bgra'))
+        bgra.assert_called_once_with(cap, server.CALIDAD_PROFESOR)
+
+    def test_keyframe_pedido_incluye_los_parches(self):
+        self.c.codificar(self._con_cuadro(100, 70), ahora=1.0)
+        img = self.Image.open(io.BytesIO(self.c.keyframe())).convert('RGB')
+        self.assertGreater(min(img.getpixel((105, 75))), 200)
+
+    def test_alumno_sin_base_recibe_keyframe(self):
+        self.c.codificar(self._con_cuadro(100, 70), ahora=1.0)
+        server._teacher_capture.update(running=True, cambios=self.c)
+        self.addCleanup(server._teacher_capture.update, running=False, cambios=None)
+        self.alumno.emit('teacher_keyframe', {})
+        kf = _eventos(self.alumno, 'teacher_screen')
+        self.assertEqual(kf[0]['image'], self.c.keyframe())
+
+    def test_keyframe_solo_para_los_alumnos_destino(self):
+        self.c.codificar(self._con_cuadro(100, 70), ahora=1.0)
+        server._teacher_capture.update(running=True, cambios=self.c, sids=['otro-sid'])
+        self.addCleanup(server._teacher_capture.update, running=False, cambios=None, sids=None)
+        self.alumno.emit('teacher_keyframe', {})
+        self.prof.emit('teacher_keyframe', {})
+        self.assertEqual(_eventos(self.alumno, 'teacher_screen'), [])
+        self.assertEqual(_eventos(self.prof, 'teacher_screen'), [])
+
+
+class TestHiloCapturaProfesor(_BaseServidor):
+    """La captura del profesor se codifica fuera del event loop de eventlet."""
+
+    def test_frames_se_preparan_en_otro_hilo(self):
+        hilos = set()
+
+        def capturar():
+            hilos.add(threading.get_ident())
+            return types.SimpleNamespace(bgra=bytes(64 * 36 * 4), width=64, height=36)
+
+        server._teacher_capture.update(running=True, sid=next(iter(server.dashboards)), sids=None)
+        self.addCleanup(server._parar_captura_profesor)
+        tarea = server.socketio.start_background_task(
+            server._teacher_capture_loop, server._teacher_capture['gen'], capturar)
+        server.socketio.sleep(0.3)
+        server._parar_captura_profesor()
+        tarea.join()
+        self.assertEqual(len(hilos), 1)
+        self.assertNotIn(threading.get_ident(), hilos)
+        frames = _eventos(self.alumno, 'teacher_screen')
+        self.assertEqual(len(frames), 1)   # pantalla quieta: solo el primer keyframe
+        self.assertTrue(frames[0]['image'].startswith(b'\xff\xd8'))
+        self.assertTrue(_eventos(self.prof, 'teacher_screen_preview'))
+
+    def test_sin_mss_avisa_al_profesor(self):
+        server._teacher_capture.update(running=True, sid=next(iter(server.dashboards)), sids=None)
+        self.addCleanup(server._teacher_capture.update, running=False)
+        with patch.dict(sys.modules, {'mss': None}):
+            server._teacher_capture_loop(server._teacher_capture['gen'])
+        (aviso,) = _eventos(self.prof, 'teacher_screen_preview')
+        self.assertIn('mss', aviso['error'])
+
+
+class TestGeneracionCaptura(_BaseServidor):
+    """Reiniciar la captura del profesor no bloquea ni deja dos bucles a la vez."""
+
+    @staticmethod
+    def _captura(contador):
+        def capturar():
+            contador[0] += 1
+            return types.SimpleNamespace(bgra=bytes(64 * 36 * 4), width=64, height=36)
+        return capturar
+
+    def _arrancar(self, capturar):
+        server._parar_captura_profesor()
+        server._teacher_capture.update(running=True, sid=next(iter(server.dashboards)), sids=None)
+        return server.socketio.start_background_task(
+            server._teacher_capture_loop, server._teacher_capture['gen'], capturar)
+
+    def test_generacion_obsoleta_sale_sola(self):
+        self.addCleanup(server._parar_captura_profesor)
+        viejo, nuevo = [0], [0]
+        t_viejo = self._arrancar(self._captura(viejo))
+        server.socketio.sleep(0.2)
+        self._arrancar(self._captura(nuevo))
+        t_viejo.join()   # termina sin que nadie ponga running a False
+        parado = viejo[0]
+        server.socketio.sleep(0.6)
+        self.assertEqual(viejo[0], parado)
+        self.assertGreater(nuevo[0], 0)
+        nombres = [t.name for t in threading.enumerate()]
+        self.assertEqual(nombres.count('vigia-captura-profesor'), 1)
+
+    def test_reinicio_no_espera(self):
+        self.addCleanup(server._parar_captura_profesor)
+        with patch.object(server, '_teacher_capture_loop') as bucle:
+            for monitor in (1, 2):
+                self.prof.emit('start_teacher_capture', {'type': 'monitor', 'monitor': monitor})
+            server.socketio.sleep(0)   # deja arrancar las tareas de fondo
+        primera, segunda = (c.args[0] for c in bucle.call_args_list)
+        self.assertNotEqual(primera, segunda)
+        self.assertFalse(server._captura_vigente(primera))
+        self.assertTrue(server._captura_vigente(segunda))
+        self.assertEqual(server._teacher_capture['monitor'], 2)
+
+
+class TestSelectorPantallas(_BaseServidor):
+    """get_screens responde enseguida y las miniaturas llegan después, una a una."""
+
+    def test_lista_sin_miniaturas_y_luego_screen_thumb(self):
+        from unittest.mock import MagicMock
+        mon = {'left': 0, 'top': 0, 'width': 1920, 'height': 1080}
+        win = {'wid': '0x3a00007', 'x': 10, 'y': 20, 'w': 800, 'h': 600,
+               'title': 'Editor', 'clases': ['gedit', 'Gedit']}
+        ventanas_x = MagicMock()
+        ventanas_x.miniatura.return_value = None   # sin Xlib: se recorta la región con mss
+        with patch.object(server, '_listar_pantallas', return_value=([mon, mon], [win])), \
+             patch.object(server, '_ventanas_x', ventanas_x), \
+             patch.object(server, '_capture_thumb', return_value=_JPEG) as capturar, \
+             patch.object(server, '_get_window_app_icon', return_value='data:icono') as icono, \
+             patch('mss.mss'):
+            self.prof.emit('get_screens')
+            lista = _eventos(self.prof, 'screens_list')[0]['screens']
+            self.assertEqual([s['id'] for s in lista], ['monitor-0', 'monitor-1', '0x3a00007'])
+            self.assertFalse(any('thumb' in s for s in lista))
+            miniaturas = []
+            for _ in range(50):
+                server.socketio.sleep(0.02)
+                miniaturas += _eventos(self.prof, 'screen_thumb')
+                if len(miniaturas) == 3:
+                    break
+        self.assertEqual([m['id'] for m in miniaturas], ['monitor-0', 'monitor-1', '0x3a00007'])
+        self.assertEqual(miniaturas[2]['icon'], 'data:icono')
+        icono.assert_called_once_with('0x3a00007', ['gedit', 'Gedit'])
+        capturar.assert_called_with(ANY, {'left': 10, 'top': 20, 'width': 800, 'height': 600})
+
+    def test_sin_xlib_se_usa_xprop(self):
+        v = server._VentanasX()
+        with patch.dict(sys.modules, {'Xlib': None}):
+            self.assertIsNone(v.listar())
+            self.assertIsNone(v.region('0x1'))
+        with patch.object(server, '_ventanas_x', v), \
+             patch.object(server, '_get_window_list_xprop', return_value=['xprop']):
+            self.assertEqual(server._get_window_list(), ['xprop'])
+
+
+class TestFormatos(_BaseServidor):
+    """Negociación del formato de las miniaturas (JPEG/WebP/AVIF)."""
+
+    def _anuncios(self):
+        return [d['formatos'] for d in _eventos(self.alumno, 'image_formats')]
+
+    def test_dashboard_sin_formatos_solo_jpeg(self):
+        self.assertEqual(server._formatos_comunes(), ['jpeg'])
+
+    def test_webp_si_todos_los_dashboards_lo_entienden(self):
+        self.prof.disconnect()
+        prof = server.socketio.test_client(server.app)
+        prof.emit('register_teacher', {'formatos': ['webp', 'jpeg']})
+        self.assertEqual(self._anuncios()[-1], ['webp', 'jpeg'])
+        prof.disconnect()
+
+    def test_un_dashboard_antiguo_limita_a_jpeg(self):
+        self.prof.disconnect()
+        a = server.socketio.test_client(server.app)
+        a.emit('register_teacher', {'formatos': ['webp', 'jpeg']})
+        b = server.socketio.test_client(server.app)
+        b.emit('register_teacher')
+        self.assertEqual(self._anuncios()[-1], ['jpeg'])
+        b.disconnect()
+        self.assertEqual(self._anuncios()[-1], ['webp', 'jpeg'])
+        a.disconnect()
+
+    def test_alumno_nuevo_recibe_formatos(self):
+        otro = server.socketio.test_client(server.app)
+        otro.emit('register', {'name': 'alumno - pc02'})
+        self.assertEqual([d['formatos'] for d in _eventos(otro, 'image_formats')], [['jpeg']])
+        otro.disconnect()
+
+    def test_formato_del_alumno_se_registra(self):
+        self.alumno.emit('screenshot', {'image': _JPEG, 'kf': 1, 'fmt': 'webp'})
+        self.assertEqual(server.students[self.sid].formato, 'webp')
+        api = server.app.test_client().get('/api/students').get_json()
+        self.assertEqual(api[0]['formato'], 'webp')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)